@@ -0,0 +1,164 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import HTTPException, status
+
+from src.env import env
+from src.llm.LLMs import Models
+
+DEFAULT_CONCURRENCY_LIMIT = 8
+# Expected duration of a chat before the first one finished, used for the Retry-After estimate
+INITIAL_SERVICE_SECONDS = 5.0
+
+
+class ModelLimiter:
+    """Limits the number of concurrent chats of one model and queues the requests above the limit.
+
+    Waiting requests are grouped by API key and admitted round-robin, so that one client cannot starve the others.
+    A key may only hold its fair share of the queue. Requests are rejected right away with 429 if the key exceeds its
+    share, with 503 if the queue is full and with 503 if they waited longer than the queue timeout. All rejections carry
+    a Retry-After header estimated from the average duration of a chat."""
+
+    def __init__(self, model: str, limit: int, queue_size: int, queue_timeout: float, api_key_count: int) -> None:
+        self.model = model
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.key_share = max(1, math.ceil(queue_size / max(1, api_key_count)))
+
+        self.active = 0
+        # api key -> futures of the waiting requests, in the order in which the keys are served
+        self._waiting: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self._queued = 0
+
+        self.service_seconds = INITIAL_SERVICE_SECONDS  # moving average of the chat duration
+        self.wait_seconds = 0.0  # moving average of the queue wait of admitted requests
+        self.max_wait_seconds = 0.0
+        self.admitted = 0
+        self.rejected_key_share = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def retry_after(self) -> int:
+        """Seconds until the requests in front of a new request are expected to be served."""
+        return max(1, math.ceil(self.service_seconds * (self._queued + 1) / self.limit))
+
+    def _reject(self, status_code: int, detail: str) -> HTTPException:
+        return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after())})
+
+    async def acquire(self, api_key: str) -> None:
+        if self.active < self.limit and self._queued == 0:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if self._queued >= self.queue_size:
+            self.rejected_queue_full += 1
+            raise self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, f"Too many requests for {self.model}.")
+        if len(self._waiting.get(api_key, ())) >= self.key_share:
+            self.rejected_key_share += 1
+            raise self._reject(status.HTTP_429_TOO_MANY_REQUESTS, f"Too many concurrent requests for {self.model}.")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(api_key, deque()).append(future)
+        self._queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before the timeout, pass it on to the next request
+                self.release()
+            else:
+                future.cancel()
+                self._remove_waiter(api_key, future)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected_timeout += 1
+            raise self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, f"Timed out waiting for {self.model}.")
+
+        waited = time.perf_counter() - start
+        self.wait_seconds = 0.9 * self.wait_seconds + 0.1 * waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.admitted += 1
+
+    def _remove_waiter(self, api_key: str, future: asyncio.Future) -> None:
+        key_queue = self._waiting.get(api_key)
+        if key_queue is not None and future in key_queue:
+            key_queue.remove(future)
+            self._queued -= 1
+            if not key_queue:
+                del self._waiting[api_key]
+
+    def release(self, service_seconds: float | None = None) -> None:
+        """Free the slot of a finished request and hand it over to the next waiting API key."""
+        if service_seconds is not None:
+            self.service_seconds = 0.9 * self.service_seconds + 0.1 * service_seconds
+        while self._waiting:
+            api_key, key_queue = self._waiting.popitem(last=False)
+            future = key_queue.popleft()
+            self._queued -= 1
+            if key_queue:
+                # the key goes to the end of the round-robin order
+                self._waiting[api_key] = key_queue
+            if not future.done():
+                # the slot stays active and is taken over by the waiting request
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, api_key: str) -> AsyncIterator[None]:
+        await self.acquire(api_key)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": self._queued,
+            "queue_wait_seconds": self.wait_seconds,
+            "max_queue_wait_seconds": self.max_wait_seconds,
+            "service_seconds": self.service_seconds,
+            "admitted": self.admitted,
+            "rejected_key_share": self.rejected_key_share,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+
+class AdmissionController:
+    """One ModelLimiter per model, configured through LLM_CONCURRENCY_LIMITS, LLM_QUEUE_SIZE and LLM_QUEUE_TIMEOUT.
+    The limits apply per worker process."""
+
+    def __init__(self) -> None:
+        self._limiters: dict[Models, ModelLimiter] = {}
+
+    def get_limiter(self, model: Models) -> ModelLimiter:
+        if model not in self._limiters:
+            self._limiters[model] = ModelLimiter(
+                model=model.value,
+                limit=env.LLM_CONCURRENCY_LIMITS.get(model.value, DEFAULT_CONCURRENCY_LIMIT),
+                queue_size=env.LLM_QUEUE_SIZE,
+                queue_timeout=env.LLM_QUEUE_TIMEOUT,
+                api_key_count=len(env.REST_API_KEYS),
+            )
+        return self._limiters[model]
+
+    def stats(self) -> dict:
+        return {model.value: limiter.stats() for model, limiter in self._limiters.items()}
+
+
+admission = AdmissionController()
@@ -0,0 +1,226 @@
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
+
+from langfuse import Langfuse
+
+from src.env import env
+
+FEEDBACK_SCORE_NAME = "user-explicit-feedback"
+MAX_QUEUE_SIZE = 10000
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 1  # in seconds, how long the background thread waits for more feedback before sending a batch
+HEALTH_CHECK_INTERVAL = 30  # in seconds, how often the Langfuse connection is checked
+# replay files of other workers are only taken over when they were not touched for this long, e.g. after a crash
+STALE_REPLAY_AGE = 60  # in seconds
+
+logger = logging.getLogger("api")
+
+
+@dataclass
+class Feedback:
+    trace_id: str
+    value: int
+    comment: str | None
+    # score id, so that a feedback replayed from the spool file is not counted twice
+    id: str
+
+
+class FeedbackQueue:
+    """Sends user feedback to Langfuse in the background, so that the feedback endpoint does not wait for Langfuse.
+
+    Feedback is put on a bounded in-memory queue and sent in batches by a background thread with one long-lived
+    Langfuse client. The client drops scores it cannot send without an error, so the connection is checked every
+    HEALTH_CHECK_INTERVAL seconds and the feedback sent since the last successful check is kept until then. While
+    Langfuse is unreachable, the feedback is appended to a spool file (JSON lines) and sent when Langfuse is reachable
+    again. Feedback is only lost when the queue is full and the spool file not writable."""
+
+    def __init__(self, spool_path: str, max_size: int = MAX_QUEUE_SIZE) -> None:
+        self.spool_path = spool_path
+        self._queue: queue.Queue[Feedback] = queue.Queue(maxsize=max_size)
+        self._client: Langfuse | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._spool_lock = threading.Lock()
+        self._reachable = True
+        self._last_health_check = 0.0
+        # sent after the last successful health check, spooled if the next check fails
+        self._unconfirmed: list[Feedback] = []
+
+        self.submitted = 0
+        self.sent = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+
+    @property
+    def client(self) -> Langfuse:
+        if self._client is None:
+            self._client = Langfuse()
+        return self._client
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="feedback-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, trace_id: str, value: int, comment: str | None) -> None:
+        """Queue the feedback without blocking."""
+        if self._thread is None:
+            # e.g. when the app is used through a TestClient without lifespan
+            self.start()
+        feedback = Feedback(trace_id=trace_id, value=value, comment=comment, id=str(uuid.uuid4()))
+        self.submitted += 1
+        try:
+            self._queue.put_nowait(feedback)
+        except queue.Full:
+            logger.warning("Feedback queue is full, writing the feedback to the spool file.")
+            self._spool([feedback])
+
+    def close(self) -> None:
+        """Stop the background thread after sending the queued feedback, called when the worker shuts down."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._send(self._take_batch(self._queue.qsize()))
+        if self._unconfirmed:
+            self._confirm()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._take_batch(BATCH_SIZE, timeout=FLUSH_INTERVAL)
+            try:
+                if self._is_reachable():
+                    self._replay_spool()
+                self._send(batch)
+            except Exception:
+                logger.exception("Sending feedback failed, writing it to the spool file.")
+                self._spool(batch)
+
+    def _take_batch(self, size: int, timeout: float | None = None) -> list[Feedback]:
+        batch: list[Feedback] = []
+        try:
+            # wait for the first feedback, then take what is already queued
+            batch.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            while len(batch) < size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _check_reachable(self) -> bool:
+        self._last_health_check = time.monotonic()
+        try:
+            self._reachable = self.client.auth_check()
+        except Exception:
+            self._reachable = False
+        return self._reachable
+
+    def _is_reachable(self) -> bool:
+        """Langfuse is checked again after it was unreachable, at most every HEALTH_CHECK_INTERVAL seconds."""
+        if not self._reachable and time.monotonic() - self._last_health_check >= HEALTH_CHECK_INTERVAL:
+            self._check_reachable()
+        return self._reachable
+
+    def _send(self, batch: list[Feedback]) -> None:
+        if not batch:
+            return
+        if not self._is_reachable():
+            self._spool(batch)
+            return
+        for feedback in batch:
+            self.client.score(
+                id=feedback.id,
+                trace_id=feedback.trace_id,
+                name=FEEDBACK_SCORE_NAME,
+                value=feedback.value,
+                comment=feedback.comment,
+            )
+        # The client sends the scores in its own background thread and drops them if that fails. The batch is
+        # confirmed by the next health check, if Langfuse is not reachable then, it is kept in the spool file. Scores
+        # are identified by their id, so a batch that arrived nevertheless is not counted twice when it is replayed.
+        self.client.flush()
+        self._unconfirmed.extend(batch)
+        if time.monotonic() - self._last_health_check >= HEALTH_CHECK_INTERVAL:
+            self._confirm()
+
+    def _confirm(self) -> None:
+        unconfirmed, self._unconfirmed = self._unconfirmed, []
+        if self._check_reachable():
+            self.sent += len(unconfirmed)
+        else:
+            self._spool(unconfirmed)
+
+    def _spool(self, batch: list[Feedback]) -> None:
+        with self._spool_lock:
+            try:
+                with open(self.spool_path, "a") as file:
+                    for feedback in batch:
+                        file.write(json.dumps(asdict(feedback)) + "\n")
+                self.spooled += len(batch)
+            except OSError:
+                logger.exception(f"Writing {len(batch)} feedback to the spool file failed, the feedback is lost.")
+                self.dropped += len(batch)
+
+    def _claim_replay_files(self) -> list[str]:
+        """Rename the spool file to a replay file of this worker, so that feedback spooled by a failed replay is not
+        read again. Replay files left by a failed replay of this worker or a crashed worker are taken over, too."""
+        replay_prefix = f"{self.spool_path}.{os.getpid()}."
+        claimed = []
+        with self._spool_lock:
+            for path in [self.spool_path, *glob.glob(f"{glob.escape(self.spool_path)}.*.replay")]:
+                try:
+                    if path != self.spool_path and not path.startswith(replay_prefix):
+                        if time.time() - os.stat(path).st_mtime < STALE_REPLAY_AGE:
+                            continue
+                    replay_path = f"{replay_prefix}{uuid.uuid4().hex}.replay"
+                    os.replace(path, replay_path)
+                    # renaming keeps the modification time, the other workers must not take over the claimed file
+                    os.utime(replay_path)
+                except FileNotFoundError:
+                    # not spooled or claimed by another worker in the meantime
+                    continue
+                claimed.append(replay_path)
+        return claimed
+
+    def _replay_spool(self) -> None:
+        for replay_path in self._claim_replay_files():
+            batch = []
+            with open(replay_path) as file:
+                for number, line in enumerate(file, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        batch.append(Feedback(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        logger.warning(f"Skipping the corrupt line {number} of the spool file {replay_path}.")
+                        self.dropped += 1
+            logger.info(f"Replaying {len(batch)} feedback from the spool file.")
+            # removed after sending, a replay that raises is retried from the file. Feedback that could not be sent is
+            # spooled again by _send.
+            self._send(batch)
+            os.remove(replay_path)
+            if self._reachable:
+                self.replayed += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "langfuse_reachable": self._reachable,
+        }
+
+
+feedback_queue = FeedbackQueue(spool_path=env.FEEDBACK_SPOOL_PATH)
@@ -1,4 +1,6 @@
+import gc
 import multiprocessing
+import os
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -11,3 +13,29 @@ timeout = 230
 num_cpus = multiprocessing.cpu_count()
 workers = min((num_cpus * 2) + 1, 8)
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# Load the app and the read-only chat components in the master, the workers share their memory copy-on-write
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+
+def when_ready(server):
+    if preload_app:
+        from src.api.registry import registry
+
+        registry.preload()
+        # objects of the master are never collected in the workers, so that their pages stay shared
+        gc.collect()
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from src.api.registry import registry
+
+        registry.after_fork()
+
+
+def post_worker_init(worker):
+    from src.api.memory import process_memory
+
+    worker.log.info(f"Worker {worker.pid} started, memory: {process_memory()}")
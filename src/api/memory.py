@@ -0,0 +1,27 @@
+import resource
+
+SMAPS_ROLLUP = "/proc/self/smaps_rollup"
+
+
+def process_memory() -> dict:
+    """Memory usage of the current process in kB.
+
+    rss counts every resident page, also those shared copy-on-write with the gunicorn master and the other workers.
+    pss divides shared pages by the number of processes sharing them, so the pss of all workers adds up to the
+    memory actually used. Outside of Linux only the peak rss is available."""
+    try:
+        with open(SMAPS_ROLLUP) as file:
+            values = {}
+            for line in file:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    values[parts[0].rstrip(":")] = int(parts[1])
+    except OSError:
+        return {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    return {
+        "rss_kb": values.get("Rss"),
+        "pss_kb": values.get("Pss"),
+        "shared_kb": values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0),
+        "private_kb": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+    }
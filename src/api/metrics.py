@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+from src.llm.timing import RequestTimings
+
+QUANTILES = [0.5, 0.95, 0.99]
+# The quantiles are computed over the most recent samples of each stage, model and fallback combination
+MAX_SAMPLES = 1024
+STAGE_METRIC = "kicwa_chat_stage_duration_seconds"
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels.keys(), escaped)) + "}"
+
+
+class StageMetrics:
+    """Latency summaries per chat stage, model and fallback flag in the Prometheus text format.
+
+    The metrics are kept per worker process and labelled with its pid, each scrape returns the metrics of the worker
+    that answered it."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (stage, model, fallback) -> (recent samples, count, sum)
+        self._samples: dict[tuple[str, str, bool], deque[float]] = {}
+        self._counts: dict[tuple[str, str, bool], int] = {}
+        self._sums: dict[tuple[str, str, bool], float] = {}
+
+    def observe(self, timings: RequestTimings) -> None:
+        with self._lock:
+            for stage, seconds in timings.stages.items():
+                key = (stage, timings.model, timings.fallback)
+                if key not in self._samples:
+                    self._samples[key] = deque(maxlen=MAX_SAMPLES)
+                    self._counts[key] = 0
+                    self._sums[key] = 0.0
+                self._samples[key].append(seconds)
+                self._counts[key] += 1
+                self._sums[key] += seconds
+
+    def render(self, gauges: dict[str, tuple[str, list[tuple[dict[str, str], float]]]] | None = None) -> str:
+        """Render the summaries and the given gauges, which map a metric name to its help text and labelled values."""
+        worker = str(os.getpid())
+        lines = [
+            f"# HELP {STAGE_METRIC} Duration of the stages of a chat request.",
+            f"# TYPE {STAGE_METRIC} summary",
+        ]
+        with self._lock:
+            keys = sorted(self._samples.keys())
+            snapshot = {key: (np.array(self._samples[key]), self._counts[key], self._sums[key]) for key in keys}
+        for (stage, model, fallback), (samples, count, total) in snapshot.items():
+            labels = {"stage": stage, "model": model, "fallback": str(fallback).lower(), "worker": worker}
+            for quantile, value in zip(QUANTILES, np.quantile(samples, QUANTILES)):
+                lines.append(f"{STAGE_METRIC}{format_labels({**labels, 'quantile': str(quantile)})} {value:.6f}")
+            lines.append(f"{STAGE_METRIC}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{STAGE_METRIC}_count{format_labels(labels)} {count}")
+
+        for name, (help_text, values) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                lines.append(f"{name}{format_labels({**labels, 'worker': worker})} {value}")
+        return "\n".join(lines) + "\n"
+
+
+stage_metrics = StageMetrics()
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import threading
+import time
+
+from src.api.memory import process_memory
+from src.env import env
+from src.llm.assistant import KICampusAssistant
+from src.llm.circuit_breaker import circuit_breakers
+from src.llm.clients import llm_clients
+from src.llm.contextualization_cache import (
+    ContextualizationCache,
+    InMemoryMemoBackend,
+    SqliteMemoBackend,
+)
+from src.llm.hedging import hedger
+from src.llm.routing import deployment_routers
+from src.llm.semantic_cache import (
+    InMemoryCacheBackend,
+    QdrantCacheBackend,
+    SemanticCache,
+)
+from src.llm.speculative_retrieval import SpeculativeRetrieval
+from src.llm.streaming import stream_stats
+from src.llm.tools.history_summarizer import ChatHistorySummarizer
+from src.llm.tools.language_detector import LanguageDetector
+from src.llm.tools.standalone_classifier import StandaloneQuestionClassifier
+from src.vectordb.catalog import CourseCatalog
+from src.vectordb.qdrant import VectorDBQdrant
+
+logger = logging.getLogger("api")
+
+
+class ComponentRegistry:
+    """Holds the components of the chat pipeline and the course catalog for the lifetime of a worker process.
+
+    Building the assistant creates the embedder, the Qdrant connection and the lingua language models, which takes
+    several hundred milliseconds. The registry builds them once when the worker starts, so that a request only pays
+    for its own I/O. Requests that arrive before the startup build finished (e.g. when the app is used through a
+    TestClient without lifespan) build the components lazily on first use.
+
+    With gunicorn's preload mode, the read-only parts (language models and course catalog) are built once in the
+    master process by preload() and shared copy-on-write with the forked workers. Network clients are never shared,
+    each worker creates its own in build()."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._vector_db: VectorDBQdrant | None = None
+        self._assistant: KICampusAssistant | None = None
+        self._catalog: CourseCatalog | None = None
+        self._semantic_cache: SemanticCache | None = None
+        self._contextualization_cache: ContextualizationCache | None = None
+        self._language_detector: LanguageDetector | None = None
+        self.preloaded = False
+
+        self.build_seconds: float | None = None
+        self.first_request_seconds: float | None = None
+        self.warm_request_seconds: float | None = None
+        self.requests_served = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def build(self, vector_db: VectorDBQdrant | None = None) -> None:
+        """Build all components. Safe to call multiple times, only the first successful call does the work.
+
+        A vector database can be passed instead of the production Qdrant, e.g. an in-memory one for load tests."""
+        with self._lock:
+            if self._ready.is_set():
+                return
+            start = time.perf_counter()
+            self._vector_db = vector_db or VectorDBQdrant("prod_remote")
+            self._semantic_cache = self._build_semantic_cache(self._vector_db)
+            self._contextualization_cache = self._build_contextualization_cache()
+            self._assistant = KICampusAssistant(
+                vector_db=self._vector_db,
+                semantic_cache=self._semantic_cache,
+                language_detector=self._language_detector,
+                speculative_retrieval=(
+                    SpeculativeRetrieval(threshold=env.SPECULATIVE_RETRIEVAL_THRESHOLD)
+                    if env.SPECULATIVE_RETRIEVAL
+                    else None
+                ),
+                standalone_classifier=(
+                    StandaloneQuestionClassifier(threshold=env.STANDALONE_CLASSIFIER_THRESHOLD)
+                    if env.STANDALONE_CLASSIFIER
+                    else None
+                ),
+                contextualization_cache=self._contextualization_cache,
+                history_summarizer=ChatHistorySummarizer(
+                    token_budgets=env.CHAT_HISTORY_TOKEN_BUDGETS, summarize=env.CHAT_HISTORY_SUMMARY
+                ),
+            )
+            if self._catalog is None:
+                self._catalog = CourseCatalog(self._vector_db)
+                try:
+                    self._catalog.load()
+                except Exception:
+                    logger.exception("Loading the course catalog failed, the refresh thread retries it.")
+            else:
+                # the catalog was preloaded in the gunicorn master, it keeps its ids but uses the client of this worker
+                self._catalog.vector_db = self._vector_db
+            if self._semantic_cache is not None:
+                # cached answers are outdated when the knowledge base was rebuilt
+                self._catalog.on_change(self._semantic_cache.invalidate)
+            self._catalog.start()
+            self.build_seconds = time.perf_counter() - start
+            self._ready.set()
+        logger.info(
+            f"Chat components built in {self.build_seconds * 1000:.0f} ms (cold start, preloaded: {self.preloaded}), "
+            f"memory: {process_memory()}"
+        )
+
+    def preload(self) -> None:
+        """Build the read-only components in the gunicorn master before the workers are forked."""
+        start = time.perf_counter()
+        self._language_detector = LanguageDetector(preload_models=True)
+        vector_db = VectorDBQdrant("prod_remote")
+        catalog = CourseCatalog(vector_db)
+        try:
+            catalog.load()
+            self._catalog = catalog
+        except Exception:
+            logger.exception("Preloading the course catalog failed, every worker loads it on its own.")
+        # the connections of the master must not be used by the workers, the master has no event loop yet
+        vector_db.client.close()
+        asyncio.run(vector_db.aclient.close())
+        self.preloaded = True
+        logger.info(
+            f"Preloaded read-only components in {(time.perf_counter() - start) * 1000:.0f} ms, "
+            f"memory: {process_memory()}"
+        )
+
+    def after_fork(self) -> None:
+        """Reset the per-process state inherited from the gunicorn master, called in each forked worker."""
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._vector_db = None
+        self._assistant = None
+        self._semantic_cache = None
+        self._contextualization_cache = None
+        llm_clients.reset_after_fork()
+        if self._catalog is not None:
+            self._catalog.reset_after_fork()
+
+    @staticmethod
+    def _build_semantic_cache(vector_db: VectorDBQdrant) -> SemanticCache | None:
+        match env.SEMANTIC_CACHE_BACKEND:
+            case "memory":
+                backend: InMemoryCacheBackend | QdrantCacheBackend = InMemoryCacheBackend()
+            case "qdrant":
+                backend = QdrantCacheBackend(vector_db)
+            case _:
+                return None
+        return SemanticCache(backend, threshold=env.SEMANTIC_CACHE_THRESHOLD, ttl=env.SEMANTIC_CACHE_TTL)
+
+    @staticmethod
+    def _build_contextualization_cache() -> ContextualizationCache | None:
+        store = None
+        match env.CONTEXTUALIZATION_CACHE_BACKEND:
+            case "off":
+                return None
+            case "sqlite":
+                try:
+                    store = SqliteMemoBackend(env.CONTEXTUALIZATION_CACHE_PATH)
+                except Exception:
+                    logger.exception("Opening the contextualization cache file failed, only the memory cache is used.")
+        return ContextualizationCache(InMemoryMemoBackend(), store, ttl=env.CONTEXTUALIZATION_CACHE_TTL)
+
+    def get_assistant(self) -> KICampusAssistant:
+        if not self._ready.is_set():
+            logger.warning("Chat components requested before startup finished, building them now.")
+            self.build()
+        assert self._assistant is not None
+        return self._assistant
+
+    def get_catalog(self) -> CourseCatalog:
+        if not self._ready.is_set():
+            self.build()
+        assert self._catalog is not None
+        return self._catalog
+
+    def shutdown(self) -> None:
+        if self._catalog is not None:
+            self._catalog.stop()
+        if self._contextualization_cache is not None and self._contextualization_cache.store is not None:
+            self._contextualization_cache.store.close()
+
+    def record_request(self, seconds: float) -> None:
+        """Track the latency of the first (cold) request separately from the moving average of warm requests."""
+        self.requests_served += 1
+        if self.first_request_seconds is None:
+            self.first_request_seconds = seconds
+        elif self.warm_request_seconds is None:
+            self.warm_request_seconds = seconds
+        else:
+            self.warm_request_seconds = 0.9 * self.warm_request_seconds + 0.1 * seconds
+
+    def stats(self) -> dict:
+        return {
+            "registry": self.timings(),
+            "semantic_cache": self._semantic_cache.stats() if self._semantic_cache is not None else None,
+            "speculative_retrieval": (
+                self._assistant.speculative_retrieval.stats()
+                if self._assistant is not None and self._assistant.speculative_retrieval is not None
+                else None
+            ),
+            "standalone_classifier": (
+                self._assistant.contextualizer.classifier.stats()
+                if self._assistant is not None and self._assistant.contextualizer.classifier is not None
+                else None
+            ),
+            "contextualization_cache": (
+                self._contextualization_cache.stats() if self._contextualization_cache is not None else None
+            ),
+            "history_summarizer": self._assistant.history_summarizer.stats() if self._assistant is not None else None,
+            "source_packer": self._assistant.source_packer.stats() if self._assistant is not None else None,
+            "llm_clients": llm_clients.stats(),
+            "circuit_breakers": circuit_breakers.stats(),
+            "hedging": hedger.stats(),
+            "streaming": stream_stats.stats(),
+            "deployment_routers": deployment_routers.stats(),
+            "memory": process_memory(),
+        }
+
+    def timings(self) -> dict:
+        return {
+            "ready": self.ready,
+            "build_seconds": self.build_seconds,
+            "first_request_seconds": self.first_request_seconds,
+            "warm_request_seconds": self.warm_request_seconds,
+            "requests_served": self.requests_served,
+        }
+
+
+registry = ComponentRegistry()
@@ -1,20 +1,57 @@
-from typing import Annotated
+import base64
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated, AsyncIterator, Literal
 
-from fastapi import Depends, FastAPI, HTTPException, status
+import numpy as np
+from fastapi import Depends, FastAPI, HTTPException, Response, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
-from langfuse import Langfuse
 from langfuse.decorators import langfuse_context, observe
 from llama_index.core.llms import ChatMessage, MessageRole
 from pydantic import BaseModel, Field, field_validator, model_validator
 
+from src.api.admission import ModelLimiter, admission
+from src.api.feedback import feedback_queue
+from src.api.metrics import stage_metrics
 from src.api.models.serializable_chat_message import SerializableChatMessage
+from src.api.registry import registry
 from src.env import env
 from src.llm.assistant import KICampusAssistant
-from src.llm.LLMs import Models
-from src.vectordb.qdrant import VectorDBQdrant
+from src.llm.clients import llm_clients
+from src.llm.LLMs import AZURE_OPENAI_ENDPOINT, GWDG_ENDPOINT, Models
+from src.llm.retriever import MAX_BATCH_QUERIES
+from src.llm.timing import QUEUE, stage, track_request
+from src.vectordb.catalog import REFRESH_INTERVAL as CATALOG_REFRESH_INTERVAL
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the chat components once per worker, before the first request is accepted
+    try:
+        await run_in_threadpool(registry.build)
+    except Exception:
+        logging.getLogger("api").exception("Building chat components failed, retrying on first request.")
+    # open the connections to the LLM endpoints before the first chat needs them, unset endpoints are skipped
+    await llm_clients.awarm_up(
+        {
+            AZURE_OPENAI_ENDPOINT: getattr(env, "AZURE_OPENAI_URL", ""),
+            GWDG_ENDPOINT: getattr(env, "GWDG_URL", ""),
+        }
+    )
+    feedback_queue.start()
+    yield
+    registry.shutdown()
+    await llm_clients.aclose()
+    # send the queued feedback before the worker exits
+    await run_in_threadpool(feedback_queue.close)
+
+
+app = FastAPI(lifespan=lifespan)
 # authentication with OAuth2
 api_key_hearder = APIKeyHeader(name="Api-Key")
 app.add_middleware(
@@ -30,11 +67,12 @@ app.add_middleware(
 )
 
 
-async def api_key_auth(api_key: Annotated[str, Depends(api_key_hearder)]):
+async def api_key_auth(api_key: Annotated[str, Depends(api_key_hearder)]) -> str:
     ALLOWED_API_KEYS = env.REST_API_KEYS
 
     if api_key not in ALLOWED_API_KEYS:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
+    return api_key
 
 
 # APIs
@@ -44,6 +82,133 @@ def health() -> str:
     return "OK"
 
 
+@app.get("/ready")
+def ready() -> dict:
+    """Readiness check endpoint. Returns 503 until the chat components of this worker are built."""
+    if not registry.ready:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Chat components not yet built.")
+    return registry.timings()
+
+
+@app.get("/api/stats", dependencies=[Depends(api_key_auth)])
+def stats() -> dict:
+    """Statistics of this worker process, e.g. startup timings, semantic cache hit rate and queue depth per model."""
+    return {**registry.stats(), "admission": admission.stats(), "feedback": feedback_queue.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(api_key_auth)])
+def metrics() -> str:
+    """Stage latencies, queue depths and cache statistics of this worker process in the Prometheus text format.
+    Protected like /api/stats, the scraper has to send an Api-Key header."""
+    admission_stats = admission.stats()
+    registry_stats = registry.stats()
+    gauges = {
+        "kicwa_chats_active": (
+            "Chats in progress per model.",
+            [({"model": model}, stats["active"]) for model, stats in admission_stats.items()],
+        ),
+        "kicwa_chat_queue_depth": (
+            "Chats waiting for a model.",
+            [({"model": model}, stats["queue_depth"]) for model, stats in admission_stats.items()],
+        ),
+        "kicwa_chat_queue_wait_seconds": (
+            "Moving average of the time chats waited for a model.",
+            [({"model": model}, stats["queue_wait_seconds"]) for model, stats in admission_stats.items()],
+        ),
+        "kicwa_feedback_queue_depth": (
+            "Feedback waiting to be sent to Langfuse.",
+            [({}, feedback_queue.stats()["queue_depth"])],
+        ),
+        "kicwa_worker_memory_kb": (
+            "Memory of this worker process.",
+            [({"type": kind.removesuffix("_kb")}, value) for kind, value in registry_stats["memory"].items() if value],
+        ),
+    }
+    if registry_stats["semantic_cache"] is not None:
+        gauges["kicwa_semantic_cache_hit_rate"] = (
+            "Share of chats answered from the semantic cache.",
+            [({}, registry_stats["semantic_cache"]["hit_rate"])],
+        )
+    if registry_stats["speculative_retrieval"] is not None:
+        gauges["kicwa_speculative_retrieval_hit_rate"] = (
+            "Share of follow-up questions answered with the sources of the raw query.",
+            [({}, registry_stats["speculative_retrieval"]["hit_rate"])],
+        )
+        gauges["kicwa_speculative_retrieval_seconds_saved"] = (
+            "Mean latency saved by speculative retrieval when its sources were kept.",
+            [({}, registry_stats["speculative_retrieval"]["mean_seconds_saved"])],
+        )
+    if registry_stats["standalone_classifier"] is not None:
+        gauges["kicwa_contextualizer_skip_rate"] = (
+            "Share of follow-up questions that were not contextualized, because they are self-contained.",
+            [({}, registry_stats["standalone_classifier"]["skip_rate"])],
+        )
+    if registry_stats["contextualization_cache"] is not None:
+        gauges["kicwa_contextualization_cache_hit_rate"] = (
+            "Share of contextualized follow-up questions whose rewritten query was reused.",
+            [({}, registry_stats["contextualization_cache"]["hit_rate"])],
+        )
+    if registry_stats["history_summarizer"] is not None:
+        gauges["kicwa_history_summary_reuse_rate"] = (
+            "Share of long chat histories whose summary of older turns was reused from an earlier request.",
+            [({}, registry_stats["history_summarizer"]["reuse_rate"])],
+        )
+    if registry_stats["source_packer"] is not None:
+        gauges["kicwa_source_tokens_saved"] = (
+            "Mean tokens of the retrieved sources per answer that did not fit into the token budget of the model.",
+            [({}, registry_stats["source_packer"]["mean_tokens_saved"])],
+        )
+    gauges["kicwa_circuit_breaker_open"] = (
+        "Whether the circuit breaker of the LLM backend is open (1), half-open (0.5) or closed (0).",
+        [
+            ({"backend": backend}, {"open": 1.0, "half_open": 0.5}.get(stats["state"], 0.0))
+            for backend, stats in registry_stats["circuit_breakers"].items()
+        ],
+    )
+    gauges["kicwa_llm_hedge_rate"] = (
+        "Share of the calls of the model that were also sent to GPT-4, because they were slow.",
+        [({"model": model}, stats["hedge_rate"]) for model, stats in registry_stats["hedging"].items()],
+    )
+    gauges["kicwa_llm_time_to_first_token_seconds"] = (
+        "Moving average of the time until the first token of the model.",
+        [({"model": model}, stats["time_to_first_token"]) for model, stats in registry_stats["streaming"].items()],
+    )
+    gauges["kicwa_llm_tokens_per_second"] = (
+        "Moving average of the tokens per second the model generates after its first token.",
+        [({"model": model}, stats["tokens_per_second"]) for model, stats in registry_stats["streaming"].items()],
+    )
+    gauges["kicwa_deployment_latency_seconds"] = (
+        "Moving average of the latency until the response headers of the deployment, used for routing.",
+        [
+            ({"router": router, "deployment": deployment}, stats["latency_seconds"])
+            for router, deployments in registry_stats["deployment_routers"].items()
+            for deployment, stats in deployments.items()
+        ],
+    )
+    gauges["kicwa_deployment_headroom"] = (
+        "Share of the rate limit of the deployment that is left, from its x-ratelimit-remaining headers.",
+        [
+            ({"router": router, "deployment": deployment}, stats["headroom"])
+            for router, deployments in registry_stats["deployment_routers"].items()
+            for deployment, stats in deployments.items()
+        ],
+    )
+    endpoint_stats = registry_stats["llm_clients"]["endpoints"]
+    gauges["kicwa_llm_pool_utilization"] = (
+        "Share of the connections of the LLM endpoint pools that are in use.",
+        [({"endpoint": endpoint}, stats["utilization"]) for endpoint, stats in endpoint_stats.items()],
+    )
+    gauges["kicwa_llm_pool_connections"] = (
+        "Open connections to the LLM endpoints.",
+        [
+            ({"endpoint": endpoint, "state": state}, stats[f"{state}_connections"])
+            for endpoint, stats in endpoint_stats.items()
+            for state in ("open", "idle")
+        ],
+    )
+    return stage_metrics.render(gauges)
+
+
 class RetrievalRequest(BaseModel):
     message: str = Field(
         description="The query to find the most fitting sources to.",
@@ -65,14 +230,114 @@ class RetrievalRequest(BaseModel):
 
     @model_validator(mode="after")
     def validate_module_id(self):
-        if self.course_id and not self.module_id:
+        if self.module_id and not self.course_id:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="module_id is required when course_id is set.",
+                detail="course_id is required when module_id is set.",
             )
         return self
 
 
+class BatchRetrievalRequest(BaseModel):
+    queries: list[RetrievalRequest] = Field(
+        description="The queries to retrieve sources for. All queries are embedded and searched together.",
+        min_length=1,
+        max_length=MAX_BATCH_QUERIES,
+    )
+    limit: int = Field(default=10, ge=1, le=50, description="The maximum number of sources per query.")
+    embedding_format: Literal["float", "base64"] = Field(
+        default="float",
+        description="Format of the content embeddings: a list of floats or the base64 encoded little-endian float32 "
+        "array, which is about four times smaller.",
+    )
+
+
+class RetrievedSource(BaseModel):
+    content: str = Field(description="The text of the source.")
+    metadata: dict = Field(description="The metadata of the source, e.g. url, title, course_id and module_id.")
+    score: float | None = Field(description="The similarity of the source to the query.")
+    embedding: list[float] | str | None = Field(
+        default=None, description="The embedding of the source, if get_content_embeddings was set for the query."
+    )
+
+
+class RetrievalResult(BaseModel):
+    sources: list[RetrievedSource]
+
+
+class BatchRetrievalResponse(BaseModel):
+    results: list[RetrievalResult] = Field(description="The retrieved sources, in the same order as the queries.")
+
+
+async def validate_catalog_ids(course_id: int | None, module_id: int | None) -> None:
+    """Checks the course and module id of a request against the course catalog of the worker. The catalog is loaded at
+    startup, a worker whose catalog could not be loaded yet responds with 503 instead of calling Qdrant."""
+    if course_id is None and module_id is None:
+        return
+    try:
+        # builds the components of the worker if the startup build failed, which blocks
+        catalog = await run_in_threadpool(registry.get_catalog)
+    except Exception:
+        logging.getLogger("api").exception("Building the course catalog failed.")
+        catalog = None
+    if catalog is None or not catalog.loaded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The course catalog is not loaded yet, course_id and module_id cannot be checked.",
+            headers={"Retry-After": str(CATALOG_REFRESH_INTERVAL)},
+        )
+    if module_id is not None and not catalog.has_module(module_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"no module found with the given id: {module_id}.",
+        )
+    if course_id is not None and not catalog.has_course(course_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"no course found with the given id: {course_id}.",
+        )
+
+
+def encode_embedding(embedding: list[float], embedding_format: str) -> list[float] | str:
+    if embedding_format == "base64":
+        return base64.b64encode(np.asarray(embedding, dtype="<f4").tobytes()).decode("ascii")
+    return embedding
+
+
+@app.post("/api/retrieve", dependencies=[Depends(api_key_auth)])
+@observe()
+async def retrieve(batch_request: BatchRetrievalRequest) -> BatchRetrievalResponse:
+    """Returns the most fitting sources for a batch of queries without generating an answer."""
+    for query in batch_request.queries:
+        await validate_catalog_ids(query.course_id, query.module_id)
+    retriever = registry.get_assistant().retriever
+    with_vectors = any(query.get_content_embeddings for query in batch_request.queries)
+    nodes_per_query = await retriever.aretrieve_batch(
+        [(query.message, query.course_id, query.module_id) for query in batch_request.queries],
+        limit=batch_request.limit,
+        with_vectors=with_vectors,
+    )
+
+    results = []
+    for query, nodes in zip(batch_request.queries, nodes_per_query):
+        sources = []
+        for node_with_score in nodes:
+            node = node_with_score.node
+            embedding = None
+            if query.get_content_embeddings and node.embedding is not None:
+                embedding = encode_embedding(node.embedding, batch_request.embedding_format)
+            sources.append(
+                RetrievedSource(
+                    content=node.get_content(),
+                    metadata=node.metadata,
+                    score=node_with_score.score,
+                    embedding=embedding,
+                )
+            )
+        results.append(RetrievalResult(sources=sources))
+    return BatchRetrievalResponse(results=results)
+
+
 class ChatRequest(BaseModel):
     messages: list[SerializableChatMessage] = Field(
         description="All chat messages of the current conversation. The most recent should be a user message.",
@@ -124,22 +389,6 @@ class ChatRequest(BaseModel):
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="module_id is required when course_id is set.",
             )
-        if self.module_id is not None:
-            if not VectorDBQdrant().check_if_module_exists(self.module_id):
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"no module found with the given id: {self.module_id}.",
-                )
-        return self
-
-    @model_validator(mode="after")
-    def validate_course_id(self):
-        if self.course_id is not None:
-            if not VectorDBQdrant().check_if_course_exists(self.course_id):
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"no course found with the given id: {self.course_id}.",
-                )
         return self
 
 
@@ -151,14 +400,35 @@ class ChatResponse(BaseModel):
     response_id: str = Field(description="An ID for the response, that is needed for using the feedback endpoint.")
 
 
-@app.post("/api/chat", dependencies=[Depends(api_key_auth)])
+@app.post("/api/chat")
 @observe()
-def chat(chat_request: ChatRequest) -> ChatResponse:
-    """Returns the response to the user message in one response (no streaming)."""
-    assistant = KICampusAssistant()
+async def chat(
+    chat_request: ChatRequest, api_key: Annotated[str, Depends(api_key_auth)], response: Response
+) -> ChatResponse:
+    """Returns the response to the user message in one response (no streaming).
+    Responds with 429 or 503 and a Retry-After header when too many chats are in progress for the model.
+    The Server-Timing header contains the duration of each stage of the response in milliseconds."""
+    await validate_catalog_ids(chat_request.course_id, chat_request.module_id)
+    limiter = admission.get_limiter(chat_request.model)
+    with track_request(chat_request.model.value) as timings:
+        with stage(QUEUE):
+            await limiter.acquire(api_key)
+        start = time.perf_counter()
+        try:
+            chat_response = await answer_chat(chat_request)
+        finally:
+            limiter.release(time.perf_counter() - start)
+    response.headers["Server-Timing"] = timings.server_timing()
+    stage_metrics.observe(timings)
+    return chat_response
+
+
+async def answer_chat(chat_request: ChatRequest) -> ChatResponse:
+    start = time.perf_counter()
+    assistant = registry.get_assistant()
 
     if chat_request.course_id and not chat_request.module_id:
-        llm_response = assistant.chat_with_course(
+        llm_response = await assistant.achat_with_course(
             query=chat_request.get_user_query(),
             chat_history=chat_request.get_chat_history(),
             model=chat_request.model,
@@ -166,14 +436,14 @@ def chat(chat_request: ChatRequest) -> ChatResponse:
         )
 
     elif chat_request.course_id and chat_request.module_id:
-        llm_response = assistant.chat_with_course(
+        llm_response = await assistant.achat_with_course(
             query=chat_request.get_user_query(),
             chat_history=chat_request.get_chat_history(),
             model=chat_request.model,
             module_id=chat_request.module_id,
         )
     else:
-        llm_response = assistant.chat(
+        llm_response = await assistant.achat(
             query=chat_request.get_user_query(), chat_history=chat_request.get_chat_history(), model=chat_request.model
         )
 
@@ -183,9 +453,85 @@ def chat(chat_request: ChatRequest) -> ChatResponse:
     chat_response = ChatResponse(
         message=SerializableChatMessage.from_chat_message(llm_response).content, response_id=trace_id
     )
+    registry.record_request(time.perf_counter() - start)
     return chat_response
 
 
+def format_server_sent_event(event: str, data: str) -> str:
+    # data is JSON encoded, so that line breaks in the answer do not end the event
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_chat_events(
+    assistant: KICampusAssistant, chat_request: ChatRequest, queue_seconds: float = 0.0
+) -> AsyncIterator[str]:
+    timings = None
+    try:
+        with track_request(chat_request.model.value) as timings:
+            timings.add(QUEUE, queue_seconds)
+            async for event, text in assistant.astream_chat(
+                query=chat_request.get_user_query(),
+                chat_history=chat_request.get_chat_history(),
+                model=chat_request.model,
+                course_id=chat_request.course_id,
+                module_id=chat_request.module_id,
+            ):
+                if event == "answer":
+                    trace_id = langfuse_context.get_current_trace_id()
+                    yield format_server_sent_event("response_id", trace_id if trace_id else "TRACING_UNAVAILABLE")
+                    yield format_server_sent_event("message", text)
+                else:
+                    yield format_server_sent_event(event, text)
+    except Exception:
+        logging.getLogger("api").exception("Streaming the chat response failed.")
+        yield format_server_sent_event("error", "The response could not be generated.")
+    finally:
+        if timings is not None:
+            stage_metrics.observe(timings)
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Holds the admission slot of a chat until the response is finished. The slot is released when the response
+    ends in any way, also when the client disconnects before the first event, where the generator never runs."""
+
+    def __init__(self, content: AsyncIterator[str], limiter: ModelLimiter, **kwargs) -> None:
+        super().__init__(content, **kwargs)
+        self.limiter = limiter
+        self.admitted_at = time.perf_counter()
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.limiter.release(time.perf_counter() - self.admitted_at)
+
+
+@app.post("/api/chat/stream", response_class=StreamingResponse)
+async def chat_stream(chat_request: ChatRequest, api_key: Annotated[str, Depends(api_key_auth)]) -> StreamingResponse:
+    """Streams the response to the user message as Server-Sent Events with JSON encoded data.
+    'token' events contain parts of the answer text as soon as they are generated, without citations.
+    The stream closes with a 'response_id' event, needed for using the feedback endpoint, and a 'message' event
+    with the final answer including citations, which replaces the streamed text. On failure an 'error' event is sent.
+    Responds with 429 or 503 and a Retry-After header when too many chats are in progress for the model.
+    """
+    await validate_catalog_ids(chat_request.course_id, chat_request.module_id)
+    limiter = admission.get_limiter(chat_request.model)
+    start = time.perf_counter()
+    await limiter.acquire(api_key)
+    queue_seconds = time.perf_counter() - start
+    try:
+        assistant = registry.get_assistant()
+        return AdmittedStreamingResponse(
+            stream_chat_events(assistant, chat_request, queue_seconds),
+            limiter,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except Exception:
+        limiter.release()
+        raise
+
+
 class FeedbackRequest(BaseModel):
     response_id: str = Field(description="The ID of the response that the feedback belongs to.")
     feedback: str | None = Field(description="Feedback on the conversation.", default=None)
@@ -203,11 +549,10 @@ class FeedbackRequest(BaseModel):
 
 
 @app.post("/api/feedback", dependencies=[Depends(api_key_auth)])
-def track_feedback(feedback_request: FeedbackRequest) -> None:
-    """Update feedback in langfuse logs."""
-    Langfuse().score(
+async def track_feedback(feedback_request: FeedbackRequest) -> None:
+    """Update feedback in langfuse logs. The feedback is queued and sent to langfuse in the background."""
+    feedback_queue.submit(
         trace_id=feedback_request.response_id,
-        name="user-explicit-feedback",
         value=feedback_request.score,
         comment=feedback_request.feedback,
     )
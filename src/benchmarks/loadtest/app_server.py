@@ -0,0 +1,83 @@
+"""Runs the REST API against the fake backends and an in-memory Qdrant seeded from the fixture corpus.
+
+The environment is set before the project modules are imported, so that every client of the app (Azure OpenAI,
+Azure Mistral, GWDG, Langfuse) points to the fake backends and nothing is fetched from the key vault.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+
+CORPUS_PATH = Path(__file__).parent / "corpus.json"
+API_KEY = "loadtest"
+
+
+def configure_environment(backend_url: str, semantic_cache: str) -> None:
+    os.environ.update(
+        {
+            "KEY_VAULT_DISABLED": "true",
+            "REST_API_KEYS": json.dumps([API_KEY]),
+            "AZURE_OPENAI_URL": backend_url,
+            "AZURE_OPENAI_API_KEY": "loadtest",
+            "AZURE_OPENAI_GPT4_DEPLOYMENT": "gpt-4",
+            "AZURE_OPENAI_GPT4_MODEL": "gpt-4",
+            "AZURE_OPENAI_EMBEDDER_DEPLOYMENT": "text-embedding-ada-002",
+            "AZURE_OPENAI_EMBEDDER_MODEL": "text-embedding-ada-002",
+            "AZURE_MISTRAL_URL": f"{backend_url}/mistral",
+            "AZURE_MISTRAL_KEY": "loadtest",
+            "GWDG_URL": f"{backend_url}/gwdg/v1",
+            "GWDG_API_KEY": "loadtest",
+            "LANGFUSE_HOST": backend_url,
+            "LANGFUSE_PUBLIC_KEY": "pk-loadtest",
+            "LANGFUSE_SECRET_KEY": "sk-loadtest",
+            "SEMANTIC_CACHE_BACKEND": semantic_cache,
+            # every run starts with closed circuit breakers
+            "CIRCUIT_BREAKER_STATE_PATH": "",
+        }
+    )
+
+
+def seed_vector_db():
+    """Create an in-memory Qdrant with the fixture corpus, embedded like the fake embedding endpoint does."""
+    from llama_index.core.schema import TextNode
+
+    from src.benchmarks.loadtest.fake_backends import fake_embedding
+    from src.llm.retriever import COLLECTION_NAME
+    from src.vectordb.qdrant import VectorDBQdrant
+
+    with open(CORPUS_PATH) as file:
+        corpus = json.load(file)
+    nodes = [
+        TextNode(text=document["text"], metadata=document["metadata"], embedding=fake_embedding(document["text"]))
+        for document in corpus
+    ]
+
+    vector_db = VectorDBQdrant("memory")
+    vector_store = vector_db.as_llama_vector_store(COLLECTION_NAME, with_async_client=True)
+    # the sync and async in-memory clients do not share their storage
+    vector_store.add(nodes)
+    asyncio.run(vector_store.async_add(nodes))
+    return vector_db
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--backend-url", default="http://127.0.0.1:8900", help="URL of the fake backends")
+    parser.add_argument("--semantic-cache", default="off", choices=["memory", "off"])
+    args = parser.parse_args()
+    configure_environment(args.backend_url, args.semantic_cache)
+
+    import uvicorn
+
+    from src.api.registry import registry
+    from src.api.rest import app
+
+    registry.build(vector_db=seed_vector_db())
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Local stand-ins for the Azure OpenAI, Azure Mistral, GWDG and Langfuse APIs, used by the load test.
+
+Chat completions answer after a configurable latency and stream tokens at a configurable rate. Answers to the
+question answerer prompt are JSON with a citation, all other prompts (e.g. the contextualizer) get the user message
+back. Embeddings are deterministic hashed bag-of-words vectors, so that similar texts get similar embeddings.
+The configuration can be changed at runtime with POST /admin/config, e.g. to make GWDG slower than the fallback timeout.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from collections import Counter
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIMENSIONS = 256
+ANSWER_PROMPT_MARKER = "RESPONSE FORMAT"
+FAKE_ANSWER = (
+    "Der KI-Campus bietet kostenlose Online-Kurse zu Künstlicher Intelligenz an, die du jederzeit im eigenen Tempo "
+    "bearbeiten kannst. Nach erfolgreichem Abschluss erhältst du eine Teilnahmebestätigung. [doc1]"
+)
+
+config = {
+    "latency": 0.5,  # seconds until the first token
+    "tokens_per_second": 50.0,
+    "gwdg_latency": None,  # overrides the latency of the GWDG models, e.g. to trigger the GPT-4 fallback
+    "embedding_latency": 0.05,
+    "error_rate": 0.0,  # share of chat completions that fail with 500
+}
+requests_per_backend: Counter[str] = Counter()
+
+app = FastAPI()
+
+
+def fake_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> list[float]:
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % dimensions] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm > 0 else vector).tolist()
+
+
+def answer_for(messages: list[dict]) -> str:
+    system_prompt = " ".join(str(message.get("content")) for message in messages if message.get("role") == "system")
+    if ANSWER_PROMPT_MARKER in system_prompt:
+        return json.dumps({"answer": FAKE_ANSWER}, ensure_ascii=False)
+    return next(str(message["content"]) for message in reversed(messages) if message.get("role") == "user")
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+def completion_chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+async def chat_completion(request: Request, backend: str) -> JSONResponse | StreamingResponse:
+    requests_per_backend[backend] += 1
+    body = await request.json()
+    latency = config["gwdg_latency"] if backend == "gwdg" and config["gwdg_latency"] is not None else config["latency"]
+    if random.random() < config["error_rate"]:
+        await asyncio.sleep(latency)
+        raise HTTPException(status_code=500, detail="Injected error")
+
+    model = body.get("model") or backend
+    tokens = tokenize(answer_for(body["messages"]))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    seconds_per_token = 1 / config["tokens_per_second"]
+    await asyncio.sleep(latency)
+
+    if body.get("stream"):
+
+        async def stream():
+            yield f"data: {json.dumps(completion_chunk(completion_id, model, {'role': 'assistant'}, None))}\n\n"
+            for token in tokens:
+                await asyncio.sleep(seconds_per_token)
+                yield f"data: {json.dumps(completion_chunk(completion_id, model, {'content': token}, None))}\n\n"
+            yield f"data: {json.dumps(completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    await asyncio.sleep(seconds_per_token * len(tokens))
+    prompt_tokens = sum(len(tokenize(str(message.get("content")))) for message in body["messages"])
+    return JSONResponse(
+        {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens),
+            },
+        }
+    )
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def azure_openai_chat(deployment: str, request: Request):
+    return await chat_completion(request, "azure_openai")
+
+
+@app.post("/mistral/chat/completions")
+async def azure_mistral_chat(request: Request):
+    return await chat_completion(request, "mistral")
+
+
+@app.post("/gwdg/v1/chat/completions")
+async def gwdg_chat(request: Request):
+    return await chat_completion(request, "gwdg")
+
+
+@app.post("/openai/deployments/{deployment}/embeddings")
+async def azure_openai_embeddings(deployment: str, request: Request) -> dict:
+    requests_per_backend["embeddings"] += 1
+    body = await request.json()
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    await asyncio.sleep(config["embedding_latency"])
+
+    data = []
+    for index, text in enumerate(texts):
+        embedding: list[float] | str = fake_embedding(text)
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(np.asarray(embedding, dtype="<f4").tobytes()).decode()
+        data.append({"object": "embedding", "index": index, "embedding": embedding})
+    tokens = sum(len(tokenize(text)) for text in texts)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", deployment),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.post("/api/public/ingestion")
+async def langfuse_ingestion(request: Request) -> JSONResponse:
+    body = await request.json()
+    successes = [{"id": event.get("id"), "status": 201} for event in body.get("batch", [])]
+    return JSONResponse({"successes": successes, "errors": []}, status_code=207)
+
+
+@app.get("/api/public/projects")
+def langfuse_projects() -> dict:
+    return {"data": [{"id": "loadtest", "name": "loadtest"}]}
+
+
+@app.post("/admin/config")
+async def update_config(request: Request) -> dict:
+    config.update(await request.json())
+    return config
+
+
+@app.get("/admin/stats")
+def stats() -> dict:
+    return {"config": config, "requests": requests_per_backend}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=config["latency"], help="seconds until the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=config["tokens_per_second"])
+    parser.add_argument("--embedding-latency", type=float, default=config["embedding_latency"])
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"])
+    args = parser.parse_args()
+    config.update(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        embedding_latency=args.embedding_latency,
+        error_rate=args.error_rate,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Offline load test for /api/chat.
+
+Starts the fake backends (see fake_backends.py) and the REST API against them (see app_server.py), then sends chat
+requests with a fixed number of concurrent clients for every scenario and reports requests per second, latency
+percentiles and error rates per model. The last scenario makes GWDG slower than TIME_TO_WAIT_FOR_GWDG, so that the
+Llama3 requests time out and fall back to GPT-4. It runs last, because the circuit breaker of GWDG stays open
+afterwards. Whether a request was answered by the fallback is read from the Server-Timing header.
+
+Run from the project root:
+
+    python -m src.benchmarks.loadtest.run --duration 30 --concurrency 16 --output loadtest.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+import httpx
+import numpy as np
+
+from src.benchmarks.loadtest.app_server import API_KEY
+from src.benchmarks.startup import free_port
+
+STARTUP_TIMEOUT = 180  # in seconds
+REQUEST_TIMEOUT = 60  # in seconds
+# must be larger than TIME_TO_WAIT_FOR_GWDG in src/llm/LLMs.py
+GWDG_TIMEOUT_LATENCY = 8  # in seconds
+
+QUESTIONS = [
+    "Was kostet ein Kurs auf dem KI-Campus?",
+    "Bekomme ich ein Zertifikat, wenn ich einen Kurs abschließe?",
+    "Wie kann ich mich registrieren?",
+    "Which courses about machine learning do you offer?",
+    "Was ist ein Micro-Degree?",
+    "Worum geht es im Kurs Einführung in die KI?",
+]
+COURSE_QUESTIONS = [
+    "Was ist überwachtes Lernen?",
+    "Wie funktioniert k-Means?",
+    "Wie viele Versuche habe ich in der Abschlussprüfung?",
+    "Was macht Backpropagation?",
+]
+COURSE_ID = 79
+FOLLOW_UP_SHARE = 0.3  # share of requests with a chat history, which are contextualized first
+COURSE_SHARE = 0.3  # share of requests restricted to a course
+
+
+@dataclass
+class Scenario:
+    name: str
+    model: str
+    # applied to the fake backends before the scenario runs
+    backend_config: dict = field(default_factory=dict)
+
+
+SCENARIOS = [
+    Scenario(name="GPT-4", model="GPT-4"),
+    Scenario(name="Mistral8", model="Mistral8"),
+    Scenario(name="Llama3", model="Llama3"),
+    Scenario(name="Qwen2", model="Qwen2"),
+    Scenario(name="Llama3 (GWDG timeout)", model="Llama3", backend_config={"gwdg_latency": GWDG_TIMEOUT_LATENCY}),
+]
+
+
+@dataclass
+class Sample:
+    seconds: float
+    status: int  # 0 if the request failed without a response
+    fallback: bool = False
+
+
+def summarize(scenario: Scenario, samples: list[Sample], seconds: float) -> dict:
+    succeeded = [sample.seconds for sample in samples if sample.status == 200]
+    percentiles = np.percentile(succeeded, [50, 95, 99]).tolist() if succeeded else [None, None, None]
+    return {
+        "scenario": scenario.name,
+        "model": scenario.model,
+        "requests": len(samples),
+        "rps": len(samples) / seconds,
+        "p50": percentiles[0],
+        "p95": percentiles[1],
+        "p99": percentiles[2],
+        "mean": statistics.mean(succeeded) if succeeded else None,
+        "error_rate": 1 - len(succeeded) / len(samples) if samples else 0.0,
+        "fallback_rate": sum(sample.fallback for sample in samples) / len(samples) if samples else 0.0,
+        "status_codes": dict(Counter(sample.status for sample in samples)),
+    }
+
+
+def chat_request(model: str) -> dict:
+    request: dict = {"model": model}
+    if random.random() < COURSE_SHARE:
+        request["course_id"] = COURSE_ID
+        question = random.choice(COURSE_QUESTIONS)
+    else:
+        question = random.choice(QUESTIONS)
+    messages = [{"role": "user", "content": question}]
+    if random.random() < FOLLOW_UP_SHARE:
+        messages = [
+            {"role": "user", "content": random.choice(QUESTIONS)},
+            {"role": "assistant", "content": "Der KI-Campus bietet kostenlose Online-Kurse an."},
+            *messages,
+        ]
+    request["messages"] = messages
+    return request
+
+
+async def client(http: httpx.AsyncClient, model: str, deadline: float, samples: list[Sample]) -> None:
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await http.post("/api/chat", json=chat_request(model))
+            fallback = "fallback" in response.headers.get("Server-Timing", "")
+            samples.append(Sample(time.perf_counter() - start, response.status_code, fallback))
+        except httpx.HTTPError:
+            samples.append(Sample(time.perf_counter() - start, 0))
+
+
+async def run_scenario(
+    scenario: Scenario, app_url: str, backend_url: str, backend_config: dict, duration: float, concurrency: int
+) -> dict:
+    async with httpx.AsyncClient(base_url=backend_url) as backend:
+        (await backend.post("/admin/config", json={**backend_config, **scenario.backend_config})).raise_for_status()
+
+    samples: list[Sample] = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=app_url, headers={"Api-Key": API_KEY}, timeout=REQUEST_TIMEOUT, limits=limits
+    ) as http:
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(client(http, scenario.model, deadline, samples) for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+    return summarize(scenario, samples, seconds)
+
+
+def wait_until_ready(process: subprocess.Popen, url: str) -> None:
+    start = time.perf_counter()
+    while time.perf_counter() - start < STARTUP_TIMEOUT:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} not ready within {STARTUP_TIMEOUT} seconds")
+
+
+def start_process(module: str, *args: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", module, *args], env={**os.environ, "PYTHONPATH": os.getcwd()}, stdout=subprocess.DEVNULL
+    )
+
+
+def print_report(summaries: list[dict]) -> None:
+    def milliseconds(seconds: float | None) -> str:
+        return f"{seconds * 1000:8.0f}" if seconds is not None else f"{'-':>8}"
+
+    print(
+        f"\n{'scenario':<24}{'requests':>9}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'errors':>8}{'fallback':>10}"
+    )
+    for summary in summaries:
+        print(
+            f"{summary['scenario']:<24}{summary['requests']:>9}{summary['rps']:>8.2f}"
+            f"{milliseconds(summary['p50']):>9}{milliseconds(summary['p95']):>9}{milliseconds(summary['p99']):>9}"
+            f"{summary['error_rate']:>8.1%}{summary['fallback_rate']:>10.1%}"
+        )
+        if set(summary["status_codes"]) - {200}:
+            print(f"{'':<24}status codes: {summary['status_codes']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30, help="seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds until the fake LLM sends the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="token rate of the fake LLM")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of failing fake LLM calls")
+    parser.add_argument("--semantic-cache", default="off", choices=["memory", "off"])
+    parser.add_argument("--only", nargs="*", choices=[scenario.name for scenario in SCENARIOS], help="scenarios to run")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    backend_port, app_port = free_port(), free_port()
+    backend_url, app_url = f"http://127.0.0.1:{backend_port}", f"http://127.0.0.1:{app_port}"
+    backend_config = {
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+        "error_rate": args.error_rate,
+        "gwdg_latency": None,
+    }
+
+    processes = [start_process("src.benchmarks.loadtest.fake_backends", "--port", str(backend_port))]
+    try:
+        wait_until_ready(processes[0], f"{backend_url}/admin/stats")
+        processes.append(
+            start_process(
+                "src.benchmarks.loadtest.app_server",
+                "--port",
+                str(app_port),
+                "--backend-url",
+                backend_url,
+                "--semantic-cache",
+                args.semantic_cache,
+            )
+        )
+        wait_until_ready(processes[1], f"{app_url}/ready")
+
+        summaries = []
+        for scenario in SCENARIOS:
+            if args.only and scenario.name not in args.only:
+                continue
+            print(f"Running {scenario.name} for {args.duration:.0f} s with {args.concurrency} clients")
+            summaries.append(
+                asyncio.run(
+                    run_scenario(scenario, app_url, backend_url, backend_config, args.duration, args.concurrency)
+                )
+            )
+        backend_requests = httpx.get(f"{backend_url}/admin/stats").json()["requests"]
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    print_report(summaries)
+    print(f"\nrequests per fake backend: {backend_requests}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {"scenarios": summaries, "backend_requests": backend_requests, "config": vars(args)}, file, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Evaluation of the standalone question classifier on the labelled follow-up questions in src/tests/data.
+
+Compares the accuracy and the latency of the decision whether a follow-up question has to be contextualized:
+
+- llm: the contextualizer LLM call for every follow-up question, as without the classifier
+- cues: only the wording of the question, inconclusive questions are contextualized
+- cues+embeddings: inconclusive questions are decided by the similarity to the previous question
+
+A false skip (a question that needs context is not contextualized) can lead to wrong sources, a false rewrite only
+costs the LLM call. The llm and cues+embeddings modes need the Azure OpenAI settings (see .env):
+
+    python -m src.benchmarks.standalone_classifier --modes cues cues+embeddings llm --model GPT-4
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from pathlib import Path
+
+from llama_index.core.llms import ChatMessage
+
+from src.llm.LLMs import Models
+from src.llm.tools.standalone_classifier import StandaloneQuestionClassifier
+
+EVALUATION_SET = Path(__file__).parents[1] / "tests" / "data" / "standalone_questions.json"
+MODES = ["cues", "cues+embeddings", "llm"]
+
+
+def load_examples(path: Path = EVALUATION_SET) -> list[dict]:
+    with open(path) as file:
+        examples = json.load(file)
+    for example in examples:
+        example["chat_history"] = [ChatMessage(**message) for message in example["chat_history"]]
+    return examples
+
+
+async def decide(mode: str, example: dict, classifier: StandaloneQuestionClassifier, model: Models) -> bool:
+    match mode:
+        case "cues":
+            return classifier.needs_context(example["query"], example["chat_history"])
+        case "cues+embeddings":
+            return await classifier.aneeds_context(example["query"], example["chat_history"])
+        case "llm":
+            from src.llm.tools.contextualizer import Contextualizer
+
+            await Contextualizer().acontextualize(example["query"], example["chat_history"], model)
+            return True
+    raise ValueError(f"Unknown mode '{mode}'")
+
+
+async def evaluate(mode: str, examples: list[dict], threshold: float, model: Models) -> dict:
+    classifier = StandaloneQuestionClassifier(threshold=threshold)
+    confusion = {"true_rewrite": 0, "false_rewrite": 0, "true_skip": 0, "false_skip": 0}
+    seconds = []
+    false_skips = []
+    for example in examples:
+        start = time.perf_counter()
+        needs_context = await decide(mode, example, classifier, model)
+        seconds.append(time.perf_counter() - start)
+        outcome = ("true_" if needs_context == example["needs_context"] else "false_") + (
+            "rewrite" if needs_context else "skip"
+        )
+        confusion[outcome] += 1
+        if outcome == "false_skip":
+            false_skips.append(example["query"])
+
+    follow_ups = sum(example["needs_context"] for example in examples)
+    return {
+        "mode": mode,
+        "examples": len(examples),
+        "accuracy": (confusion["true_rewrite"] + confusion["true_skip"]) / len(examples),
+        # share of questions that needed context but were not contextualized
+        "false_skip_rate": confusion["false_skip"] / follow_ups if follow_ups else 0.0,
+        # share of LLM calls that are saved
+        "skip_rate": (confusion["true_skip"] + confusion["false_skip"]) / len(examples),
+        "mean_ms": statistics.mean(seconds) * 1000,
+        "p95_ms": sorted(seconds)[int(0.95 * (len(seconds) - 1))] * 1000,
+        "confusion": confusion,
+        "false_skips": false_skips,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="*", choices=MODES, default=["cues"])
+    parser.add_argument("--threshold", type=float, default=0.85, help="similarity threshold for cues+embeddings")
+    parser.add_argument("--model", type=Models, default=Models.GPT4, help="model of the contextualizer in llm mode")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    examples = load_examples()
+    results = [asyncio.run(evaluate(mode, examples, args.threshold, args.model)) for mode in args.modes]
+
+    print(f"\n{'mode':<18}{'accuracy':>9}{'false skips':>12}{'skip rate':>10}{'mean ms':>9}{'p95 ms':>9}")
+    for result in results:
+        print(
+            f"{result['mode']:<18}{result['accuracy']:>9.1%}{result['false_skip_rate']:>12.1%}"
+            f"{result['skip_rate']:>10.1%}{result['mean_ms']:>9.1f}{result['p95_ms']:>9.1f}"
+        )
+        for query in result["false_skips"]:
+            print(f"{'':<18}false skip: {query}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Startup benchmark for the entry points of the project.
+
+For every entry point the import is profiled with `python -X importtime` in a fresh interpreter, and for the servers
+the time from process start until the first successful request is measured. Each measurement is repeated and the
+median is reported, the slowest imported packages are listed to find candidates for lazy imports.
+
+Run from the project root, with all environment variables set (see .env) so that no key vault lookups distort the
+result:
+
+    python -m src.benchmarks.startup --repeat 5 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+
+STARTUP_TIMEOUT = 180  # in seconds
+POLL_INTERVAL = 0.05  # in seconds
+
+
+@dataclass
+class EntryPoint:
+    name: str
+    module: str
+    # command to start the server, "{port}" is replaced by a free port
+    server_command: list[str] | None = None
+    # path that answers with 200 when the server is able to serve requests
+    ready_path: str | None = None
+
+
+ENTRY_POINTS = [
+    EntryPoint(
+        name="rest",
+        module="src.api.rest",
+        server_command=[sys.executable, "-m", "uvicorn", "src.api.rest:app", "--port", "{port}"],
+        # /ready instead of /health, because the chat components are built on startup
+        ready_path="/ready",
+    ),
+    EntryPoint(
+        name="frontend",
+        module="src.frontend.frontend",
+        server_command=[
+            sys.executable,
+            "-m",
+            "streamlit",
+            "run",
+            "src/frontend/frontend.py",
+            "--server.headless=true",
+            "--server.port={port}",
+        ],
+        ready_path="/_stcore/health",
+    ),
+    # The Azure Functions host only has to import the module to index the timer trigger
+    EntryPoint(name="function_app", module="src.loaders.function_app"),
+]
+
+
+@dataclass
+class Result:
+    name: str
+    import_seconds: list[float] = field(default_factory=list)
+    first_request_seconds: list[float] = field(default_factory=list)
+    slowest_packages: list[tuple[str, float]] = field(default_factory=list)
+    error: str | None = None
+
+    def summary(self) -> dict:
+        return {
+            "name": self.name,
+            "import_seconds": statistics.median(self.import_seconds) if self.import_seconds else None,
+            "first_request_seconds": (
+                statistics.median(self.first_request_seconds) if self.first_request_seconds else None
+            ),
+            "slowest_packages": self.slowest_packages,
+            "error": self.error,
+            "runs": asdict(self),
+        }
+
+
+def profile_import(module: str) -> tuple[float, dict[str, float]]:
+    """Import the module in a fresh interpreter and return the total import time and the self time per package."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "import failed")
+
+    self_time_per_package: dict[str, float] = defaultdict(float)
+    total_microseconds = 0
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line.removeprefix("import time:").split("|")
+        self_time_per_package[name.strip().split(".")[0]] += int(self_time) / 1e6
+        if name.strip() == module:
+            total_microseconds = int(cumulative)
+    return total_microseconds / 1e6, self_time_per_package
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_request(entry_point: EntryPoint) -> float:
+    """Start the server and return the seconds until it answered the ready path successfully."""
+    assert entry_point.server_command is not None and entry_point.ready_path is not None
+    port = free_port()
+    command = [part.replace("{port}", str(port)) for part in entry_point.server_command]
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env={**os.environ, "PYTHONPATH": os.getcwd()}
+    )
+    try:
+        while time.perf_counter() - start < STARTUP_TIMEOUT:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with code {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{entry_point.ready_path}", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(POLL_INTERVAL)
+        raise TimeoutError(f"no successful request within {STARTUP_TIMEOUT} seconds")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(entry_point: EntryPoint, repeat: int, top: int) -> Result:
+    result = Result(name=entry_point.name)
+    package_times: dict[str, list[float]] = defaultdict(list)
+    try:
+        for _ in range(repeat):
+            seconds, self_times = profile_import(entry_point.module)
+            result.import_seconds.append(seconds)
+            for package, package_seconds in self_times.items():
+                package_times[package].append(package_seconds)
+            if entry_point.server_command is not None:
+                result.first_request_seconds.append(time_to_first_request(entry_point))
+    except Exception as e:
+        result.error = str(e)
+
+    medians = {package: statistics.median(times) for package, times in package_times.items()}
+    result.slowest_packages = sorted(medians.items(), key=lambda item: item[1], reverse=True)[:top]
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per entry point")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest packages to list")
+    parser.add_argument(
+        "--only", nargs="*", choices=[entry_point.name for entry_point in ENTRY_POINTS], help="entry points to run"
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    summaries = []
+    for entry_point in ENTRY_POINTS:
+        if args.only and entry_point.name not in args.only:
+            continue
+        summary = run(entry_point, args.repeat, args.top).summary()
+        summaries.append(summary)
+
+        print(f"\n{summary['name']}")
+        if summary["error"]:
+            print(f"  failed: {summary['error']}")
+        if summary["import_seconds"] is not None:
+            print(f"  import:             {summary['import_seconds'] * 1000:8.0f} ms")
+        if summary["first_request_seconds"] is not None:
+            print(f"  first request:      {summary['first_request_seconds'] * 1000:8.0f} ms")
+        for package, seconds in summary["slowest_packages"]:
+            print(f"    {package:<30} {seconds * 1000:8.0f} ms")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summaries, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
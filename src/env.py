@@ -1,13 +1,155 @@
 import json
 import logging
 import os
-from typing import Any
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
 
-from azure.core.exceptions import ResourceNotFoundError
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
 from dotenv import find_dotenv, load_dotenv
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, PrivateAttr, ValidationInfo, field_validator
+
+if TYPE_CHECKING:
+    from azure.keyvault.secrets import SecretClient
+
+
+# Variables that are named DATA_SOURCE_STAGING_... or DATA_SOURCE_PRODUCTION_... in the environment and key vault
+ENVIRONMENT_ALIASES = ["DATA_SOURCE_MOODLE_URL", "DATA_SOURCE_MOODLE_TOKEN"]
+MAX_PARALLEL_SECRET_FETCHES = 16
+# Tuning settings that are not kept in the key vault, they are set in the environment or use their default
+ENV_ONLY_VARIABLES = [
+    "SEMANTIC_CACHE_BACKEND",
+    "SEMANTIC_CACHE_THRESHOLD",
+    "SEMANTIC_CACHE_TTL",
+    "CONTEXTUALIZATION_CACHE_BACKEND",
+    "CONTEXTUALIZATION_CACHE_PATH",
+    "CONTEXTUALIZATION_CACHE_TTL",
+    "SPECULATIVE_RETRIEVAL",
+    "SPECULATIVE_RETRIEVAL_THRESHOLD",
+    "STANDALONE_CLASSIFIER",
+    "STANDALONE_CLASSIFIER_THRESHOLD",
+    "CHAT_HISTORY_TOKEN_BUDGETS",
+    "SOURCE_TOKEN_BUDGETS",
+    "CHAT_HISTORY_SUMMARY",
+    "LLM_CONCURRENCY_LIMITS",
+    "LLM_QUEUE_SIZE",
+    "LLM_QUEUE_TIMEOUT",
+    "LLM_FIRST_TOKEN_TIMEOUTS",
+    "LLM_STALL_TIMEOUTS",
+    "LLM_HEDGING",
+    "LLM_HEDGE_BUDGETS",
+    "LLM_POOL_MAX_CONNECTIONS",
+    "LLM_POOL_MAX_KEEPALIVE",
+    "LLM_POOL_KEEPALIVE_EXPIRY",
+    "CIRCUIT_BREAKER_STATE_PATH",
+    "CIRCUIT_BREAKER_ERROR_RATE",
+    "CIRCUIT_BREAKER_P95_FIRST_TOKEN_SECONDS",
+    "CIRCUIT_BREAKER_MIN_CALLS",
+    "CIRCUIT_BREAKER_OPEN_SECONDS",
+    "FEEDBACK_SPOOL_PATH",
+]
+
+
+class SecretResolver:
+    """Fetches secrets from the Azure Key Vault concurrently, the client is created on first use.
+
+    If ENV_CACHE_PATH and ENV_CACHE_KEY (a Fernet key, see cryptography.fernet.Fernet.generate_key) are set, fetched
+    secrets are stored encrypted in that file and reused for ENV_CACHE_TTL seconds (default 1 hour). This avoids
+    fetching all secrets again when a container or worker process restarts.
+
+    With KEY_VAULT_DISABLED=true nothing is fetched and only the environment and the defaults are used, e.g. for
+    offline load tests."""
+
+    def __init__(self, key_vault_uri: str) -> None:
+        self.key_vault_uri = key_vault_uri
+        self.lock = threading.RLock()
+        self._secret_client: "SecretClient | None" = None
+        self._futures: dict[str, Future] = {}
+
+        self.cache_path = os.environ.get("ENV_CACHE_PATH")
+        self.cache_key = os.environ.get("ENV_CACHE_KEY")
+        self.cache_ttl = int(os.environ.get("ENV_CACHE_TTL", 60 * 60))
+        self._cached: dict[str, str | None] | None = None
+        self.disabled = os.environ.get("KEY_VAULT_DISABLED", "false").lower() == "true"
+
+    @property
+    def secret_client(self) -> "SecretClient":
+        if self._secret_client is None:
+            from azure.identity import DefaultAzureCredential
+            from azure.keyvault.secrets import SecretClient
+
+            self._secret_client = SecretClient(vault_url=self.key_vault_uri, credential=DefaultAzureCredential())
+        return self._secret_client
+
+    def fetch(self, name: str) -> str | None:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            # Azure Key Vault does not allow underscores in the key name but hyphens
+            return self.secret_client.get_secret(name.replace("_", "-")).value
+        except ResourceNotFoundError:
+            return None
+
+    def prefetch(self, names: list[str], write_cache: bool = False) -> None:
+        """Start fetching the secrets that are neither fetched nor cached yet. With write_cache, the cache file is
+        written once these fetches finished, which is done for the prefetch of all variables at startup."""
+        with self.lock:
+            if self._cached is None:
+                self._cached = self._read_cache()
+            fetched = []
+            executor = None
+            for name in names:
+                if name in self._futures:
+                    continue
+                if name in self._cached or self.disabled:
+                    self._futures[name] = Future()
+                    self._futures[name].set_result(self._cached.get(name))
+                    continue
+                if executor is None:
+                    executor = ThreadPoolExecutor(MAX_PARALLEL_SECRET_FETCHES, thread_name_prefix="key-vault")
+                self._futures[name] = executor.submit(self.fetch, name)
+                fetched.append(name)
+            if executor is not None:
+                executor.shutdown(wait=False)
+                if write_cache and self.cache_path and self.cache_key:
+                    threading.Thread(target=self._write_cache, args=(fetched,), daemon=True).start()
+
+    def get(self, name: str) -> str | None:
+        if name not in self._futures:
+            self.prefetch([name])
+        return self._futures[name].result()
+
+    def _read_cache(self) -> dict[str, str | None]:
+        if not (self.cache_path and self.cache_key and os.path.exists(self.cache_path)):
+            return {}
+        from cryptography.fernet import Fernet, InvalidToken
+
+        try:
+            with open(self.cache_path, "rb") as file:
+                content = json.loads(Fernet(self.cache_key).decrypt(file.read(), ttl=self.cache_ttl))
+        except (InvalidToken, OSError, ValueError):
+            logging.info("Secret cache is expired or invalid, fetching secrets from the key vault.")
+            return {}
+        return content["secrets"] if content.get("key_vault_uri") == self.key_vault_uri else {}
+
+    def _write_cache(self, names: list[str]) -> None:
+        from cryptography.fernet import Fernet
+
+        for name in names:
+            # wait until the fetches finished, failed fetches are raised on attribute access and not cached
+            self._futures[name].exception()
+        secrets = {
+            name: future.result()
+            for name, future in list(self._futures.items())
+            if future.done() and future.exception() is None
+        }
+        content = json.dumps({"key_vault_uri": self.key_vault_uri, "secrets": secrets}).encode()
+        temporary_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+                file.write(Fernet(self.cache_key).encrypt(content))
+            os.replace(temporary_path, self.cache_path)
+        except OSError:
+            logging.exception("Writing the secret cache failed.")
 
 
 class EnvHelper(BaseModel):
@@ -59,12 +201,134 @@ class EnvHelper(BaseModel):
 
     VIMEO_PAT: str = "UNSET"
 
+    SEMANTIC_CACHE_BACKEND: str = Field(default="memory", description="'memory', 'qdrant' or 'off'")
+    SEMANTIC_CACHE_THRESHOLD: float = Field(
+        default=0.97, description="Minimum cosine similarity of two queries to reuse the cached answer"
+    )
+    SEMANTIC_CACHE_TTL: int = Field(default=60 * 60 * 24 * 7, description="Maximum age of a cached answer in seconds")
+
+    CONTEXTUALIZATION_CACHE_BACKEND: str = Field(
+        default="memory", description="'memory', 'sqlite' (shared by the workers of a host) or 'off'"
+    )
+    CONTEXTUALIZATION_CACHE_PATH: str = Field(
+        default="/tmp/contextualization_cache.sqlite3", description="SQLite file of the contextualization cache"
+    )
+    CONTEXTUALIZATION_CACHE_TTL: int = Field(
+        default=60 * 60 * 24, description="Maximum age of a cached contextualized query in seconds"
+    )
+
+    SPECULATIVE_RETRIEVAL: bool = Field(
+        default=True, description="Retrieve the sources for the raw query while a follow-up question is contextualized"
+    )
+    SPECULATIVE_RETRIEVAL_THRESHOLD: float = Field(
+        default=0.95,
+        description="Minimum cosine similarity of the raw and contextualized query to keep the speculative sources",
+    )
+    STANDALONE_CLASSIFIER: bool = Field(
+        default=False,
+        description="Skip the contextualizer for follow-up questions that are self-contained. Off until the "
+        "cues+embeddings mode of src/benchmarks/standalone_classifier.py, which the API uses, was evaluated",
+    )
+    STANDALONE_CLASSIFIER_THRESHOLD: float = Field(
+        default=0.85,
+        description="Minimum cosine similarity to the previous question for a vague question to be contextualized",
+    )
+    CHAT_HISTORY_TOKEN_BUDGETS: dict[str, int] = Field(
+        default={"GPT-4": 3000, "Mistral8": 2000, "Llama3": 1500, "Qwen2": 1500},
+        description="Maximum chat history tokens per model including the summary of older turns, as JSON object",
+    )
+    SOURCE_TOKEN_BUDGETS: dict[str, int] = Field(
+        default={"GPT-4": 6000, "Mistral8": 2600, "Llama3": 2100, "Qwen2": 2200},
+        description="Maximum tokens of the retrieved sources in the prompt per model, as JSON object",
+    )
+    CHAT_HISTORY_SUMMARY: bool = Field(
+        default=True, description="Fold the turns beyond the token budget into a summary instead of dropping them"
+    )
+
+    LLM_CONCURRENCY_LIMITS: dict[str, int] = Field(
+        default={"GPT-4": 32, "Mistral8": 16, "Llama3": 8, "Qwen2": 8},
+        description="Maximum number of concurrent chats per model and worker, as JSON object",
+    )
+    LLM_QUEUE_SIZE: int = Field(default=64, description="Maximum number of chats waiting for a model per worker")
+    LLM_QUEUE_TIMEOUT: float = Field(default=10, description="Maximum time in seconds a chat waits for a model")
+    LLM_FIRST_TOKEN_TIMEOUTS: dict[str, float] = Field(
+        default={"Mistral8": 4, "Llama3": 4, "Qwen2": 4},
+        description="Maximum time in seconds until the first token of a model before falling back, as JSON object",
+    )
+    LLM_STALL_TIMEOUTS: dict[str, float] = Field(
+        default={"Mistral8": 2, "Llama3": 2, "Qwen2": 2},
+        description="Maximum time in seconds between two tokens of a model before falling back, as JSON object",
+    )
+    LLM_HEDGING: bool = Field(
+        default=False, description="Send slow GWDG and Mistral calls to GPT-4 as well and use the first answer"
+    )
+    LLM_HEDGE_BUDGETS: dict[str, float] = Field(
+        default={"Mistral8": 0.1, "Llama3": 0.1, "Qwen2": 0.1},
+        description="Maximum share of the calls per model that are also sent to GPT-4, as JSON object",
+    )
+    LLM_POOL_MAX_CONNECTIONS: int = Field(
+        default=64, description="Maximum number of open connections per LLM endpoint, event loop and worker"
+    )
+    LLM_POOL_MAX_KEEPALIVE: int = Field(
+        default=16, description="Maximum number of idle connections kept open per LLM endpoint and event loop"
+    )
+    LLM_POOL_KEEPALIVE_EXPIRY: float = Field(
+        default=120, description="Time in seconds after which an idle connection to an LLM endpoint is closed"
+    )
+    AZURE_OPENAI_GPT4_DEPLOYMENTS: list[dict[str, str]] = Field(
+        default=[],
+        description="Equivalent GPT-4 deployments to route the calls over, as JSON list of objects with url, "
+        "deployment and optionally api_key and name. Empty to only use AZURE_OPENAI_GPT4_DEPLOYMENT",
+    )
+    AZURE_OPENAI_EMBEDDER_DEPLOYMENTS: list[dict[str, str]] = Field(
+        default=[],
+        description="Equivalent embedder deployments to route the calls over, like AZURE_OPENAI_GPT4_DEPLOYMENTS",
+    )
+    CIRCUIT_BREAKER_STATE_PATH: str = Field(
+        default="/tmp/kicwa_circuit_breakers.json",
+        description="File that shares the circuit breaker state between the workers, empty to keep it per worker",
+    )
+    CIRCUIT_BREAKER_ERROR_RATE: float = Field(
+        default=0.5, description="Share of failed calls among the last calls of a backend that opens its breaker"
+    )
+    CIRCUIT_BREAKER_P95_FIRST_TOKEN_SECONDS: float = Field(
+        default=6,
+        description="95th percentile of the time to the first token of the last successful calls of a backend that "
+        "opens its breaker. All calls are streamed, so the length of the answers does not count",
+    )
+    CIRCUIT_BREAKER_MIN_CALLS: int = Field(
+        default=4, description="Minimum number of recent calls before a breaker opens on error rate or latency"
+    )
+    CIRCUIT_BREAKER_OPEN_SECONDS: float = Field(
+        default=60 * 5, description="Time in seconds an open breaker skips its backend before it is probed again"
+    )
+
+    FEEDBACK_SPOOL_PATH: str = Field(
+        default="/tmp/feedback_spool.jsonl", description="File that keeps the feedback while Langfuse is unreachable"
+    )
+
+    _secrets: SecretResolver = PrivateAttr()
+    # variable -> names to look up in the key vault, for variables that were not yet resolved
+    _pending: dict[str, list[str]] = PrivateAttr(default_factory=dict)
+
     @field_validator("ENVIRONMENT")
     def validate_ENVIRONMENT(cls, value: str) -> str:
         if value not in ["STAGING", "PRODUCTION"]:
             raise ValueError("ENVIRONMENT must be LOCAL, STAGING, or PRODUCTION")
         return value
 
+    @field_validator("SEMANTIC_CACHE_BACKEND")
+    def validate_SEMANTIC_CACHE_BACKEND(cls, value: str) -> str:
+        if value not in ["memory", "qdrant", "off"]:
+            raise ValueError("SEMANTIC_CACHE_BACKEND must be memory, qdrant or off")
+        return value
+
+    @field_validator("CONTEXTUALIZATION_CACHE_BACKEND")
+    def validate_CONTEXTUALIZATION_CACHE_BACKEND(cls, value: str) -> str:
+        if value not in ["memory", "sqlite", "off"]:
+            raise ValueError("CONTEXTUALIZATION_CACHE_BACKEND must be memory, sqlite or off")
+        return value
+
     @field_validator("REST_API_KEYS", mode="before")
     def transform_REST_API_KEYS(cls, value: list[str] | str) -> list[str]:
         if type(value) == str:
@@ -74,71 +338,94 @@ class EnvHelper(BaseModel):
             raise ValueError("REST_API_KEYS must be a list of strings.")
         return value
 
-    @staticmethod
-    def append_variable(kwargs: Any, variable_key: str, secret_client: SecretClient, class_variable: str = "") -> Any:
-        """Appends a variable to the kwargs dictionary. If the variable is not set in the environment, it will be fetched from the key vault.
-        Use class_variable to set a different class variable in the kwargs dictionary, than the variable_key name."""
-        kwargs_key = class_variable if class_variable else variable_key
+    @field_validator("AZURE_OPENAI_GPT4_DEPLOYMENTS", "AZURE_OPENAI_EMBEDDER_DEPLOYMENTS", mode="before")
+    def transform_deployments(cls, value: list[dict[str, str]] | str, info: ValidationInfo) -> list[dict[str, str]]:
+        if type(value) == str:
+            value = json.loads(value)
+        if type(value) != list or any(type(entry) != dict or {"url", "deployment"} - entry.keys() for entry in value):
+            raise ValueError(f"{info.field_name} must be a JSON list of objects with url and deployment.")
+        return value
 
-        if os.getenv(variable_key) is not None:
-            kwargs[kwargs_key] = os.getenv(variable_key)
-        else:
-            try:
-                # Azure Key Vault does not allow underscores in the key name but hyphens
-                variable_key = variable_key.replace("_", "-")
-                secret = secret_client.get_secret(variable_key)
-                kwargs[kwargs_key] = secret.value
-            except ResourceNotFoundError:
-                logging.debug(f"Secret {variable_key} not found in the key vault, it will be unset.")
-        # otherwise default value from pydantic model is used
-        return kwargs
+    @field_validator(
+        "LLM_CONCURRENCY_LIMITS",
+        "LLM_FIRST_TOKEN_TIMEOUTS",
+        "LLM_STALL_TIMEOUTS",
+        "LLM_HEDGE_BUDGETS",
+        "CHAT_HISTORY_TOKEN_BUDGETS",
+        "SOURCE_TOKEN_BUDGETS",
+        mode="before",
+    )
+    def transform_model_limits(cls, value: dict[str, float] | str, info: ValidationInfo) -> dict[str, float]:
+        if type(value) == str:
+            value = json.loads(value.replace("'", '"'))
+        if type(value) != dict:
+            raise ValueError(f"{info.field_name} must be a JSON object of model names and limits.")
+        return value
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
-        """Helper class for environment variables. Loads production variables if production=True, or env variable 'ENVIRONMENT' is set to 'PRODUCTION'"""
+        """Helper class for environment variables. Loads production variables if production=True, or env variable 'ENVIRONMENT' is set to 'PRODUCTION'
+
+        Variables that are not set in the environment are fetched from the key vault, except ENV_ONLY_VARIABLES.
+        prefetch() starts fetching all of them concurrently and is called once when the module is imported, a variable
+        that is accessed waits for its own fetch only."""
         if find_dotenv():
             load_dotenv(override=True)
         else:
             logging.warning("No .env file found.")
 
+        pending: dict[str, list[str]] = {}
+        for key in type(self).model_fields.keys():
+            if key in kwargs.keys():
+                continue
+            # Variables with different names per environment are preferred over the general name
+            names = [key]
+            if key in ENVIRONMENT_ALIASES:
+                names.insert(0, key.replace("DATA_SOURCE_", "DATA_SOURCE_{ENVIRONMENT}_"))
+            for name in names:
+                if "{ENVIRONMENT}" in name:
+                    name = name.format(ENVIRONMENT=kwargs.get("ENVIRONMENT", os.getenv("ENVIRONMENT", "STAGING")))
+                if os.getenv(name) is not None:
+                    kwargs[key] = os.getenv(name)
+                    break
+            else:
+                if key not in ENV_ONLY_VARIABLES:
+                    pending[key] = names
+        super().__init__(*args, **kwargs)
+
         # Using Azure Key Vault when secrets are not set through environment variables
         key_vault_name = os.environ.get("KEY_VAULT_NAME", "kicwa-keyvault-prod")
-        key_vault_uri = f"https://{key_vault_name}.vault.azure.net/"
-        credential = DefaultAzureCredential()
-        secret_client = SecretClient(vault_url=key_vault_uri, credential=credential)
-
-        # Environment setup
-        for key in self.model_json_schema()["properties"].keys():
-            if key not in kwargs.keys():
-                self.append_variable(kwargs, variable_key=key, secret_client=secret_client)
-
-        # Variables with different names
-        if kwargs.get("ENVIRONMENT") == "PRODUCTION":
-            self.append_variable(
-                kwargs,
-                variable_key="DATA_SOURCE_PRODUCTION_MOODLE_URL",
-                secret_client=secret_client,
-                class_variable="DATA_SOURCE_MOODLE_URL",
-            )
-            self.append_variable(
-                kwargs,
-                variable_key="DATA_SOURCE_PRODUCTION_MOODLE_TOKEN",
-                secret_client=secret_client,
-                class_variable="DATA_SOURCE_MOODLE_TOKEN",
-            )
-        else:
-            self.append_variable(
-                kwargs,
-                variable_key="DATA_SOURCE_STAGING_MOODLE_URL",
-                secret_client=secret_client,
-                class_variable="DATA_SOURCE_MOODLE_URL",
-            )
-            self.append_variable(
-                kwargs,
-                variable_key="DATA_SOURCE_STAGING_MOODLE_TOKEN",
-                secret_client=secret_client,
-                class_variable="DATA_SOURCE_MOODLE_TOKEN",
-            )
-        super().__init__(*args, **kwargs)
+        self._secrets = SecretResolver(f"https://{key_vault_name}.vault.azure.net/")
+        self._pending = pending
+
+    def _resolve(self, key: str) -> None:
+        with self._secrets.lock:
+            names = self._pending.get(key)
+            if names is None:
+                return
+            if "ENVIRONMENT" in self._pending and key != "ENVIRONMENT":
+                self._resolve("ENVIRONMENT")
+            environment = object.__getattribute__(self, "ENVIRONMENT")
+            names = [name.format(ENVIRONMENT=environment) for name in names]
+            # only the names of this variable are fetched, the environment specific and general name concurrently
+            self._secrets.prefetch(names)
+            for name in names:
+                value = self._secrets.get(name)
+                if value is not None:
+                    self.__pydantic_validator__.validate_assignment(self, key, value)
+                    break
+            else:
+                # otherwise default value from pydantic model is used
+                logging.debug(f"Secret {key} not found in the key vault, it will be unset.")
+            del self._pending[key]
+
+    def prefetch(self) -> None:
+        """Start fetching all variables that are not set in the environment from the key vault concurrently, without
+        waiting for them. The secret cache is written once all of them were fetched."""
+        environment = os.getenv("ENVIRONMENT", "STAGING")
+        if "ENVIRONMENT" not in self._pending:
+            environment = object.__getattribute__(self, "ENVIRONMENT")
+        names = {name.replace("{ENVIRONMENT}", environment) for names in self._pending.values() for name in names}
+        self._secrets.prefetch(sorted(names), write_cache=True)
 
     @staticmethod
     def check_env():
@@ -148,6 +435,8 @@ class EnvHelper(BaseModel):
 
     def __getattribute__(self, name: str):
         """Since not all environment variables are always required or set, this will raise an error if the attribute is not set during runtime."""
+        if name in EnvHelper.model_fields and name in self._pending:
+            self._resolve(name)
         value = object.__getattribute__(self, name)
         if value == "UNSET":
             raise AttributeError(f"{name} is requested but no value was provided.")
@@ -160,6 +449,7 @@ class EnvHelper(BaseModel):
 
 
 env = EnvHelper()
+env.prefetch()
 os.environ["LANGFUSE_PUBLIC_KEY"] = env.LANGFUSE_PUBLIC_KEY
 os.environ["LANGFUSE_SECRET_KEY"] = env.LANGFUSE_SECRET_KEY
 os.environ["LANGFUSE_HOST"] = env.LANGFUSE_HOST
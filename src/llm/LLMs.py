@@ -1,23 +1,42 @@
-import datetime
-import threading
+import asyncio
+import time
 from enum import Enum
+from typing import TYPE_CHECKING, AsyncIterator, Iterator
 
 from langfuse.decorators import langfuse_context, observe
 from llama_index.core import Settings
 from llama_index.core.callbacks import CallbackManager
-from llama_index.core.chat_engine import SimpleChatEngine
+from llama_index.core.constants import DEFAULT_EMBED_BATCH_SIZE
 from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.core.llms.function_calling import FunctionCallingLLM
-from llama_index.core.llms.llm import LLM as llama_llm
-from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from llama_index.llms.azure_inference import AzureAICompletionsModel
-from llama_index.llms.azure_openai import AzureOpenAI
-from llama_index.llms.openai_like import OpenAILike
 
 from src.env import env
+from src.llm.circuit_breaker import CircuitBreaker, Permit, circuit_breakers
+from src.llm.clients import llm_clients
+from src.llm.hedging import first_success, hedger
+from src.llm.routing import deployment_routers
+from src.llm.streaming import (
+    StreamedAnswer,
+    StreamTimeout,
+    acollect,
+    afirst_token,
+    stream_stats,
+)
+from src.llm.timing import mark_fallback
 
+# The model backends are imported when a model is first used, only the selected one is loaded
+if TYPE_CHECKING:
+    from llama_index.core.llms.function_calling import FunctionCallingLLM
+    from llama_index.core.llms.llm import LLM as llama_llm
+    from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
+
+# SDK timeout of the GWDG and Mistral calls, which fall back to GPT-4. The streamed calls of achat and astream_chat
+# fall back earlier, see LLM_FIRST_TOKEN_TIMEOUTS and LLM_STALL_TIMEOUTS
 TIME_TO_WAIT_FOR_GWDG = 7  # in seconds
-TIME_TO_RESET_UNAVAILABLE_STATUS = 60 * 5  # in seconds
+
+# names of the connection pools in src/llm/clients.py and of the circuit breakers
+AZURE_OPENAI_ENDPOINT = "azure_openai"
+AZURE_MISTRAL_ENDPOINT = "azure_mistral"
+GWDG_ENDPOINT = "gwdg"
 
 
 class Models(str, Enum):
@@ -28,33 +47,61 @@ class Models(str, Enum):
 
 
 class LLM:
-    gwdg_unavailable = False
-    gwdg_unavailable_since = None
+    def get_embedder(self, embed_batch_size: int = DEFAULT_EMBED_BATCH_SIZE) -> "AzureOpenAIEmbedding":
+        """embed_batch_size is the number of texts embedded in one request of the batch embedding methods."""
+        return llm_clients.get(f"embedder:{embed_batch_size}", lambda: self._build_embedder(embed_batch_size))
+
+    def _build_embedder(self, embed_batch_size: int) -> "AzureOpenAIEmbedding":
+        from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
 
-    def get_embedder(self) -> AzureOpenAIEmbedding:
+        # with AZURE_OPENAI_EMBEDDER_DEPLOYMENTS the requests are routed over the deployments (see src/llm/routing.py)
+        http_client, async_http_client = llm_clients.http_clients(
+            AZURE_OPENAI_ENDPOINT, deployment_routers.get("embedder")
+        )
         embedder = AzureOpenAIEmbedding(
             model=env.AZURE_OPENAI_EMBEDDER_MODEL,
             deployment_name=env.AZURE_OPENAI_EMBEDDER_DEPLOYMENT,
             api_key=env.AZURE_OPENAI_API_KEY,
             azure_endpoint=env.AZURE_OPENAI_URL,
             api_version="2023-05-15",
+            embed_batch_size=embed_batch_size,
+            http_client=http_client,
+            async_http_client=async_http_client,
         )
         return embedder
 
-    def get_model(self, model: Models) -> FunctionCallingLLM | llama_llm:
+    def get_model(self, model: Models) -> "FunctionCallingLLM | llama_llm":
+        """The pooled model of the worker, as a copy that reports to the callback manager of the current request."""
+        llm = llm_clients.get(f"model:{model.value}", lambda: self._build_model(model))
+        return llm_clients.for_request(llm, Settings.callback_manager)
+
+    def _build_model(self, model: Models) -> "FunctionCallingLLM | llama_llm":
         match model:
             case Models.GPT4:
+                from llama_index.llms.azure_openai import AzureOpenAI
+
+                http_client, async_http_client = llm_clients.http_clients(
+                    AZURE_OPENAI_ENDPOINT, deployment_routers.get("gpt4")
+                )
                 llm = AzureOpenAI(
                     model=env.AZURE_OPENAI_GPT4_MODEL,
                     deployment=env.AZURE_OPENAI_GPT4_DEPLOYMENT,
                     api_key=env.AZURE_OPENAI_API_KEY,
                     azure_endpoint=env.AZURE_OPENAI_URL,
                     api_version="2023-05-15",
-                    callback_manager=Settings.callback_manager,
+                    http_client=http_client,
+                    async_http_client=async_http_client,
                 )
             case Models.MISTRAL8:
+                from llama_index.llms.azure_inference import AzureAICompletionsModel
+
+                # the Azure AI inference client brings its own azure-core transport, only the model object is pooled
                 llm = AzureAICompletionsModel(
-                    credential=env.AZURE_MISTRAL_KEY, endpoint=env.AZURE_MISTRAL_URL, model_name="mistral-large"
+                    credential=env.AZURE_MISTRAL_KEY,
+                    endpoint=env.AZURE_MISTRAL_URL,
+                    model_name="mistral-large",
+                    # a failed call falls back to GPT-4 instead of being retried
+                    client_kwargs={"read_timeout": TIME_TO_WAIT_FOR_GWDG, "retry_total": 0},
                 )
                 # GWDG instruct model for chat currently not working
                 # llm = OpenAILike(
@@ -66,9 +113,11 @@ class LLM:
                 #     api_base=env.GWDG_URL,
                 #     api_version="v1",
                 #     logprobs=None,
-                #     callback_manager=Settings.callback_manager,
                 # )
             case Models.LLAMA3:
+                from llama_index.llms.openai_like import OpenAILike
+
+                http_client, async_http_client = llm_clients.http_clients(GWDG_ENDPOINT)
                 llm = OpenAILike(
                     model="llama-3.3-70b-instruct",
                     is_chat_model=True,
@@ -78,9 +127,15 @@ class LLM:
                     api_base=env.GWDG_URL,
                     api_version="v1",
                     logprobs=None,
-                    callback_manager=Settings.callback_manager,
+                    timeout=TIME_TO_WAIT_FOR_GWDG,
+                    max_retries=0,
+                    http_client=http_client,
+                    async_http_client=async_http_client,
                 )
             case Models.QWEN2:
+                from llama_index.llms.openai_like import OpenAILike
+
+                http_client, async_http_client = llm_clients.http_clients(GWDG_ENDPOINT)
                 llm = OpenAILike(
                     model="qwen2-72b-instruct",
                     is_chat_model=True,
@@ -90,73 +145,230 @@ class LLM:
                     api_base=env.GWDG_URL,
                     api_version="v1",
                     logprobs=None,
-                    callback_manager=Settings.callback_manager,
+                    timeout=TIME_TO_WAIT_FOR_GWDG,
+                    max_retries=0,
+                    http_client=http_client,
+                    async_http_client=async_http_client,
                 )
             case _:
                 raise ValueError(f"Model '{model}' not yet supported")
+        if model != Models.MISTRAL8:
+            # the OpenAI SDK clients are created on first use, creating them now lets all copies of the model share them
+            llm._get_client()
+            llm._get_aclient()
         return llm
 
+    @staticmethod
+    def circuit_breaker(model: Models) -> CircuitBreaker | None:
+        """The breaker of the backend of the model. GPT-4 is the fallback and has none."""
+        match model:
+            case Models.MISTRAL8:
+                return circuit_breakers.get(AZURE_MISTRAL_ENDPOINT)
+            case Models.LLAMA3 | Models.QWEN2:
+                return circuit_breakers.get(GWDG_ENDPOINT)
+        return None
+
+    def select_available_model(self, model: Models) -> tuple[Models, Permit | None]:
+        """Returns GPT-4 instead of the requested model while the circuit breaker of its backend is open, and the
+        permit of the breaker the call has to be recorded with."""
+        breaker = self.circuit_breaker(model)
+        if breaker is None:
+            return model, None
+        permit = breaker.allow()
+        if permit is None:
+            mark_fallback()
+            return Models.GPT4, None
+        return model, permit
+
+    async def aselect_available_model(self, model: Models) -> tuple[Models, Permit | None]:
+        """Async variant of select_available_model, the event loop does not wait for the state file of the breaker."""
+        breaker = self.circuit_breaker(model)
+        if breaker is None:
+            return model, None
+        permit = await breaker.aallow()
+        if permit is None:
+            mark_fallback()
+            return Models.GPT4, None
+        return model, permit
+
     @observe()
     def chat(self, query: str, chat_history: list[ChatMessage], model: Models, system_prompt: str) -> ChatMessage:
+        """The complete answer, streamed internally like stream_chat: a GWDG or Mistral call that fails before its first
+        token, e.g. after the SDK timeout of TIME_TO_WAIT_FOR_GWDG seconds, is reported to the circuit breaker of its
+        backend and answered by GPT-4 instead, at most once. All paths report the time to the first token to the
+        breaker."""
+        answer = "".join(
+            self.stream_chat(query=query, chat_history=chat_history, model=model, system_prompt=system_prompt)
+        )
+        return ChatMessage(content=answer, role=MessageRole.ASSISTANT)
+
+    @observe()
+    def stream_chat(
+        self, query: str, chat_history: list[ChatMessage], model: Models, system_prompt: str
+    ) -> Iterator[str]:
+        """Streams the response token by token. Falls back to GPT-4 if the model fails before the first token."""
         langfuse_handler = langfuse_context.get_current_llama_index_handler()
         Settings.callback_manager = CallbackManager([langfuse_handler])
 
-        if LLM.gwdg_unavailable and LLM.gwdg_unavailable_since:
-            if datetime.datetime.now() - LLM.gwdg_unavailable_since > datetime.timedelta(
-                seconds=TIME_TO_RESET_UNAVAILABLE_STATUS
-            ):
-                LLM.gwdg_unavailable = False
-                LLM.gwdg_unavailable_since = None
+        model, permit = self.select_available_model(model)
+        breaker = self.circuit_breaker(model)
+        messages = [
+            ChatMessage(content=system_prompt, role=MessageRole.SYSTEM),
+            *chat_history,
+            ChatMessage(content=query, role=MessageRole.USER),
+        ]
 
-        # If GWDG is unavailable, use GPT-4 instead
-        if LLM.gwdg_unavailable:
-            model = Models.GPT4
+        start = time.perf_counter()
+        try:
+            stream = self.get_model(model).stream_chat(messages)
+            first_chunk = next(stream, None)
+        except Exception:
+            if breaker is None:
+                raise
+            breaker.record(False, time.perf_counter() - start, permit)
+            mark_fallback()
+            stream = self.get_model(Models.GPT4).stream_chat(messages)
+            first_chunk = next(stream, None)
+        else:
+            if breaker is not None:
+                breaker.record(True, time.perf_counter() - start, permit)
 
-        llm = self.get_model(model)
-        copy_chat_history = (
-            chat_history.copy()
-        )  # creating a copy of the history because the SimpleChatEngine modifies it
-        # Only way of automatic tracing Langfuse is to use such an Engine. Direct calling llama_index models is not traced.
-        chat_engine = SimpleChatEngine.from_defaults(
-            llm=llm, system_prompt=system_prompt, chat_history=copy_chat_history
-        )
+        if first_chunk is None:
+            return
+        if first_chunk.delta:
+            yield first_chunk.delta
+        for chunk in stream:
+            if chunk.delta:
+                yield chunk.delta
 
-        result = [None]  # Use a list to hold the result (mutable object to modify inside threads)
+    async def astreamed_answer(self, model: Models, messages: list[ChatMessage]) -> StreamedAnswer:
+        """The complete answer of the model, streamed internally. A model that does not respond is detected by the
+        time to its first token and the gaps between its tokens, instead of by the length of its answer."""
+        try:
+            answer = await acollect(
+                lambda: self.get_model(model).astream_chat(messages),
+                first_token_timeout=env.LLM_FIRST_TOKEN_TIMEOUTS.get(model.value),
+                stall_timeout=env.LLM_STALL_TIMEOUTS.get(model.value),
+            )
+        except StreamTimeout as e:
+            stream_stats.record_timeout(model.value, e.first_token)
+            raise
+        stream_stats.record(model.value, answer)
+        return answer
 
-        def target():
-            try:
-                result.append(chat_engine.chat(message=query))  # Execute the chat function
-            except Exception as e:
-                result.append(e)  # If error, store the exception in the result
+    @observe()
+    async def achat(
+        self, query: str, chat_history: list[ChatMessage], model: Models, system_prompt: str
+    ) -> ChatMessage:
+        """Async variant of chat. The answer is streamed internally (see astreamed_answer), a GWDG or Mistral call that
+        exceeds LLM_FIRST_TOKEN_TIMEOUTS or LLM_STALL_TIMEOUTS falls back to GPT-4.
 
-        thread = threading.Thread(target=target)
-        thread.start()
-        thread.join(timeout=TIME_TO_WAIT_FOR_GWDG)
+        With LLM_HEDGING, a GWDG or Mistral call that is slower than usual is sent to GPT-4 as well (see
+        src/llm/hedging.py). The first answer is used and the other call is cancelled, GPT-4 is still called at most
+        once."""
+        langfuse_handler = langfuse_context.get_current_llama_index_handler()
+        Settings.callback_manager = CallbackManager([langfuse_handler])
 
-        if thread.is_alive() or isinstance(result[-1], Exception):
-            LLM.gwdg_unavailable = True
-            LLM.gwdg_unavailable_since = datetime.datetime.now()
-            llm = self.get_model(Models.GPT4)
-            chat_engine = SimpleChatEngine.from_defaults(
-                llm=llm, system_prompt=system_prompt, chat_history=copy_chat_history
-            )
-            response = chat_engine.chat(message=query)
+        model, permit = await self.aselect_available_model(model)
+        breaker = self.circuit_breaker(model)
+        messages = [
+            ChatMessage(content=system_prompt, role=MessageRole.SYSTEM),
+            *chat_history,
+            ChatMessage(content=query, role=MessageRole.USER),
+        ]
+
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(self.astreamed_answer(model, messages))
+        hedge = None
+        try:
+            if breaker is not None and env.LLM_HEDGING:
+                hedge = await hedger.ahedge(model.value, primary, lambda: self.astreamed_answer(Models.GPT4, messages))
+            winner = await first_success([primary] if hedge is None else [primary, hedge])
+            answer = winner.result()
+        except Exception:
+            if breaker is None:
+                raise
+            await breaker.arecord(False, time.perf_counter() - start, permit)
+            # a hedged call already was the fallback
+            if hedge is not None:
+                raise
+            mark_fallback()
+            answer = await self.astreamed_answer(Models.GPT4, messages)
         else:
-            response = result[-1]
+            if winner is hedge:
+                mark_fallback()
+                hedger.record_fallback_win(model.value)
+                seconds = time.perf_counter() - start
+                # The primary call failed before the hedge answered, or it is cancelled without an answer. Both count
+                # as failed calls, so a probe of a stuck backend does not close its breaker. A cancelled call would
+                # have taken longer, which keeps a slow backend visible to the hedge delay.
+                if breaker is not None:
+                    await breaker.arecord(False, seconds, permit)
+                if not (primary.done() and not primary.cancelled() and primary.exception() is not None):
+                    hedger.record(model.value, seconds)
+            elif breaker is not None:
+                # the breaker judges the responsiveness of the backend, the hedge delay the complete answer
+                await breaker.arecord(True, answer.time_to_first_token, permit)
+                hedger.record(model.value, answer.seconds)
+        finally:
+            primary.cancel()
+            # a probe that was cancelled by the hedge or the client does not keep the breaker half-open
+            if breaker is not None:
+                await breaker.arelease(permit)
+
+        return ChatMessage(content=answer.text, role=MessageRole.ASSISTANT)
+
+    @observe()
+    async def astream_chat(
+        self, query: str, chat_history: list[ChatMessage], model: Models, system_prompt: str
+    ) -> AsyncIterator[str]:
+        """Async variant of stream_chat. A GWDG or Mistral call without a token after LLM_FIRST_TOKEN_TIMEOUTS falls
+        back to GPT-4."""
+        langfuse_handler = langfuse_context.get_current_llama_index_handler()
+        Settings.callback_manager = CallbackManager([langfuse_handler])
 
-        if isinstance(result[-1], Exception) or result[-1] is None:
-            self.gwdg_unavailable = True
-            llm = self.get_model(Models.GPT4)
-            chat_engine = SimpleChatEngine.from_defaults(
-                llm=llm, system_prompt=system_prompt, chat_history=copy_chat_history
+        model, permit = await self.aselect_available_model(model)
+        breaker = self.circuit_breaker(model)
+        messages = [
+            ChatMessage(content=system_prompt, role=MessageRole.SYSTEM),
+            *chat_history,
+            ChatMessage(content=query, role=MessageRole.USER),
+        ]
+
+        start = time.perf_counter()
+        try:
+            stream, first_chunk = await afirst_token(
+                lambda: self.get_model(model).astream_chat(messages), env.LLM_FIRST_TOKEN_TIMEOUTS.get(model.value)
             )
-            response = chat_engine.chat(message=query)
+        except Exception as e:
+            if isinstance(e, StreamTimeout):
+                stream_stats.record_timeout(model.value, first_token=True)
+            if breaker is None:
+                raise
+            await breaker.arecord(False, time.perf_counter() - start, permit)
+            mark_fallback()
+            model = Models.GPT4
+            start = time.perf_counter()
+            stream, first_chunk = await afirst_token(lambda: self.get_model(Models.GPT4).astream_chat(messages), None)
         else:
-            response = result[-1]
+            if breaker is not None:
+                await breaker.arecord(True, time.perf_counter() - start, permit)
+        finally:
+            # the client went away before the first token
+            if breaker is not None:
+                await breaker.arelease(permit)
 
-        if type(response.response) is not str:
-            raise ValueError(f"Response is not a string. Please check the LLM implementation. Response: {response}")
-        return ChatMessage(content=response.response, role=MessageRole.ASSISTANT)
+        if first_chunk is None:
+            return
+        time_to_first_token = time.perf_counter() - start
+        chunks = 1
+        yield first_chunk.delta
+        async for chunk in stream:
+            if chunk.delta:
+                chunks += 1
+                yield chunk.delta
+        # the time the caller spent between two tokens counts as well, it is short for the SSE responses
+        stream_stats.record(model.value, StreamedAnswer("", time_to_first_token, time.perf_counter() - start, chunks))
 
 
 if __name__ == "__main__":
@@ -1,53 +1,221 @@
+import logging
+from functools import partial
+from typing import AsyncIterator, Iterator
+
 from langfuse.decorators import observe
-from llama_index.core.llms import ChatMessage
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.schema import TextNode
 
+from src.env import env
+from src.llm.contextualization_cache import ContextualizationCache
 from src.llm.LLMs import Models
 from src.llm.parser.citation_parser import CitationParser
 from src.llm.retriever import KiCampusRetriever
+from src.llm.semantic_cache import SemanticCache
+from src.llm.source_packing import SourcePacker
+from src.llm.speculative_retrieval import SpeculativeResult, SpeculativeRetrieval
+from src.llm.stages import StageGraph
+from src.llm.timing import (
+    CONTEXTUALIZE,
+    EMBED,
+    LANGUAGE_DETECTION,
+    SEMANTIC_CACHE,
+    SPECULATIVE_RETRIEVAL,
+    VECTOR_SEARCH,
+)
 from src.llm.tools.contextualizer import Contextualizer
+from src.llm.tools.history_summarizer import ChatHistorySummarizer
 from src.llm.tools.language_detector import LanguageDetector
-from src.llm.tools.question_answerer import QuestionAnswerer
+from src.llm.tools.question_answerer import QuestionAnswerer, is_answer_found
+from src.llm.tools.standalone_classifier import StandaloneQuestionClassifier
+from src.vectordb.qdrant import VectorDBQdrant
+
+# stage of the sync pipeline, which embeds the query and searches the vector database in one call
+RETRIEVE = "retrieve"
+
+logger = logging.getLogger("api")
 
 
 class KICampusAssistant:
-    def __init__(self):
-        self.retriever = KiCampusRetriever()
+    def __init__(
+        self,
+        vector_db: VectorDBQdrant | None = None,
+        semantic_cache: SemanticCache | None = None,
+        language_detector: LanguageDetector | None = None,
+        speculative_retrieval: SpeculativeRetrieval | None = None,
+        standalone_classifier: StandaloneQuestionClassifier | None = None,
+        contextualization_cache: ContextualizationCache | None = None,
+        history_summarizer: ChatHistorySummarizer | None = None,
+        source_packer: SourcePacker | None = None,
+    ):
+        self.retriever = KiCampusRetriever(vector_db=vector_db)
+        self.semantic_cache = semantic_cache
+        self.speculative_retrieval = speculative_retrieval
 
-        self.contextualizer = Contextualizer()
+        self.contextualizer = Contextualizer(classifier=standalone_classifier, cache=contextualization_cache)
         self.question_answerer = QuestionAnswerer()
         self.output_formatter = CitationParser()
-        self.language_detector = LanguageDetector()
+        self.language_detector = language_detector if language_detector is not None else LanguageDetector()
+        self.history_summarizer = (
+            history_summarizer
+            if history_summarizer is not None
+            else ChatHistorySummarizer(token_budgets=env.CHAT_HISTORY_TOKEN_BUDGETS)
+        )
+        self.source_packer = (
+            source_packer if source_packer is not None else SourcePacker(token_budgets=env.SOURCE_TOKEN_BUDGETS)
+        )
 
-    @observe()
-    def limit_chat_history(self, chat_history: list[ChatMessage], limit: int) -> list[ChatMessage]:
-        if len(chat_history) > limit:
-            chat_history = chat_history[-limit:]
-        return chat_history
+    async def _alookup_cache(
+        self, embedding: list[float], course_id: int | None, module_id: int | None, model: Models, language: str
+    ) -> str | None:
+        if self.semantic_cache is None:
+            return None
+        return await self.semantic_cache.lookup(embedding, course_id, module_id, model.value, language)
+
+    async def _astore_in_cache(
+        self,
+        embedding: list[float],
+        course_id: int | None,
+        module_id: int | None,
+        model: Models,
+        language: str,
+        answer: str,
+    ) -> None:
+        if self.semantic_cache is None or not is_answer_found(answer):
+            return
+        await self.semantic_cache.store(embedding, course_id, module_id, model.value, language, answer)
+
+    def _retrieve(
+        self,
+        query: str,
+        chat_history: list[ChatMessage],
+        model: Models,
+        course_id: int | None = None,
+        module_id: int | None = None,
+    ) -> tuple[list[TextNode], str]:
+        """Contextualize the query and retrieve the sources, while the language of the query is detected."""
+        graph = StageGraph()
+        graph.add(
+            CONTEXTUALIZE,
+            partial(self.contextualizer.contextualize, query=query, chat_history=chat_history, model=model),
+        )
+        graph.add(LANGUAGE_DETECTION, partial(self.language_detector.detect, query))
+        graph.add(
+            RETRIEVE,
+            lambda rag_query: self.retriever.retrieve(rag_query, course_id=course_id, module_id=module_id),
+            after=[CONTEXTUALIZE],
+        )
+        with graph:
+            return graph.result(RETRIEVE), graph.result(LANGUAGE_DETECTION)
+
+    def _aretrieval_graph(
+        self,
+        query: str,
+        chat_history: list[ChatMessage],
+        model: Models,
+        course_id: int | None = None,
+        module_id: int | None = None,
+    ) -> StageGraph:
+        """Stages of the async pipeline before the answer. Language detection runs while the query is contextualized
+        and embedded, and the vector search runs together with the semantic cache lookup. On a cache hit, the vector
+        search is cancelled when the graph is left. With a chat history, the raw query is retrieved speculatively while
+        it is contextualized, see SpeculativeRetrieval."""
+
+        async def lookup_cache(embedding: list[float], language: str) -> str | None:
+            return await self._alookup_cache(embedding, course_id, module_id, model, language)
+
+        graph = StageGraph()
+        graph.add(
+            CONTEXTUALIZE,
+            partial(self.contextualizer.acontextualize, query=query, chat_history=chat_history, model=model),
+        )
+        graph.add(LANGUAGE_DETECTION, partial(self.language_detector.detect, query))
+
+        speculation = self.speculative_retrieval
+        # without a chat history the query is not contextualized, so there is nothing to wait for
+        if speculation is None or len(chat_history) == 0:
+            graph.add(EMBED, self.retriever.aembed, after=[CONTEXTUALIZE])
+            graph.add(
+                VECTOR_SEARCH,
+                partial(self.retriever.aretrieve_by_embedding, course_id=course_id, module_id=module_id),
+                after=[EMBED],
+            )
+        else:
+            self._add_speculative_retrieval(graph, speculation, query, course_id, module_id)
+
+        graph.add(SEMANTIC_CACHE, lookup_cache, after=[EMBED, LANGUAGE_DETECTION])
+        return graph
+
+    def _add_speculative_retrieval(
+        self,
+        graph: StageGraph,
+        speculation: SpeculativeRetrieval,
+        query: str,
+        course_id: int | None,
+        module_id: int | None,
+    ) -> None:
+        """Add the embed and vector search stages, which reuse the speculative sources of the raw query if the
+        contextualized query is identical or similar enough."""
+        graph.add(
+            SPECULATIVE_RETRIEVAL,
+            partial(self.retriever.aretrieve_speculative, query, course_id=course_id, module_id=module_id),
+        )
+
+        async def speculative_result() -> SpeculativeResult | None:
+            try:
+                return await graph.aresult(SPECULATIVE_RETRIEVAL)
+            except Exception:
+                # the speculation must not fail the request, the contextualized query is retrieved as usual
+                logger.exception("Speculative retrieval failed.")
+                return None
+
+        async def embed(rag_query: str) -> list[float]:
+            if speculation.is_identical(query, rag_query):
+                speculative = await speculative_result()
+                if speculative is not None:
+                    return speculative.embedding
+            return await self.retriever.aembed(rag_query)
+
+        async def search(rag_query: str, embedding: list[float]) -> list[TextNode]:
+            speculative = await speculative_result()
+            identical = speculation.is_identical(query, rag_query)
+            if speculative is None or not (identical or speculation.is_similar(speculative.embedding, embedding)):
+                speculation.record(kept=False)
+                return await self.retriever.aretrieve_by_embedding(embedding, course_id=course_id, module_id=module_id)
+            # Without speculation, the search would have started when this stage started and taken as long as the
+            # speculative one. An identical query would not even have been embedded before.
+            started = graph.spans[CONTEXTUALIZE if identical else EMBED][1]
+            seconds = speculative.search_seconds + (speculative.embed_seconds if identical else 0.0)
+            available = graph.spans[SPECULATIVE_RETRIEVAL][1]
+            saved = started + seconds - max(started, available)
+            speculation.record(kept=True, identical=identical, seconds_saved=saved)
+            return speculative.nodes
+
+        graph.add(EMBED, embed, after=[CONTEXTUALIZE])
+        graph.add(VECTOR_SEARCH, search, after=[CONTEXTUALIZE, EMBED])
 
     @observe()
     def chat(self, query: str, model: Models, chat_history: list[ChatMessage] = []) -> ChatMessage:
         """Chat with general bot about drupal and functions of ki-campus. For frontend integrated drupal."""
 
         # Limiting context window to save resources
-        limited_chat_history = self.limit_chat_history(chat_history, 10)
-
-        rag_query = self.contextualizer.contextualize(query=query, chat_history=limited_chat_history, model=model)
+        limited_chat_history = self.history_summarizer.limit(chat_history, model)
 
-        retrieved_chunks = self.retriever.retrieve(rag_query)
+        retrieved_chunks, user_language = self._retrieve(query, limited_chat_history, model)
 
-        user_language = self.language_detector.detect(query)
+        packed_sources = self.source_packer.pack(retrieved_chunks, model)
 
         response = self.question_answerer.answer_question(
             query=query,
             chat_history=limited_chat_history,
             language=user_language,
-            sources=retrieved_chunks,
+            sources=packed_sources,
             model=model,
             is_moodle=False,
             course_id=None,
         )
 
-        response.content = self.output_formatter.parse(answer=response.content, source_documents=retrieved_chunks)
+        response.content = self.output_formatter.parse(answer=response.content, source_documents=packed_sources.nodes)
         return response
 
     @observe()
@@ -61,29 +229,175 @@ class KICampusAssistant:
     ) -> ChatMessage:
         """Chat with the contents of a specific course and optionally submodule. For frontend hosted on moodle."""
 
-        limited_chat_history = self.limit_chat_history(chat_history, 10)
-
-        rag_query = self.contextualizer.contextualize(query=query, chat_history=limited_chat_history, model=model)
-
-        retrieved_chunks = self.retriever.retrieve(rag_query, course_id=course_id, module_id=module_id)
+        limited_chat_history = self.history_summarizer.limit(chat_history, model)
 
-        user_language = self.language_detector.detect(query)
+        retrieved_chunks, user_language = self._retrieve(
+            query, limited_chat_history, model, course_id=course_id, module_id=module_id
+        )
 
         # TODO course name and module name are unused. Save this metadata in the vectorDB
+        packed_sources = self.source_packer.pack(retrieved_chunks, model)
         response = self.question_answerer.answer_question(
             query=query,
             chat_history=limited_chat_history,
             language=user_language,
-            sources=retrieved_chunks,
+            sources=packed_sources,
             model=model,
             is_moodle=True,
             course_id=course_id,
         )
 
-        response.content = self.output_formatter.parse(answer=response.content, source_documents=retrieved_chunks)
+        response.content = self.output_formatter.parse(answer=response.content, source_documents=packed_sources.nodes)
 
         return response
 
+    @observe(capture_output=False)
+    def stream_chat(
+        self,
+        query: str,
+        model: Models,
+        chat_history: list[ChatMessage] = [],
+        course_id: int | None = None,
+        module_id: int | None = None,
+    ) -> Iterator[tuple[str, str]]:
+        """Streaming variant of chat and chat_with_course. Chats with the course or module contents if an id is given.
+        Yields ("token", text) while the answer is generated and finally ("answer", text) with the complete answer
+        including the citations."""
+        is_moodle = course_id is not None or module_id is not None
+
+        limited_chat_history = self.history_summarizer.limit(chat_history, model)
+
+        retrieved_chunks, user_language = self._retrieve(
+            query, limited_chat_history, model, course_id=course_id, module_id=module_id
+        )
+
+        packed_sources = self.source_packer.pack(retrieved_chunks, model)
+
+        for event, text in self.question_answerer.stream_answer(
+            query=query,
+            chat_history=limited_chat_history,
+            language=user_language,
+            sources=packed_sources,
+            model=model,
+            is_moodle=is_moodle,
+            course_id=course_id,
+        ):
+            if event == "answer":
+                text = self.output_formatter.parse(answer=text, source_documents=packed_sources.nodes)
+            yield event, text
+
+    @observe()
+    async def achat(self, query: str, model: Models, chat_history: list[ChatMessage] = []) -> ChatMessage:
+        """Async variant of chat."""
+
+        limited_chat_history = await self.history_summarizer.alimit(chat_history, model)
+
+        async with self._aretrieval_graph(query, limited_chat_history, model) as graph:
+            cached_answer = await graph.aresult(SEMANTIC_CACHE)
+            if cached_answer is not None:
+                return ChatMessage(content=cached_answer, role=MessageRole.ASSISTANT)
+            embedding = await graph.aresult(EMBED)
+            user_language = await graph.aresult(LANGUAGE_DETECTION)
+            retrieved_chunks = await graph.aresult(VECTOR_SEARCH)
+
+        packed_sources = self.source_packer.pack(retrieved_chunks, model)
+
+        response = await self.question_answerer.aanswer_question(
+            query=query,
+            chat_history=limited_chat_history,
+            language=user_language,
+            sources=packed_sources,
+            model=model,
+            is_moodle=False,
+            course_id=None,
+        )
+
+        response.content = self.output_formatter.parse(answer=response.content, source_documents=packed_sources.nodes)
+        await self._astore_in_cache(embedding, None, None, model, user_language, response.content)
+        return response
+
+    @observe()
+    async def achat_with_course(
+        self,
+        query: str,
+        model: Models,
+        course_id: int | None = None,
+        chat_history: list[ChatMessage] = [],
+        module_id: int | None = None,
+    ) -> ChatMessage:
+        """Async variant of chat_with_course."""
+
+        limited_chat_history = await self.history_summarizer.alimit(chat_history, model)
+
+        async with self._aretrieval_graph(
+            query, limited_chat_history, model, course_id=course_id, module_id=module_id
+        ) as graph:
+            cached_answer = await graph.aresult(SEMANTIC_CACHE)
+            if cached_answer is not None:
+                return ChatMessage(content=cached_answer, role=MessageRole.ASSISTANT)
+            embedding = await graph.aresult(EMBED)
+            user_language = await graph.aresult(LANGUAGE_DETECTION)
+            retrieved_chunks = await graph.aresult(VECTOR_SEARCH)
+
+        packed_sources = self.source_packer.pack(retrieved_chunks, model)
+
+        response = await self.question_answerer.aanswer_question(
+            query=query,
+            chat_history=limited_chat_history,
+            language=user_language,
+            sources=packed_sources,
+            model=model,
+            is_moodle=True,
+            course_id=course_id,
+        )
+
+        response.content = self.output_formatter.parse(answer=response.content, source_documents=packed_sources.nodes)
+        await self._astore_in_cache(embedding, course_id, module_id, model, user_language, response.content)
+
+        return response
+
+    @observe(capture_output=False)
+    async def astream_chat(
+        self,
+        query: str,
+        model: Models,
+        chat_history: list[ChatMessage] = [],
+        course_id: int | None = None,
+        module_id: int | None = None,
+    ) -> AsyncIterator[tuple[str, str]]:
+        """Async variant of stream_chat."""
+        is_moodle = course_id is not None or module_id is not None
+
+        limited_chat_history = await self.history_summarizer.alimit(chat_history, model)
+
+        async with self._aretrieval_graph(
+            query, limited_chat_history, model, course_id=course_id, module_id=module_id
+        ) as graph:
+            cached_answer = await graph.aresult(SEMANTIC_CACHE)
+            embedding = await graph.aresult(EMBED)
+            user_language = await graph.aresult(LANGUAGE_DETECTION)
+            retrieved_chunks = await graph.aresult(VECTOR_SEARCH) if cached_answer is None else []
+
+        if cached_answer is not None:
+            yield "answer", cached_answer
+            return
+
+        packed_sources = self.source_packer.pack(retrieved_chunks, model)
+
+        async for event, text in self.question_answerer.astream_answer(
+            query=query,
+            chat_history=limited_chat_history,
+            language=user_language,
+            sources=packed_sources,
+            model=model,
+            is_moodle=is_moodle,
+            course_id=course_id,
+        ):
+            if event == "answer":
+                text = self.output_formatter.parse(answer=text, source_documents=packed_sources.nodes)
+                await self._astore_in_cache(embedding, course_id, module_id, model, user_language, text)
+            yield event, text
+
 
 if __name__ == "__main__":
     assistant = KICampusAssistant()
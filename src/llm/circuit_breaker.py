@@ -0,0 +1,295 @@
+import asyncio
+import fcntl
+import json
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+from src.env import env
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# number of the last calls of the worker the error rate and latency are computed from
+WINDOW_SIZE = 20
+# a half-open breaker lets the next call probe the backend when the probe did not report back in time
+PROBE_TIMEOUT = 30  # in seconds
+# the state read from the store is reused for this long, so that most calls do not touch the store
+STATE_CACHE_SECONDS = 1.0
+
+logger = logging.getLogger("api")
+
+Change = Callable[[dict], dict | None]
+
+
+@dataclass(frozen=True)
+class Permit:
+    """A call the breaker allowed. The probe of a half-open breaker carries the time it was claimed at, so that only
+    this call decides whether the breaker closes."""
+
+    probe_at: float | None = None
+
+
+class InMemoryBreakerStore:
+    """State of the breakers of this worker process."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._states: dict[str, dict] = {}
+
+    def read(self, name: str) -> dict:
+        with self._lock:
+            return dict(self._states.get(name, {}))
+
+    def update(self, name: str, change: Change) -> bool:
+        """Apply change to the state of the breaker atomically, change returns None to keep the state."""
+        with self._lock:
+            state = change(dict(self._states.get(name, {})))
+            if state is None:
+                return False
+            self._states[name] = state
+            return True
+
+
+class FileBreakerStore:
+    """State of the breakers in a small JSON file, shared by the workers of the host. Access is serialized with
+    flock, so that only one worker moves an open breaker to half-open."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def read(self, name: str) -> dict:
+        try:
+            with open(self.path) as file:
+                fcntl.flock(file, fcntl.LOCK_SH)
+                content = file.read()
+        except FileNotFoundError:
+            return {}
+        return json.loads(content or "{}").get(name, {})
+
+    def update(self, name: str, change: Change) -> bool:
+        with open(self.path, "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            states = json.loads(file.read() or "{}")
+            state = change(dict(states.get(name, {})))
+            if state is None:
+                return False
+            states[name] = state
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(states))
+            file.flush()
+            return True
+
+
+class CircuitBreaker:
+    """Stops calling a backend while it fails or is too slow, so that its calls go to the fallback model at once.
+
+    The breaker is closed while the backend is healthy. It opens when the error rate of the last calls of the worker or
+    the 95th percentile of the time to the first token of their successful calls exceed their thresholds. Every call
+    path streams the answer and reports the time to the first token, the length of the answer does not matter. While
+    it is open, all workers skip the backend. After open_seconds the next call probes the backend in the half-open
+    state: success closes the breaker, a failure opens it again.
+
+    The state is kept in the store, the window of recent calls in the worker. The state is read from the store at most
+    every STATE_CACHE_SECONDS, the store is locked exclusively only when the state changes. Coroutines use aallow(),
+    arecord() and arelease(), which access the store in a thread."""
+
+    def __init__(
+        self,
+        name: str,
+        store: InMemoryBreakerStore | FileBreakerStore,
+        error_rate_threshold: float,
+        latency_threshold: float,
+        open_seconds: float,
+        min_calls: int,
+    ) -> None:
+        self.name = name
+        self.store = store
+        self.error_rate_threshold = error_rate_threshold
+        self.latency_threshold = latency_threshold
+        self.open_seconds = open_seconds
+        self.min_calls = min_calls
+        self._lock = threading.Lock()
+        # (success, seconds) of the last calls
+        self._calls: deque[tuple[bool, float]] = deque(maxlen=WINDOW_SIZE)
+        # (time it was read, state) of the last read from the store
+        self._cached_state: tuple[float, dict] | None = None
+
+        self.trips = 0
+        self.rejected = 0
+
+    def _cached(self) -> dict | None:
+        cached = self._cached_state
+        if cached is not None and time.monotonic() - cached[0] < STATE_CACHE_SECONDS:
+            return cached[1]
+        return None
+
+    def _read(self, fresh: bool = False) -> dict:
+        if not fresh and (state := self._cached()) is not None:
+            return state
+        try:
+            state = self.store.read(self.name)
+        except (OSError, ValueError):
+            logger.exception(f"Reading the state of the circuit breaker {self.name} failed.")
+            return {}
+        self._cached_state = (time.monotonic(), state)
+        return state
+
+    def _update(self, change: Change) -> bool:
+        # the next read sees the change, or the change of another worker that made this one obsolete
+        self._cached_state = None
+        try:
+            return self.store.update(self.name, change)
+        except (OSError, ValueError):
+            logger.exception(f"Updating the state of the circuit breaker {self.name} failed.")
+            return False
+
+    def state(self) -> str:
+        return self._read().get("state", CLOSED)
+
+    def _blocked(self, state: dict, now: float) -> bool:
+        if state.get("state") == OPEN:
+            return now - state["opened_at"] < self.open_seconds
+        if state.get("state") == HALF_OPEN:
+            return now - state["probe_at"] < PROBE_TIMEOUT
+        return False
+
+    def allow(self) -> Permit | None:
+        """A permit if the backend may be called, None otherwise. The call has to be reported with record() and its
+        permit, or with release() if it was cancelled before it told anything about the backend."""
+        state = self._read()
+        if state.get("state", CLOSED) == CLOSED:
+            return Permit()
+        now = time.time()
+
+        def claim_probe(current: dict) -> dict | None:
+            if current.get("state", CLOSED) == CLOSED or self._blocked(current, now):
+                return None
+            return {"state": HALF_OPEN, "opened_at": current["opened_at"], "probe_at": now}
+
+        if not self._blocked(state, now) and self._update(claim_probe):
+            self._cached_state = (time.monotonic(), claim_probe(state) or {})
+            return Permit(probe_at=now)
+        # another worker closed the breaker in the meantime
+        if self.state() == CLOSED:
+            return Permit()
+        with self._lock:
+            self.rejected += 1
+        return None
+
+    @staticmethod
+    def _is_probe(current: dict, permit: Permit) -> bool:
+        """Whether the permit is still the probe of the half-open breaker, and not a probe that timed out."""
+        return current.get("state") == HALF_OPEN and current.get("probe_at") == permit.probe_at
+
+    def record(self, success: bool, seconds: float, permit: Permit | None = None) -> None:
+        probing = permit is not None and permit.probe_at is not None
+        with self._lock:
+            if probing:
+                self._calls.clear()
+            self._calls.append((success, seconds))
+            calls = len(self._calls)
+            error_rate, p95_seconds = self._window()
+
+        if probing:
+            # a probe that answered but was too slow does not close the breaker
+            if success and seconds < self.latency_threshold:
+                closed = self._update(lambda current: {"state": CLOSED} if self._is_probe(current, permit) else None)
+                if closed:
+                    logger.info(f"Circuit breaker {self.name} closed, the probe succeeded.")
+            elif self._is_probe(self._read(fresh=True), permit):
+                self._open(f"the probe {'was too slow' if success else 'failed'} after {seconds:.1f} s")
+        elif calls >= self.min_calls and error_rate >= self.error_rate_threshold:
+            self._open(f"error rate {error_rate:.0%}")
+        elif calls >= self.min_calls and p95_seconds >= self.latency_threshold:
+            self._open(f"95th percentile time to first token {p95_seconds:.1f} s")
+
+    async def aallow(self) -> Permit | None:
+        """allow() for coroutines, the store is only read in a thread when the cached state is outdated."""
+        state = self._cached()
+        if state is not None and state.get("state", CLOSED) == CLOSED:
+            return Permit()
+        return await asyncio.to_thread(self.allow)
+
+    async def arecord(self, success: bool, seconds: float, permit: Permit | None = None) -> None:
+        await asyncio.to_thread(self.record, success, seconds, permit)
+
+    async def arelease(self, permit: Permit | None) -> None:
+        if permit is not None and permit.probe_at is not None:
+            await asyncio.to_thread(self.release, permit)
+
+    def release(self, permit: Permit | None) -> None:
+        """The call was cancelled before it was recorded. A probe is given up, so that the next call probes the
+        backend at once instead of after PROBE_TIMEOUT."""
+        if permit is None or permit.probe_at is None:
+            return
+        self._update(lambda current: {**current, "probe_at": 0.0} if self._is_probe(current, permit) else None)
+
+    def _window(self) -> tuple[float, float]:
+        """Error rate of the last calls and 95th percentile of the time to the first token of the successful ones, the
+        lock has to be held. A failed call has no first token, it only counts for the error rate."""
+        if not self._calls:
+            return 0.0, 0.0
+        errors = sum(not success for success, _ in self._calls)
+        latencies = sorted(seconds for success, seconds in self._calls if success)
+        if not latencies:
+            return errors / len(self._calls), 0.0
+        return errors / len(self._calls), latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def _open(self, reason: str) -> None:
+        self._update(lambda current: {"state": OPEN, "opened_at": time.time()})
+        with self._lock:
+            self._calls.clear()
+            self.trips += 1
+        logger.warning(f"Circuit breaker {self.name} opened, {reason}. Calls use the fallback model.")
+
+    def stats(self) -> dict:
+        state = self.state()
+        with self._lock:
+            error_rate, p95_seconds = self._window()
+            return {
+                "state": state,
+                "calls": len(self._calls),
+                "error_rate": error_rate,
+                "p95_first_token_seconds": p95_seconds,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+
+class CircuitBreakerRegistry:
+    """The breakers of the backends, configured from the environment on first use."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._store: InMemoryBreakerStore | FileBreakerStore | None = None
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            if self._store is None:
+                path = env.CIRCUIT_BREAKER_STATE_PATH
+                self._store = FileBreakerStore(path) if path else InMemoryBreakerStore()
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(
+                    name,
+                    self._store,
+                    error_rate_threshold=env.CIRCUIT_BREAKER_ERROR_RATE,
+                    latency_threshold=env.CIRCUIT_BREAKER_P95_FIRST_TOKEN_SECONDS,
+                    open_seconds=env.CIRCUIT_BREAKER_OPEN_SECONDS,
+                    min_calls=env.CIRCUIT_BREAKER_MIN_CALLS,
+                )
+            return self._breakers[name]
+
+    def stats(self) -> dict:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+circuit_breakers = CircuitBreakerRegistry()
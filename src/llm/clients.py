@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import threading
+from typing import TYPE_CHECKING, Callable, TypeVar
+
+import httpx
+
+from src.env import env
+from src.llm.routing import AsyncRoutingTransport, DeploymentRouter, RoutingTransport
+
+if TYPE_CHECKING:
+    from llama_index.core.callbacks import CallbackManager
+    from llama_index.core.llms.function_calling import FunctionCallingLLM
+    from llama_index.core.llms.llm import LLM as llama_llm
+
+# connect timeout of the pools, the read timeout is set by the SDK for every request
+CONNECT_TIMEOUT = 5
+WARM_UP_TIMEOUT = 3
+
+logger = logging.getLogger("api")
+
+Client = TypeVar("Client")
+
+
+def current_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class EndpointPool:
+    """The keep-alive connection pools of one endpoint, one for sync calls and one per event loop for async calls."""
+
+    def __init__(self, name: str, limits: httpx.Limits, router: DeploymentRouter | None = None) -> None:
+        self.name = name
+        self.limits = limits
+        self.router = router
+        self.requests = 0
+        self.sync_client = httpx.Client(
+            limits=limits,
+            timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT),
+            event_hooks={"request": [self._count]},
+            transport=RoutingTransport(router, httpx.HTTPTransport(limits=limits)) if router is not None else None,
+        )
+        # id of the event loop -> (loop, client), async connections can not be used by another loop
+        self.async_clients: dict[int, tuple[asyncio.AbstractEventLoop | None, httpx.AsyncClient]] = {}
+
+    def _count(self, request: httpx.Request) -> None:
+        self.requests += 1
+
+    async def _acount(self, request: httpx.Request) -> None:
+        self.requests += 1
+
+    def async_client(self, loop: asyncio.AbstractEventLoop | None) -> httpx.AsyncClient:
+        # clients of closed loops (e.g. of finished asyncio.run calls in scripts) are dropped
+        for loop_id, (client_loop, _) in list(self.async_clients.items()):
+            if client_loop is not None and client_loop.is_closed():
+                del self.async_clients[loop_id]
+        if id(loop) not in self.async_clients:
+            self.async_clients[id(loop)] = (
+                loop,
+                httpx.AsyncClient(
+                    limits=self.limits,
+                    timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT),
+                    event_hooks={"request": [self._acount]},
+                    transport=(
+                        AsyncRoutingTransport(self.router, httpx.AsyncHTTPTransport(limits=self.limits))
+                        if self.router is not None
+                        else None
+                    ),
+                ),
+            )
+        return self.async_clients[id(loop)][1]
+
+    def connections(self) -> tuple[int, int]:
+        """Number of open and idle connections of all pools of the endpoint."""
+        clients: list[httpx.Client | httpx.AsyncClient] = [self.sync_client]
+        clients += [client for _, client in self.async_clients.values()]
+        open_connections = idle_connections = 0
+        for client in clients:
+            # httpx has no public API for its pool, the httpcore connections are read from the transport
+            transport = getattr(client, "_transport", None)
+            pool = getattr(getattr(transport, "transport", transport), "_pool", None)
+            for connection in getattr(pool, "connections", []):
+                open_connections += 1
+                idle_connections += connection.is_idle()
+        return open_connections, idle_connections
+
+    def stats(self) -> dict:
+        open_connections, idle_connections = self.connections()
+        return {
+            "requests": self.requests,
+            "open_connections": open_connections,
+            "idle_connections": idle_connections,
+            "utilization": (open_connections - idle_connections) / self.limits.max_connections
+            if self.limits.max_connections
+            else 0.0,
+        }
+
+
+class LLMClientPool:
+    """Long-lived model clients and HTTP connection pools of a worker process.
+
+    Building a llama_index model creates a new OpenAI client with its own connections, so every call paid for the TCP
+    and TLS handshake. The pool keeps one model object per model and one keep-alive connection pool per endpoint,
+    which all models of the endpoint share (Llama3 and Qwen2 both run at GWDG). Every call gets a shallow copy of the
+    model with the callback manager of its request, the copy shares the clients of the pooled model.
+
+    Async connections belong to the event loop that opened them, so async clients and the models that use them are
+    kept per event loop. A worker runs a single loop, scripts with several asyncio.run calls get new clients."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pools: dict[str, EndpointPool] = {}
+        # (name, id of the event loop) -> model or embedder
+        self._clients: dict[tuple[str, int], object] = {}
+
+    @staticmethod
+    def limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=env.LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=env.LLM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=env.LLM_POOL_KEEPALIVE_EXPIRY,
+        )
+
+    def pool(self, endpoint: str, router: DeploymentRouter | None = None) -> EndpointPool:
+        """endpoint is the name of the service, e.g. "gwdg", it is used as label of the metrics. The requests of a
+        pool with a router are spread over the deployments of the router."""
+        name = f"{endpoint}:{router.name}" if router is not None else endpoint
+        with self._lock:
+            if name not in self._pools:
+                self._pools[name] = EndpointPool(name, self.limits(), router)
+            return self._pools[name]
+
+    def http_clients(
+        self, endpoint: str, router: DeploymentRouter | None = None
+    ) -> tuple[httpx.Client, httpx.AsyncClient]:
+        """The sync client and the async client for the current event loop."""
+        pool = self.pool(endpoint, router)
+        with self._lock:
+            return pool.sync_client, pool.async_client(current_loop())
+
+    def get(self, name: str, build: Callable[[], Client]) -> Client:
+        """The pooled client called name for the current event loop, built on first use."""
+        loop = current_loop()
+        key = (name, id(loop))
+        with self._lock:
+            client = self._clients.get(key)
+        if client is None:
+            client = build()
+            with self._lock:
+                client = self._clients.setdefault(key, client)
+        return client  # type: ignore[return-value]
+
+    @staticmethod
+    def for_request(
+        llm: "FunctionCallingLLM | llama_llm", callback_manager: "CallbackManager"
+    ) -> "FunctionCallingLLM | llama_llm":
+        """A copy of the pooled model that reports to the callback manager of the request."""
+        copy = llm.copy()
+        copy.callback_manager = callback_manager
+        return copy
+
+    async def awarm_up(self, endpoints: dict[str, str]) -> None:
+        """Open a connection to every endpoint (name -> url) in the pools of the current event loop and of the sync
+        calls, so that the first requests of the worker do not pay for the handshakes. Any response keeps the
+        connection open."""
+
+        async def warm_up(endpoint: str, url: str) -> None:
+            sync_client, async_client = self.http_clients(endpoint)
+            try:
+                await asyncio.gather(
+                    async_client.get(url, timeout=WARM_UP_TIMEOUT),
+                    asyncio.to_thread(sync_client.get, url, timeout=WARM_UP_TIMEOUT),
+                )
+            except Exception as e:
+                logger.warning(f"Warming up the connections to {endpoint} failed: {e!r}")
+
+        await asyncio.gather(*(warm_up(endpoint, url) for endpoint, url in endpoints.items() if url.startswith("http")))
+
+    async def aclose(self) -> None:
+        """Close the connections of all pools, called when the worker shuts down."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+            self._clients.clear()
+        for pool in pools:
+            pool.sync_client.close()
+            for _, client in pool.async_clients.values():
+                await client.aclose()
+
+    def reset_after_fork(self) -> None:
+        """Forget the pools inherited from the gunicorn master, their sockets must not be used by the workers."""
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._clients = {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = list(self._pools.values())
+            clients = len(self._clients)
+        return {"clients": clients, "endpoints": {pool.name: pool.stats() for pool in pools}}
+
+
+llm_clients = LLMClientPool()
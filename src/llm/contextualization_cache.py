@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from llama_index.core.llms import ChatMessage
+
+from src.llm.LLMs import Models
+
+MAX_IN_MEMORY_ENTRIES = 5000
+MAX_STORED_ENTRIES = 100_000
+# expired and surplus rows are deleted on every n-th write
+PRUNE_INTERVAL = 500
+# a locked database is treated as a cache miss instead of delaying the request
+SQLITE_TIMEOUT = 0.05
+
+logger = logging.getLogger("api")
+
+
+def contextualization_key(model: Models, chat_history: list[ChatMessage], query: str) -> str:
+    """The rewritten query only depends on the model, the chat history as sent to the LLM and the query."""
+    payload = [model.value, [(message.role.value, message.content or "") for message in chat_history], query]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode()).hexdigest()
+
+
+class InMemoryMemoBackend:
+    """Least recently used entries of this worker process."""
+
+    def __init__(self, max_entries: int = MAX_IN_MEMORY_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (value, created_at)
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def get(self, key: str, ttl: float) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time() - ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: str, created_at: float | None = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, created_at if created_at is not None else time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteMemoBackend:
+    """Entries in a local SQLite file, shared by the workers of the same host and kept across restarts."""
+
+    def __init__(self, path: str, max_entries: int = MAX_STORED_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS memo_created_at ON memo (created_at)")
+
+    def get(self, key: str, ttl: float) -> tuple[str, float] | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM memo WHERE key = ? AND created_at >= ?", (key, time.time() - ttl)
+            ).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO memo (key, value, created_at) VALUES (?, ?, ?)", (key, value, time.time())
+            )
+            self._writes += 1
+            if self._writes % PRUNE_INTERVAL == 0:
+                self._connection.execute("DELETE FROM memo WHERE created_at < ?", (time.time() - ttl,))
+                self._connection.execute(
+                    "DELETE FROM memo WHERE key IN (SELECT key FROM memo ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ContextualizationCache:
+    """Reuses the rewritten query when the same conversation and question are contextualized again.
+
+    Clients resend the whole conversation with every turn, so retries and repeated requests reach the contextualizer
+    with the same input. Entries are kept in an LRU of the worker and, with a store, in a SQLite file that all workers
+    of the host share. Errors of the store are logged and treated as a cache miss."""
+
+    def __init__(self, memory: InMemoryMemoBackend, store: SqliteMemoBackend | None, ttl: float) -> None:
+        self.memory = memory
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, model: Models, chat_history: list[ChatMessage], query: str) -> str | None:
+        key = contextualization_key(model, chat_history, query)
+        value = self.memory.get(key, self.ttl)
+        if value is not None:
+            self._record("memory_hits")
+            return value
+
+        stored = None
+        if self.store is not None:
+            try:
+                stored = self.store.get(key, self.ttl)
+            except sqlite3.Error:
+                logger.exception("Contextualization cache lookup failed.")
+        if stored is None:
+            self._record("misses")
+            return None
+        self.memory.set(key, stored[0], created_at=stored[1])
+        self._record("store_hits")
+        return stored[0]
+
+    def set(self, model: Models, chat_history: list[ChatMessage], query: str, rag_query: str) -> None:
+        key = contextualization_key(model, chat_history, query)
+        self.memory.set(key, rag_query)
+        if self.store is not None:
+            try:
+                self.store.set(key, rag_query, self.ttl)
+            except sqlite3.Error:
+                logger.exception("Storing the contextualized query failed.")
+
+    def _record(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.store_hits
+            lookups = hits + self.misses
+            return {
+                "backend": "sqlite" if self.store is not None else "memory",
+                "entries": len(self.memory),
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
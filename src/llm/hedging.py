@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from collections import deque
+from typing import Awaitable, Callable
+
+from src.env import env
+
+# latencies of the last successful calls of a model the hedge delay is derived from
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+HEDGE_PERCENTILE = 0.9
+# used until enough latencies of the model were observed
+DEFAULT_HEDGE_DELAY = 3.0  # in seconds
+MIN_HEDGE_DELAY = 0.5  # in seconds
+# a burst of slow calls can use at most this many saved hedges at once
+MAX_SAVED_HEDGES = 10
+
+
+async def first_success(tasks: list[asyncio.Future]) -> asyncio.Future:
+    """The first of the tasks that finishes without an error, the others are cancelled. Raises the error of the last
+    task if all of them fail."""
+    pending = set(tasks)
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            errors = [task.exception() for task in done]
+            for task, error in zip(done, errors):
+                if error is None:
+                    return task
+            if not pending:
+                raise errors[-1]  # type: ignore[misc]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class Hedger:
+    """Sends the prompt of a slow call to the fallback model as well, the caller uses the first answer.
+
+    A call is hedged when it has not finished after the 90th percentile of the latency of its model, so only the
+    slowest tenth of the calls pays for a second call. Every call of a model saves LLM_HEDGE_BUDGETS[model] hedges
+    (e.g. 0.1 allows every tenth call to be hedged) and a hedge uses one, which caps the extra spend when the backend
+    is slow for all calls."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies: dict[str, deque[float]] = {}
+        self._saved_hedges: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        self.hedged: dict[str, int] = {}
+        self.fallback_wins: dict[str, int] = {}
+
+    def delay(self, model: str) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        return max(latencies[int(len(latencies) * HEDGE_PERCENTILE)], MIN_HEDGE_DELAY)
+
+    def _take_hedge(self, model: str) -> bool:
+        with self._lock:
+            if self._saved_hedges.get(model, 0.0) < 1:
+                return False
+            self._saved_hedges[model] -= 1
+            self.hedged[model] = self.hedged.get(model, 0) + 1
+            return True
+
+    async def ahedge(
+        self, model: str, primary: asyncio.Future, fallback: Callable[[], Awaitable]
+    ) -> asyncio.Future | None:
+        """Wait for the primary call until the hedge delay of the model is over. If it is still running and the
+        budget allows it, the fallback call is started and returned."""
+        with self._lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+            saved = self._saved_hedges.get(model, 0.0) + env.LLM_HEDGE_BUDGETS.get(model, 0.0)
+            self._saved_hedges[model] = min(saved, MAX_SAVED_HEDGES)
+
+        done, _ = await asyncio.wait({primary}, timeout=self.delay(model))
+        if done or not self._take_hedge(model):
+            return None
+        return asyncio.ensure_future(fallback())
+
+    def record(self, model: str, seconds: float) -> None:
+        """Latency of a primary call that succeeded, or the time until it was cancelled because the hedge won."""
+        with self._lock:
+            self._latencies.setdefault(model, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def record_fallback_win(self, model: str) -> None:
+        with self._lock:
+            self.fallback_wins[model] = self.fallback_wins.get(model, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = list(self.calls)
+        return {
+            model: {
+                "calls": self.calls[model],
+                "hedged": self.hedged.get(model, 0),
+                "hedge_rate": self.hedged.get(model, 0) / self.calls[model],
+                "fallback_wins": self.fallback_wins.get(model, 0),
+                "delay_seconds": self.delay(model),
+            }
+            for model in models
+        }
+
+
+hedger = Hedger()
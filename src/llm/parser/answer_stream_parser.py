@@ -0,0 +1,74 @@
+import json
+import re
+
+# Start of a JSON response as requested in the RESPONSE FORMAT of the system prompts, optionally in a markdown code block
+ANSWER_PREFIX = re.compile(r'^\s*(?:```(?:json)?\s*)?\{\s*"answer"\s*:\s*"')
+# Responses that did not reveal whether they are JSON after this many characters are treated as plain text
+MAX_UNDECIDED_LENGTH = 40
+
+HIGH_SURROGATES = {"d8", "d9", "da", "db"}
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class AnswerStreamParser:
+    """Extracts the "answer" field of a streamed JSON response token by token, so that the user only sees the answer text.
+    The LLM sometimes forgets to respond with JSON, such responses are passed through unchanged."""
+
+    def __init__(self) -> None:
+        self.name = "AnswerStreamParser"
+        self._buffer = ""
+        self._mode = "undecided"  # undecided -> json | text, json -> done
+        self._pending_escape = ""
+
+    def feed(self, delta: str) -> str:
+        """Consume the next part of the LLM response and return the answer text it contains."""
+        if self._mode == "text":
+            return delta
+        if self._mode == "done":
+            return ""
+        if self._mode == "json":
+            return self._read_string(delta)
+
+        self._buffer += delta
+        match = ANSWER_PREFIX.match(self._buffer)
+        if match:
+            self._mode = "json"
+            return self._read_string(self._buffer[match.end() :])
+
+        stripped = self._buffer.lstrip()
+        if stripped and stripped[0] not in "{`" or len(stripped) > MAX_UNDECIDED_LENGTH:
+            self._mode = "text"
+            return self._buffer
+        return ""
+
+    def _read_string(self, text: str) -> str:
+        """Decode the JSON string content until the closing quote. Escape sequences may be split across deltas."""
+        answer = ""
+        text = self._pending_escape + text
+        self._pending_escape = ""
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if char == '"':
+                self._mode = "done"
+                break
+            if char != "\\":
+                answer += char
+                i += 1
+                continue
+
+            if i + 1 >= len(text):
+                self._pending_escape = text[i:]
+                break
+            if text[i + 1] == "u":
+                # characters outside the BMP (e.g. emojis) are encoded as a surrogate pair of two escapes
+                length = 12 if text[i + 2 : i + 4].lower() in HIGH_SURROGATES else 6
+                if i + length > len(text):
+                    self._pending_escape = text[i:]
+                    break
+                answer += json.loads(f'"{text[i : i + length]}"')
+                i += length
+            else:
+                answer += JSON_ESCAPES.get(text[i + 1], text[i + 1])
+                i += 2
+        return answer
@@ -3,6 +3,8 @@ import re
 from langfuse.decorators import observe
 from llama_index.core.schema import TextNode
 
+from src.llm.timing import CITATION_PARSE, timed
+
 CITATION_TEXT = '<a href="{url}"><sup>[{index}]</sup></a>'
 
 
@@ -51,6 +53,7 @@ class CitationParser:
         return answer
 
     @observe()
+    @timed(CITATION_PARSE)
     def parse(
         self,
         answer: str,
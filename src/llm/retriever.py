@@ -1,21 +1,30 @@
+import time
+
 from langfuse.decorators import observe
 from llama_index.core.schema import NodeWithScore, TextNode
-from llama_index.core.vector_stores import VectorStoreQuery
+from llama_index.core.vector_stores import VectorStoreQuery, VectorStoreQueryResult
 
 from src.llm.LLMs import LLM
+from src.llm.source_packing import SCORE_METADATA_KEY
+from src.llm.speculative_retrieval import SpeculativeResult
+from src.llm.timing import EMBED, SPECULATIVE_RETRIEVAL, VECTOR_SEARCH, stage, timed
 from src.vectordb.qdrant import VectorDBQdrant, models
 
+COLLECTION_NAME = "web_assistant"
+# Upper bound of queries per batch retrieval, all of them are embedded in a single request to the embedding API
+MAX_BATCH_QUERIES = 64
+
 
 class KiCampusRetriever:
-    def __init__(self):
-        self.embedder = LLM().get_embedder()
-        self.vector_store = VectorDBQdrant("prod_remote").as_llama_vector_store(collection_name="web_assistant")
+    def __init__(self, vector_db: VectorDBQdrant | None = None):
+        self.embedder = LLM().get_embedder(embed_batch_size=MAX_BATCH_QUERIES)
+        self.vector_db = vector_db if vector_db is not None else VectorDBQdrant("prod_remote")
+        self.vector_store = self.vector_db.as_llama_vector_store(
+            collection_name=COLLECTION_NAME, with_async_client=True
+        )
         super().__init__()
 
-    @observe()
-    def retrieve(self, query: str, course_id: int | None = None, module_id: int | None = None) -> list[TextNode]:
-        embedding = self.embedder.get_query_embedding(query)
-
+    def _build_filter(self, course_id: int | None = None, module_id: int | None = None) -> models.Filter | None:
         conditions = []
 
         if course_id is None and module_id is None:
@@ -42,12 +51,9 @@ class KiCampusRetriever:
                 )
             )
 
-        filter = models.Filter(must=conditions) if conditions else None
-
-        vector_store_query = VectorStoreQuery(query_embedding=embedding, similarity_top_k=10)
-
-        query_result = self.vector_store.query(vector_store_query, qdrant_filters=filter)
+        return models.Filter(must=conditions) if conditions else None
 
+    def _to_nodes(self, query_result: VectorStoreQueryResult) -> list[TextNode]:
         if query_result.nodes is None:
             return []
 
@@ -57,3 +63,108 @@ class KiCampusRetriever:
             node.text_template = "{metadata_str}\nContent: {content}"
 
         return query_result.nodes
+
+    def _to_scored_nodes(self, query_result: VectorStoreQueryResult) -> list[TextNode]:
+        """Nodes for the chat, with their similarity to the query in the metadata, see SourcePacker."""
+        nodes = self._to_nodes(query_result)
+        for node, score in zip(nodes, query_result.similarities or []):
+            node.metadata[SCORE_METADATA_KEY] = score
+            node.excluded_llm_metadata_keys = [*node.excluded_llm_metadata_keys, SCORE_METADATA_KEY]
+            node.excluded_embed_metadata_keys = [*node.excluded_embed_metadata_keys, SCORE_METADATA_KEY]
+        return nodes
+
+    @observe()
+    def retrieve(self, query: str, course_id: int | None = None, module_id: int | None = None) -> list[TextNode]:
+        with stage(EMBED):
+            embedding = self.embedder.get_query_embedding(query)
+
+        vector_store_query = VectorStoreQuery(query_embedding=embedding, similarity_top_k=10)
+
+        with stage(VECTOR_SEARCH):
+            query_result = self.vector_store.query(
+                vector_store_query, qdrant_filters=self._build_filter(course_id=course_id, module_id=module_id)
+            )
+
+        return self._to_scored_nodes(query_result)
+
+    @observe()
+    async def aretrieve(self, query: str, course_id: int | None = None, module_id: int | None = None) -> list[TextNode]:
+        embedding = await self.aembed(query)
+        return await self.aretrieve_by_embedding(embedding, course_id=course_id, module_id=module_id)
+
+    @timed(EMBED)
+    async def aembed(self, query: str) -> list[float]:
+        return await self.embedder.aget_query_embedding(query)
+
+    @observe()
+    @timed(VECTOR_SEARCH)
+    async def aretrieve_by_embedding(
+        self, embedding: list[float], course_id: int | None = None, module_id: int | None = None
+    ) -> list[TextNode]:
+        return await self._asearch(embedding, course_id=course_id, module_id=module_id)
+
+    @observe()
+    @timed(SPECULATIVE_RETRIEVAL)
+    async def aretrieve_speculative(
+        self, query: str, course_id: int | None = None, module_id: int | None = None
+    ) -> SpeculativeResult:
+        """Embed and search the raw query while it is contextualized, see SpeculativeRetrieval. Timed as a stage of
+        its own, so that the embed and vector search stages only contain the work on the critical path."""
+        start = time.perf_counter()
+        embedding = await self.embedder.aget_query_embedding(query)
+        embedded = time.perf_counter()
+        nodes = await self._asearch(embedding, course_id=course_id, module_id=module_id)
+        return SpeculativeResult(
+            embedding=embedding,
+            nodes=nodes,
+            embed_seconds=embedded - start,
+            search_seconds=time.perf_counter() - embedded,
+        )
+
+    async def _asearch(
+        self, embedding: list[float], course_id: int | None = None, module_id: int | None = None
+    ) -> list[TextNode]:
+        vector_store_query = VectorStoreQuery(query_embedding=embedding, similarity_top_k=10)
+
+        query_result = await self.vector_store.aquery(
+            vector_store_query, qdrant_filters=self._build_filter(course_id=course_id, module_id=module_id)
+        )
+
+        return self._to_scored_nodes(query_result)
+
+    @observe()
+    async def aretrieve_batch(
+        self,
+        queries: list[tuple[str, int | None, int | None]],
+        limit: int = 10,
+        with_vectors: bool = False,
+    ) -> list[list[NodeWithScore]]:
+        """Retrieve the sources for several (query, course_id, module_id) tuples at once.
+        All queries are embedded in one embedding request and searched in one Qdrant round trip."""
+        embeddings = await self.embedder.aget_text_embedding_batch([query for query, _, _ in queries])
+
+        search_results = await self.vector_db.aclient.search_batch(
+            collection_name=COLLECTION_NAME,
+            requests=[
+                models.SearchRequest(
+                    vector=embedding,
+                    filter=self._build_filter(course_id=course_id, module_id=module_id),
+                    limit=limit,
+                    with_payload=True,
+                    with_vector=with_vectors,
+                )
+                for embedding, (_, course_id, module_id) in zip(embeddings, queries)
+            ],
+        )
+
+        results = []
+        for points in search_results:
+            query_result = self.vector_store.parse_to_query_result(points)
+            nodes = self._to_nodes(query_result)
+            for node, point in zip(nodes, points):
+                if with_vectors and isinstance(point.vector, list):
+                    node.embedding = point.vector
+            results.append(
+                [NodeWithScore(node=node, score=score) for node, score in zip(nodes, query_result.similarities or [])]
+            )
+        return results
@@ -0,0 +1,252 @@
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+import httpx
+
+from src.env import env
+
+# weight of the newest call in the moving averages of latency and errors
+EWMA_WEIGHT = 0.2
+# an error rate of 25% doubles the score of a deployment
+ERROR_PENALTY = 4
+# a deployment close to its rate limit is only used when the others are much slower
+MIN_HEADROOM = 0.05
+# used when a throttled deployment does not send retry-after
+DEFAULT_RETRY_AFTER = 10  # in seconds
+DEPLOYMENT_PATH = re.compile(r"/openai/deployments/[^/]+/")
+
+logger = logging.getLogger("api")
+
+
+@dataclass
+class Deployment:
+    """One Azure OpenAI deployment of a model and its live health."""
+
+    name: str
+    url: str
+    deployment: str
+    api_key: str | None = None
+
+    latency: float = 0.0
+    error_rate: float = 0.0
+    requests: int = 0
+    in_flight: int = 0
+    throttled: int = 0
+    throttled_until: float = 0.0
+    # remaining requests and tokens of the rate limit window, and the largest values seen, from the response headers
+    remaining_requests: int | None = None
+    remaining_tokens: int | None = None
+    max_remaining_requests: int = 0
+    max_remaining_tokens: int = 0
+
+    def headroom(self) -> float:
+        """Share of the rate limit that is left, as far as the headers tell."""
+        shares = [1.0]
+        if self.remaining_requests is not None and self.max_remaining_requests:
+            shares.append(self.remaining_requests / self.max_remaining_requests)
+        if self.remaining_tokens is not None and self.max_remaining_tokens:
+            shares.append(self.remaining_tokens / self.max_remaining_tokens)
+        return max(min(shares), MIN_HEADROOM)
+
+    def score(self) -> float:
+        """Lower is better. Deployments without calls yet score 0, so every deployment is tried."""
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate) * (1 + self.in_flight) / self.headroom()
+
+
+def header_int(response: httpx.Response, name: str) -> int | None:
+    value = response.headers.get(name)
+    return int(value) if value is not None and value.isdigit() else None
+
+
+def retry_after(response: httpx.Response) -> float:
+    if (milliseconds := header_int(response, "retry-after-ms")) is not None:
+        return milliseconds / 1000
+    if (seconds := header_int(response, "retry-after")) is not None:
+        return seconds
+    return DEFAULT_RETRY_AFTER
+
+
+class DeploymentRouter:
+    """Spreads the calls of a model over equivalent deployments, e.g. in several regions.
+
+    The router sits in the HTTP transport of the pooled clients (see src/llm/clients.py), so the SDK and llama_index
+    are unaware of it. Each request goes to the deployment with the best score: the moving average of its latency
+    until the response headers arrive, raised by its error rate, its requests in flight and a low remaining rate limit
+    (x-ratelimit-remaining-requests and -tokens). A deployment that answers 429 is skipped until its retry-after is
+    over and the request is sent to the next deployment at once. Only when all deployments are throttled, the 429 is
+    returned and the SDK retries it."""
+
+    def __init__(self, name: str, deployments: list[Deployment]) -> None:
+        self.name = name
+        self.deployments = deployments
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, name: str, config: list[dict[str, str]]) -> "DeploymentRouter":
+        deployments = [
+            Deployment(
+                name=entry.get("name") or f"{entry['deployment']}-{index}",
+                url=entry["url"],
+                deployment=entry["deployment"],
+                api_key=entry.get("api_key"),
+            )
+            for index, entry in enumerate(config)
+        ]
+        return cls(name, deployments)
+
+    def choose(self, tried: set[str]) -> Deployment | None:
+        """The best deployment that was not tried for this request yet, and count the request as in flight."""
+        now = time.time()
+        with self._lock:
+            candidates = [deployment for deployment in self.deployments if deployment.name not in tried]
+            if not candidates:
+                return None
+            available = [deployment for deployment in candidates if deployment.throttled_until <= now]
+            if available:
+                deployment = min(available, key=Deployment.score)
+            else:
+                deployment = min(candidates, key=lambda deployment: deployment.throttled_until)
+            deployment.in_flight += 1
+            deployment.requests += 1
+            return deployment
+
+    @staticmethod
+    def rewrite(request: httpx.Request, deployment: Deployment) -> httpx.Request:
+        """The request sent to the deployment instead of the one the client was configured with."""
+        base = httpx.URL(deployment.url)
+        path = DEPLOYMENT_PATH.sub(f"/openai/deployments/{deployment.deployment}/", request.url.path)
+        url = request.url.copy_with(scheme=base.scheme, host=base.host, port=base.port, path=path)
+        headers = request.headers.copy()
+        headers["host"] = url.netloc.decode("ascii")
+        if deployment.api_key:
+            headers["api-key"] = deployment.api_key
+        return httpx.Request(
+            request.method,
+            url,
+            headers=headers,
+            stream=request.stream,
+            extensions=request.extensions,
+        )
+
+    def record(self, deployment: Deployment, seconds: float, response: httpx.Response | None) -> bool:
+        """Update the health of the deployment after the response headers or a transport error (response None).
+        Returns whether the deployment was throttled."""
+        throttled = response is not None and response.status_code == 429
+        failed = response is None or response.status_code >= 500
+        with self._lock:
+            deployment.in_flight -= 1
+            if throttled:
+                deployment.throttled += 1
+                deployment.throttled_until = time.time() + retry_after(response)  # type: ignore[arg-type]
+            else:
+                previous = deployment.latency or seconds
+                deployment.latency = (1 - EWMA_WEIGHT) * previous + EWMA_WEIGHT * seconds
+            deployment.error_rate = (1 - EWMA_WEIGHT) * deployment.error_rate + EWMA_WEIGHT * (failed or throttled)
+            if response is not None:
+                remaining_requests = header_int(response, "x-ratelimit-remaining-requests")
+                remaining_tokens = header_int(response, "x-ratelimit-remaining-tokens")
+                if remaining_requests is not None:
+                    deployment.remaining_requests = remaining_requests
+                    deployment.max_remaining_requests = max(deployment.max_remaining_requests, remaining_requests)
+                if remaining_tokens is not None:
+                    deployment.remaining_tokens = remaining_tokens
+                    deployment.max_remaining_tokens = max(deployment.max_remaining_tokens, remaining_tokens)
+        if throttled:
+            logger.warning(f"Deployment {deployment.name} of {self.name} is throttled, trying the next deployment.")
+        return throttled
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                deployment.name: {
+                    "requests": deployment.requests,
+                    "in_flight": deployment.in_flight,
+                    "latency_seconds": deployment.latency,
+                    "error_rate": deployment.error_rate,
+                    "throttled": deployment.throttled,
+                    "headroom": deployment.headroom(),
+                }
+                for deployment in self.deployments
+            }
+
+
+class RoutingTransport(httpx.BaseTransport):
+    def __init__(self, router: DeploymentRouter, transport: httpx.BaseTransport) -> None:
+        self.router = router
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        tried: set[str] = set()
+        while (deployment := self.router.choose(tried)) is not None:
+            tried.add(deployment.name)
+            start = time.perf_counter()
+            try:
+                response = self.transport.handle_request(self.router.rewrite(request, deployment))
+            except httpx.TransportError:
+                self.router.record(deployment, time.perf_counter() - start, None)
+                raise
+            throttled = self.router.record(deployment, time.perf_counter() - start, response)
+            # the last 429 is returned, the SDK retries it after its backoff
+            if not throttled or len(tried) == len(self.router.deployments):
+                return response
+            response.close()
+        raise RuntimeError(f"The deployment router {self.router.name} has no deployments.")
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRoutingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, router: DeploymentRouter, transport: httpx.AsyncBaseTransport) -> None:
+        self.router = router
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        tried: set[str] = set()
+        while (deployment := self.router.choose(tried)) is not None:
+            tried.add(deployment.name)
+            start = time.perf_counter()
+            try:
+                response = await self.transport.handle_async_request(self.router.rewrite(request, deployment))
+            except httpx.TransportError:
+                self.router.record(deployment, time.perf_counter() - start, None)
+                raise
+            throttled = self.router.record(deployment, time.perf_counter() - start, response)
+            # the last 429 is returned, the SDK retries it after its backoff
+            if not throttled or len(tried) == len(self.router.deployments):
+                return response
+            await response.aclose()
+        raise RuntimeError(f"The deployment router {self.router.name} has no deployments.")
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class DeploymentRouters:
+    """The routers of the models with several deployments, configured from the environment on first use."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._routers: dict[str, DeploymentRouter | None] = {}
+
+    def get(self, name: str) -> DeploymentRouter | None:
+        """The router of "gpt4" or "embedder", None if the model has a single deployment."""
+        with self._lock:
+            if name not in self._routers:
+                config = {
+                    "gpt4": env.AZURE_OPENAI_GPT4_DEPLOYMENTS,
+                    "embedder": env.AZURE_OPENAI_EMBEDDER_DEPLOYMENTS,
+                }[name]
+                self._routers[name] = DeploymentRouter.from_config(name, config) if config else None
+            return self._routers[name]
+
+    def stats(self) -> dict:
+        with self._lock:
+            routers = [router for router in self._routers.values() if router is not None]
+        return {router.name: router.stats() for router in routers}
+
+
+deployment_routers = DeploymentRouters()
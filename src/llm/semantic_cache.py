@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from langfuse.decorators import observe
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    MatchValue,
+    PointStruct,
+    Range,
+    VectorParams,
+)
+
+from src.llm.timing import SEMANTIC_CACHE, timed
+from src.vectordb.qdrant import VectorDBQdrant
+
+ANSWER_CACHE_COLLECTION = "web_assistant_answer_cache"
+MAX_IN_MEMORY_ENTRIES = 2000
+
+logger = logging.getLogger("api")
+
+
+def cache_scope(course_id: int | None, module_id: int | None, model: str, language: str) -> str:
+    """Answers are only reused within the same course, module, model and user language."""
+    return f"course={course_id}|module={module_id}|model={model}|language={language}"
+
+
+def normalize(embedding: list[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class InMemoryCacheBackend:
+    """Keeps the cached answers of this worker process in memory. The oldest entries are evicted first."""
+
+    def __init__(self, max_entries: int = MAX_IN_MEMORY_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # entry id -> (scope, normalized embedding, answer, created_at)
+        self._entries: OrderedDict[str, tuple[str, np.ndarray, str, float]] = OrderedDict()
+
+    async def lookup(self, embedding: list[float], scope: str, threshold: float, ttl: float) -> str | None:
+        query = normalize(embedding)
+        oldest_allowed = time.time() - ttl
+        with self._lock:
+            candidates = [
+                (vector, answer)
+                for entry_scope, vector, answer, created_at in self._entries.values()
+                if entry_scope == scope and created_at >= oldest_allowed
+            ]
+        if not candidates:
+            return None
+        similarities = np.stack([vector for vector, _ in candidates]) @ query
+        best = int(np.argmax(similarities))
+        return candidates[best][1] if similarities[best] >= threshold else None
+
+    async def store(self, embedding: list[float], scope: str, answer: str) -> None:
+        with self._lock:
+            self._entries[str(uuid.uuid4())] = (scope, normalize(embedding), answer, time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class QdrantCacheBackend:
+    """Keeps the cached answers in a Qdrant side collection, shared by all workers and replicas.
+
+    All calls use the async client of the vector database, in memory mode the sync client has a separate storage.
+    The collection is deleted by the loaders when they rebuild the knowledge base (see src/loaders/get_data.py), so
+    clear() only forgets that the collection exists. Deleting it here would drop the answers of all other workers."""
+
+    def __init__(self, vector_db: VectorDBQdrant, collection_name: str = ANSWER_CACHE_COLLECTION) -> None:
+        self.vector_db = vector_db
+        self.collection_name = collection_name
+        self._collection_ready = False
+
+    async def lookup(self, embedding: list[float], scope: str, threshold: float, ttl: float) -> str | None:
+        try:
+            results = await self.vector_db.aclient.search(
+                collection_name=self.collection_name,
+                query_vector=embedding,
+                query_filter=Filter(
+                    must=[
+                        FieldCondition(key="scope", match=MatchValue(value=scope)),
+                        FieldCondition(key="created_at", range=Range(gte=time.time() - ttl)),
+                    ]
+                ),
+                limit=1,
+                score_threshold=threshold,
+                with_payload=["answer"],
+            )
+        except UnexpectedResponse as e:
+            # The collection does not exist before the first answer is stored
+            if e.status_code == 404:
+                return None
+            raise
+        if not results or results[0].payload is None:
+            return None
+        return results[0].payload["answer"]
+
+    async def store(self, embedding: list[float], scope: str, answer: str) -> None:
+        if not self._collection_ready:
+            if not await self.vector_db.aclient.collection_exists(self.collection_name):
+                await self.vector_db.aclient.create_collection(
+                    collection_name=self.collection_name,
+                    vectors_config=VectorParams(size=len(embedding), distance=Distance.COSINE),
+                )
+            self._collection_ready = True
+        try:
+            await self.vector_db.aclient.upsert(
+                collection_name=self.collection_name,
+                points=[
+                    PointStruct(
+                        id=str(uuid.uuid4()),
+                        vector=embedding,
+                        payload={"scope": scope, "answer": answer, "created_at": time.time()},
+                    )
+                ],
+                wait=False,
+            )
+        except Exception:
+            # e.g. the collection was deleted or recreated by the loaders, the next store checks it again
+            self._collection_ready = False
+            raise
+
+    def clear(self) -> None:
+        self._collection_ready = False
+
+
+class SemanticCache:
+    """Reuses answers of earlier questions that are semantically close to the current one.
+
+    Answers are looked up by the embedding of the contextualized query within the same course, module, model and
+    language. A stored answer is returned when its cosine similarity reaches the threshold. The cache has to be
+    invalidated when the knowledge base changes."""
+
+    def __init__(self, backend: InMemoryCacheBackend | QdrantCacheBackend, threshold: float, ttl: float) -> None:
+        self.backend = backend
+        self.threshold = threshold
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    @observe()
+    @timed(SEMANTIC_CACHE)
+    async def lookup(
+        self, embedding: list[float], course_id: int | None, module_id: int | None, model: str, language: str
+    ) -> str | None:
+        try:
+            answer = await self.backend.lookup(
+                embedding, cache_scope(course_id, module_id, model, language), self.threshold, self.ttl
+            )
+        except Exception:
+            logger.exception("Semantic cache lookup failed, answering without cache.")
+            answer = None
+
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    @timed(SEMANTIC_CACHE)
+    async def store(
+        self,
+        embedding: list[float],
+        course_id: int | None,
+        module_id: int | None,
+        model: str,
+        language: str,
+        answer: str,
+    ) -> None:
+        try:
+            await self.backend.store(embedding, cache_scope(course_id, module_id, model, language), answer)
+            self.stores += 1
+        except Exception:
+            logger.exception("Storing the answer in the semantic cache failed.")
+
+    def invalidate(self) -> None:
+        """Remove all cached answers, e.g. after the knowledge base collection was rebuilt."""
+        try:
+            self.backend.clear()
+            self.invalidations += 1
+            logger.info("Semantic cache invalidated.")
+        except Exception:
+            logger.exception("Invalidating the semantic cache failed.")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,224 @@
+import json
+import threading
+from dataclasses import dataclass, field
+
+from langfuse.decorators import observe
+from llama_index.core.schema import TextNode
+
+from src.llm.LLMs import Models
+from src.llm.timing import record_source_tokens
+from src.llm.tokens import count_tokens, truncate_to_tokens
+
+SOURCE_TEMPLATE = """
+[doc{index}]
+Content: {content}
+Metadata: {metadata}
+"""
+SOURCES_HEADER = "<SOURCES>:\n"
+# similarity of a retrieved source to the query, kept in the metadata but not shown to the LLM
+SCORE_METADATA_KEY = "score"
+# metadata fields the system prompt refers to and their names in the prompt, "fullname" is the title in Moodle, the
+# language is "language" in Moodle and "lang" in Moochup
+PROMPT_METADATA_KEYS = {
+    "title": "title",
+    "fullname": "title",
+    "type": "type",
+    "language": "language",
+    "lang": "language",
+    "date_created": "date_created",
+}
+# separates chunks of the same source that are not adjacent in the document
+GAP_MARKER = "\n[…]\n"
+DEFAULT_TOKEN_BUDGET = 2000
+# a single source may fill at most this share of the budget, so that the next best sources still fit
+MAX_SOURCE_SHARE = 0.5
+# truncated sources shorter than this are left out, they rarely contain a complete statement
+MIN_SOURCE_TOKENS = 80
+
+
+@dataclass
+class PackedSources:
+    """The sources that fit into the prompt. [docN] in the prompt refers to nodes[N - 1]."""
+
+    nodes: list[TextNode] = field(default_factory=list)
+    text: str = SOURCES_HEADER
+    tokens: int = 0
+    # tokens of the retrieved chunks with their complete metadata, that were not sent
+    tokens_saved: int = 0
+    # chunks that were merged into another chunk of the same source
+    merged: int = 0
+    truncated: int = 0
+    dropped: int = 0
+
+
+def source_score(node: TextNode, rank: int) -> float:
+    """The similarity to the query, or a value that decreases with the rank if the similarity is unknown."""
+    score = node.metadata.get(SCORE_METADATA_KEY)
+    return float(score) if score is not None else 1.0 / (rank + 1)
+
+
+def prompt_metadata(node: TextNode) -> str:
+    """Only the metadata fields the prompt needs. The url is added by the CitationParser, ids are of no use to the
+    LLM."""
+    metadata = {}
+    for key, name in PROMPT_METADATA_KEYS.items():
+        value = node.metadata.get(key)
+        if value is not None and name not in metadata:
+            metadata[name] = value
+    return json.dumps(metadata, ensure_ascii=False)
+
+
+def format_source(node: TextNode, index: int, content: str) -> str:
+    return SOURCE_TEMPLATE.format(index=index, content=content, metadata=prompt_metadata(node))
+
+
+def retrieved_tokens(sources: list[TextNode], model: Models) -> int:
+    """Tokens of the retrieved chunks, each with its complete metadata as it was stored."""
+    return sum(
+        count_tokens(
+            SOURCE_TEMPLATE.format(
+                index=index + 1,
+                content=node.get_content(),
+                metadata={key: value for key, value in node.metadata.items() if key != SCORE_METADATA_KEY},
+            ),
+            model,
+        )
+        for index, node in enumerate(sources)
+    )
+
+
+def source_key(node: TextNode) -> str:
+    """Chunks with the same url are the same source for the user, even if they were split from different documents."""
+    url = node.metadata.get("url")
+    return f"url:{url}" if url else f"document:{node.ref_doc_id or node.node_id}"
+
+
+def merge_chunks(chunks: list[TextNode]) -> str:
+    """Join the chunks in document order. The overlap of adjacent chunks (SentenceSplitter chunk_overlap) is only kept
+    once, chunks that are not adjacent are separated by a gap marker."""
+    chunks = sorted(chunks, key=lambda chunk: (chunk.ref_doc_id or "", chunk.start_char_idx or 0))
+    text = chunks[0].get_content()
+    previous = chunks[0]
+    end = previous.end_char_idx
+    for chunk in chunks[1:]:
+        content = chunk.get_content()
+        if content in text:
+            continue
+        start, overlap = chunk.start_char_idx, None
+        if chunk.ref_doc_id == previous.ref_doc_id and start is not None and end is not None and start <= end:
+            overlap = end - start
+        if overlap is not None and text.endswith(content[:overlap]):
+            text += content[overlap:]
+            end = max(end or 0, chunk.end_char_idx or 0)
+        else:
+            text += GAP_MARKER + content
+            end = chunk.end_char_idx
+        previous = chunk
+    return text
+
+
+def consolidate_sources(sources: list[TextNode]) -> list[TextNode]:
+    """Merge the retrieved chunks of the same source into one node with the metadata and score of its best chunk.
+
+    Sources keep the order of their first chunk, which is their best one, since the retrieved chunks are ordered by
+    similarity. A source that was retrieved as a single chunk is returned unchanged."""
+    groups: dict[str, list[TextNode]] = {}
+    for node in sources:
+        groups.setdefault(source_key(node), []).append(node)
+
+    consolidated = []
+    for chunks in groups.values():
+        if len(chunks) == 1:
+            consolidated.append(chunks[0])
+            continue
+        best = max(enumerate(chunks), key=lambda item: source_score(item[1], item[0]))[1]
+        consolidated.append(
+            TextNode(
+                text=merge_chunks(chunks),
+                metadata=dict(best.metadata),
+                excluded_llm_metadata_keys=list(best.excluded_llm_metadata_keys),
+                excluded_embed_metadata_keys=list(best.excluded_embed_metadata_keys),
+            )
+        )
+    return consolidated
+
+
+class SourcePacker:
+    """Fills the token budget of the model with the retrieved sources, the most similar sources first.
+
+    Chunks of the same source are merged first (see consolidate_sources) and only the metadata the prompt refers to
+    is rendered. Token counts use the tokenizer of the model (see src/llm/tokens.py), so the budget holds for every
+    model. A source that does not fit completely is truncated to the remaining budget, and smaller sources after it
+    can still fit. The sources are numbered in the order of their score, the returned nodes have to be passed to the
+    CitationParser so that the [docN] references resolve to the same sources."""
+
+    def __init__(self, token_budgets: dict[str, int]) -> None:
+        self.token_budgets = token_budgets
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.tokens_sent = 0
+        self.tokens_saved = 0
+        self.merged = 0
+        self.truncated = 0
+        self.dropped = 0
+
+    def budget(self, model: Models) -> int:
+        return self.token_budgets.get(model.value, DEFAULT_TOKEN_BUDGET)
+
+    @observe(capture_input=False, capture_output=False)
+    def pack(self, sources: list[TextNode], model: Models) -> PackedSources:
+        budget = self.budget(model)
+        max_source_tokens = int(budget * MAX_SOURCE_SHARE)
+        consolidated = consolidate_sources(sources)
+        ranked = sorted(enumerate(consolidated), key=lambda item: source_score(item[1], item[0]), reverse=True)
+
+        packed = PackedSources(merged=len(sources) - len(consolidated))
+        remaining = budget - count_tokens(SOURCES_HEADER, model)
+        entries = []
+        for _, node in ranked:
+            content = node.get_content()
+            index = len(packed.nodes) + 1
+            entry = format_source(node, index, content)
+            entry_tokens = count_tokens(entry, model)
+
+            limit = min(remaining, max_source_tokens)
+            if entry_tokens > limit:
+                overhead = entry_tokens - count_tokens(content, model)
+                if limit - overhead < MIN_SOURCE_TOKENS:
+                    packed.dropped += 1
+                    continue
+                entry = format_source(node, index, truncate_to_tokens(content, limit - overhead, model))
+                entry_tokens = count_tokens(entry, model)
+                packed.truncated += 1
+
+            packed.nodes.append(node)
+            entries.append(entry.strip())
+            remaining -= entry_tokens
+            packed.tokens += entry_tokens
+
+        packed.text = SOURCES_HEADER + "\n\n".join(entries)
+        packed.tokens_saved = max(retrieved_tokens(sources, model) - packed.tokens, 0)
+        self._record(packed)
+        return packed
+
+    def _record(self, packed: PackedSources) -> None:
+        record_source_tokens(packed.tokens, packed.tokens_saved)
+        with self._lock:
+            self.requests += 1
+            self.tokens_sent += packed.tokens
+            self.tokens_saved += packed.tokens_saved
+            self.merged += packed.merged
+            self.truncated += packed.truncated
+            self.dropped += packed.dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "merged": self.merged,
+                "truncated": self.truncated,
+                "dropped": self.dropped,
+                "mean_tokens_sent": self.tokens_sent / self.requests if self.requests else 0.0,
+                "mean_tokens_saved": self.tokens_saved / self.requests if self.requests else 0.0,
+            }
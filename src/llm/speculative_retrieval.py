@@ -0,0 +1,75 @@
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+
+@dataclass
+class SpeculativeResult:
+    """Sources retrieved for the raw user query, before it was contextualized."""
+
+    embedding: list[float]
+    nodes: list[TextNode]
+    embed_seconds: float
+    search_seconds: float
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    a_vector, b_vector = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    norm = np.linalg.norm(a_vector) * np.linalg.norm(b_vector)
+    return float(a_vector @ b_vector / norm) if norm > 0 else 0.0
+
+
+class SpeculativeRetrieval:
+    """Decides whether the sources retrieved for the raw query are used for the contextualized query.
+
+    With a chat history, the query is contextualized by an LLM before the sources can be retrieved. Often the query
+    comes back unchanged or nearly unchanged, so the raw query is embedded and searched while the LLM runs. The
+    speculative sources are kept if the contextualized query is identical or its embedding reaches the cosine
+    similarity threshold, otherwise they are discarded and the contextualized query is searched as usual."""
+
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self._lock = threading.Lock()
+
+        self.identical = 0
+        self.similar = 0
+        self.discarded = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def is_identical(query: str, rag_query: str) -> bool:
+        return normalize_query(query) == normalize_query(rag_query)
+
+    def is_similar(self, speculative_embedding: list[float], embedding: list[float]) -> bool:
+        return cosine_similarity(speculative_embedding, embedding) >= self.threshold
+
+    def record(self, kept: bool, identical: bool = False, seconds_saved: float = 0.0) -> None:
+        with self._lock:
+            if not kept:
+                self.discarded += 1
+                return
+            if identical:
+                self.identical += 1
+            else:
+                self.similar += 1
+            self.seconds_saved += max(seconds_saved, 0.0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            kept = self.identical + self.similar
+            attempts = kept + self.discarded
+            return {
+                "attempts": attempts,
+                "identical": self.identical,
+                "similar": self.similar,
+                "discarded": self.discarded,
+                "hit_rate": kept / attempts if attempts else 0.0,
+                "seconds_saved": self.seconds_saved,
+                "mean_seconds_saved": self.seconds_saved / kept if kept else 0.0,
+            }
@@ -0,0 +1,124 @@
+import asyncio
+import contextvars
+import inspect
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+
+from src.llm.timing import current_timings
+
+# threads shared by the synchronous stage graphs of a worker. A stage only waits for stages that were submitted before
+# it, which have a thread already, so a full pool delays stages but cannot deadlock.
+MAX_STAGE_THREADS = 32
+stage_executor = ThreadPoolExecutor(max_workers=MAX_STAGE_THREADS, thread_name_prefix="stage")
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable[..., Any]
+    # names of the stages whose results are passed to the function, in this order
+    after: tuple[str, ...]
+
+
+class StageGraph:
+    """Runs the stages of a chat turn as soon as the stages they depend on are done, so that independent stages overlap.
+
+    A stage is a function that gets the results of the stages it runs after as positional arguments. All stages start
+    when the graph is entered and their results are collected with result() or aresult(). Stages whose result was not
+    needed (e.g. the vector search after a semantic cache hit) are cancelled when the graph is left.
+
+    Entered with `async with`, coroutine functions run as tasks and plain functions in a thread (e.g. the CPU-bound
+    language detection). Entered with `with`, every stage runs in a thread of stage_executor, so only plain functions
+    are allowed.
+
+    The start and end of every finished stage are kept in spans, and the critical path, i.e. the chain of stages that
+    determined when the last stage finished, is added to the timings of the current request."""
+
+    def __init__(self) -> None:
+        self._stages: dict[str, Stage] = {}
+        self._start = 0.0
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._futures: dict[str, Future] = {}
+        # stage -> (start, end) in seconds since the graph was entered
+        self.spans: dict[str, tuple[float, float]] = {}
+
+    def add(self, name: str, function: Callable[..., Any], after: Sequence[str] = ()) -> None:
+        """Add a stage. The stages it runs after must have been added before, so the graph cannot have cycles."""
+        unknown = [dependency for dependency in after if dependency not in self._stages]
+        if unknown:
+            raise ValueError(f"Stage '{name}' runs after unknown stages {unknown}")
+        if name in self._stages:
+            raise ValueError(f"Stage '{name}' was already added")
+        self._stages[name] = Stage(name=name, function=function, after=tuple(after))
+
+    async def __aenter__(self) -> "StageGraph":
+        self._start = time.perf_counter()
+        self.spans = {}
+        # tasks copy the current context, so that tracing and timings of the stages belong to the current request
+        self._tasks = {name: asyncio.create_task(self._arun(stage)) for name, stage in self._stages.items()}
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        # retrieves the exceptions of stages whose result was not awaited
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._record_critical_path()
+
+    async def aresult(self, name: str) -> Any:
+        # shielded, so that a cancelled caller does not cancel a stage that other stages wait for
+        return await asyncio.shield(self._tasks[name])
+
+    async def _arun(self, stage: Stage) -> Any:
+        arguments = [await asyncio.shield(self._tasks[dependency]) for dependency in stage.after]
+        start = time.perf_counter()
+        if inspect.iscoroutinefunction(stage.function):
+            result = await stage.function(*arguments)
+        else:
+            result = await asyncio.to_thread(stage.function, *arguments)
+        self.spans[stage.name] = (start - self._start, time.perf_counter() - self._start)
+        return result
+
+    def __enter__(self) -> "StageGraph":
+        self._start = time.perf_counter()
+        self.spans = {}
+        self._futures = {}
+        # stages are submitted in the order they were added, so the futures of their dependencies already exist
+        for name, stage in self._stages.items():
+            self._futures[name] = stage_executor.submit(contextvars.copy_context().run, self._run, stage)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # stages that did not start yet are cancelled, running ones finish in the background
+        for future in self._futures.values():
+            future.cancel()
+        self._record_critical_path()
+
+    def result(self, name: str) -> Any:
+        return self._futures[name].result()
+
+    def _run(self, stage: Stage) -> Any:
+        arguments = [self._futures[dependency].result() for dependency in stage.after]
+        start = time.perf_counter()
+        result = stage.function(*arguments)
+        self.spans[stage.name] = (start - self._start, time.perf_counter() - self._start)
+        return result
+
+    def critical_path(self) -> list[str]:
+        if not self.spans:
+            return []
+        name = max(self.spans, key=lambda finished: self.spans[finished][1])
+        path = [name]
+        while True:
+            dependencies = [dependency for dependency in self._stages[name].after if dependency in self.spans]
+            if not dependencies:
+                return path[::-1]
+            name = max(dependencies, key=lambda dependency: self.spans[dependency][1])
+            path.append(name)
+
+    def _record_critical_path(self) -> None:
+        timings = current_timings()
+        if timings is not None:
+            timings.critical_path = self.critical_path()
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable
+
+from llama_index.core.llms import ChatResponse
+
+# weight of the newest value in the moving averages
+EWMA_WEIGHT = 0.1
+
+ChatStream = AsyncIterator[ChatResponse]
+
+
+class StreamTimeout(TimeoutError):
+    """The model did not send its first token in time or stopped sending tokens."""
+
+    def __init__(self, message: str, first_token: bool) -> None:
+        super().__init__(message)
+        self.first_token = first_token
+
+
+@dataclass
+class StreamedAnswer:
+    text: str
+    time_to_first_token: float
+    seconds: float
+    # OpenAI compatible APIs send one token per chunk
+    chunks: int
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        generating = self.seconds - self.time_to_first_token
+        return (self.chunks - 1) / generating if self.chunks > 1 and generating > 0 else None
+
+
+async def afirst_token(
+    start_stream: Callable[[], Awaitable[ChatStream]], timeout: float | None
+) -> tuple[ChatStream, ChatResponse | None]:
+    """Start the stream and wait for the first chunk with content. Empty chunks, e.g. the role of the message, do not
+    count as first token."""
+
+    async def first() -> tuple[ChatStream, ChatResponse | None]:
+        stream = await start_stream()
+        async for chunk in stream:
+            if chunk.delta:
+                return stream, chunk
+        return stream, None
+
+    try:
+        return await asyncio.wait_for(first(), timeout)
+    except asyncio.TimeoutError as e:
+        raise StreamTimeout(f"No first token after {timeout} seconds.", first_token=True) from e
+
+
+async def acollect(
+    start_stream: Callable[[], Awaitable[ChatStream]], first_token_timeout: float | None, stall_timeout: float | None
+) -> StreamedAnswer:
+    """The complete answer of the stream. Raises StreamTimeout if the first token takes longer than
+    first_token_timeout or two tokens are more than stall_timeout apart, however long the answer is."""
+    start = time.perf_counter()
+    stream, chunk = await afirst_token(start_stream, first_token_timeout)
+    time_to_first_token = time.perf_counter() - start
+    deltas = []
+    while chunk is not None:
+        if chunk.delta:
+            deltas.append(chunk.delta)
+        try:
+            chunk = await asyncio.wait_for(anext(stream, None), stall_timeout)
+        except asyncio.TimeoutError as e:
+            message = f"No token for {stall_timeout} seconds after {len(deltas)} tokens."
+            raise StreamTimeout(message, first_token=False) from e
+    return StreamedAnswer("".join(deltas), time_to_first_token, time.perf_counter() - start, len(deltas))
+
+
+class StreamStats:
+    """Moving averages of the time to first token and the tokens per second of every model."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._models: dict[str, dict[str, float]] = {}
+
+    def _model(self, model: str) -> dict[str, float]:
+        if model not in self._models:
+            self._models[model] = {
+                "answers": 0,
+                "time_to_first_token": 0.0,
+                "tokens_per_second": 0.0,
+                "first_token_timeouts": 0,
+                "stalls": 0,
+            }
+        return self._models[model]
+
+    @staticmethod
+    def _average(stats: dict[str, float], key: str, value: float) -> None:
+        stats[key] = value if not stats[key] else (1 - EWMA_WEIGHT) * stats[key] + EWMA_WEIGHT * value
+
+    def record(self, model: str, answer: StreamedAnswer) -> None:
+        with self._lock:
+            stats = self._model(model)
+            stats["answers"] += 1
+            self._average(stats, "time_to_first_token", answer.time_to_first_token)
+            if answer.tokens_per_second is not None:
+                self._average(stats, "tokens_per_second", answer.tokens_per_second)
+
+    def record_timeout(self, model: str, first_token: bool) -> None:
+        with self._lock:
+            self._model(model)["first_token_timeouts" if first_token else "stalls"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {model: dict(stats) for model, stats in self._models.items()}
+
+
+stream_stats = StreamStats()
@@ -0,0 +1,158 @@
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+# Stages of a chat turn, in the order in which they run
+# folds the older turns of a long chat history into a summary
+SUMMARIZE_HISTORY = "summarize_history"
+CONTEXTUALIZE = "contextualize"
+# embeds and searches the raw query while it is contextualized, off the critical path
+SPECULATIVE_RETRIEVAL = "speculative_retrieval"
+EMBED = "embed"
+LANGUAGE_DETECTION = "language_detection"
+SEMANTIC_CACHE = "semantic_cache"
+VECTOR_SEARCH = "vector_search"
+LLM_ANSWER = "llm_answer"
+CITATION_PARSE = "citation_parse"
+QUEUE = "queue"
+TOTAL = "total"
+
+
+class RequestTimings:
+    """Durations of the stages of one request in seconds. A stage that runs several times is summed up."""
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.fallback = False
+        self.stages: dict[str, float] = {}
+        # stages before the answer that determined its start, see StageGraph
+        self.critical_path: list[str] = []
+        # tokens of the sources in the prompt and of the retrieved sources left out, see SourcePacker
+        self.source_tokens: tuple[int, int] | None = None
+        self._start = time.perf_counter()
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self) -> None:
+        self.stages[TOTAL] = time.perf_counter() - self._start
+
+    def server_timing(self) -> str:
+        """Format the stages as value of a Server-Timing header, e.g. 'contextualize;dur=512.3, total;dur=2301.0'."""
+        metrics = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        if self.critical_path:
+            metrics.append(f'critical_path;desc="{">".join(self.critical_path)}"')
+        if self.source_tokens is not None:
+            metrics.append(f'source_tokens;desc="sent={self.source_tokens[0]} saved={self.source_tokens[1]}"')
+        if self.fallback:
+            metrics.append('fallback;desc="GPT-4"')
+        return ", ".join(metrics)
+
+
+_current_timings: ContextVar[RequestTimings | None] = ContextVar("request_timings", default=None)
+
+
+def current_timings() -> RequestTimings | None:
+    return _current_timings.get()
+
+
+@contextmanager
+def track_request(model: str) -> Iterator[RequestTimings]:
+    """Collect the stage timings of everything that runs within this context, including tasks started from it."""
+    timings = RequestTimings(model)
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        timings.finish()
+        _current_timings.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Add the duration of the block to the stage of the current request. Does nothing outside of a request."""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def mark_fallback() -> None:
+    """Record that the request was answered by GPT-4 instead of the requested model."""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.fallback = True
+
+
+def record_source_tokens(sent: int, saved: int) -> None:
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.source_tokens = (sent, saved)
+
+
+def timed(name: str) -> Callable:
+    """Decorator that adds the duration of a function to a stage. For generators only the time spent in the generator
+    counts, not the time the caller spends between two items."""
+
+    def decorator(function: Callable) -> Callable:
+        if inspect.isasyncgenfunction(function):
+
+            @functools.wraps(function)
+            async def async_generator_wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                try:
+                    while True:
+                        with stage(name):
+                            try:
+                                item = await anext(generator)
+                            except StopAsyncIteration:
+                                return
+                        yield item
+                finally:
+                    await generator.aclose()
+
+            return async_generator_wrapper
+
+        if inspect.isgeneratorfunction(function):
+
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                try:
+                    while True:
+                        with stage(name):
+                            try:
+                                item = next(generator)
+                            except StopIteration:
+                                return
+                        yield item
+                finally:
+                    generator.close()
+
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def coroutine_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await function(*args, **kwargs)
+
+            return coroutine_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,45 @@
+import math
+from functools import lru_cache
+from typing import Callable
+
+from llama_index.core.llms import ChatMessage
+from llama_index.core.utils import get_tokenizer
+
+from src.llm.LLMs import Models
+
+# The tokenizers of the open models are not available offline, their token counts are estimated from cl100k_base.
+# Mistral's 32k vocabulary splits German text into noticeably more tokens, Llama 3 and Qwen 2 have large vocabularies
+# similar to cl100k_base. The factors are deliberately on the high side, so that a budget is not exceeded.
+TOKENIZER_FACTORS = {Models.GPT4: 1.0, Models.MISTRAL8: 1.3, Models.LLAMA3: 1.05, Models.QWEN2: 1.1}
+# role and separators that the chat templates add to every message
+TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=1)
+def _tokenizer() -> Callable[[str], list[int]]:
+    """cl100k_base, loaded from the tiktoken cache that ships with llama_index."""
+    return get_tokenizer()
+
+
+def count_tokens(text: str, model: Models = Models.GPT4) -> int:
+    return math.ceil(len(_tokenizer()(text)) * TOKENIZER_FACTORS.get(model, 1.0))
+
+
+def count_message_tokens(messages: list[ChatMessage], model: Models = Models.GPT4) -> int:
+    return sum(count_tokens(message.content or "", model) + TOKENS_PER_MESSAGE for message in messages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Models = Models.GPT4) -> str:
+    """Cut the text at the last whole word that fits into max_tokens."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    words = text.split(" ")
+    # binary search for the longest prefix of words within the budget
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(" ".join(words[:middle]) + " …", model) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low]) + " …" if low else ""
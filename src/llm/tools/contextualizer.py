@@ -1,7 +1,12 @@
+import asyncio
+
 from langfuse.decorators import observe
 from llama_index.core.llms import ChatMessage
 
+from src.llm.contextualization_cache import ContextualizationCache
 from src.llm.LLMs import LLM, Models
+from src.llm.timing import CONTEXTUALIZE, timed
+from src.llm.tools.standalone_classifier import StandaloneQuestionClassifier
 
 CONDENSE_QUESTION_PROMPT = """
 # CONTEXT #
@@ -35,15 +40,27 @@ Ensure the question is understandable and retrieval-ready.
 class Contextualizer:
     """Contextualizes a message based on the chat history, so that it can effectively used as input for RAG retrieval."""
 
-    def __init__(self):
+    def __init__(
+        self, classifier: StandaloneQuestionClassifier | None = None, cache: ContextualizationCache | None = None
+    ):
         self.llm = LLM()
+        # skips the LLM call for follow-up questions that are self-contained
+        self.classifier = classifier
+        # skips the LLM call for conversations that were contextualized before, e.g. on retries
+        self.cache = cache
 
     @observe()
+    @timed(CONTEXTUALIZE)
     def contextualize(self, query: str, chat_history: list[ChatMessage], model: Models) -> str:
         """Contextualize a message based on the chat history, so that it can effectively used as input for RAG retrieval."""
 
         if len(chat_history) == 0:
             return query
+        cached = self.cache.get(model, chat_history, query) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        if self.classifier is not None and not self.classifier.needs_context(query, chat_history):
+            return query
 
         contextualized_question = self.llm.chat(
             query=query, chat_history=chat_history, model=model, system_prompt=CONDENSE_QUESTION_PROMPT
@@ -53,4 +70,32 @@ class Contextualizer:
                 f"Contextualized question is None. Please check the LLM implementation. Response: {contextualized_question}"
             )
 
+        if self.cache is not None:
+            self.cache.set(model, chat_history, query, contextualized_question.content)
+        return contextualized_question.content
+
+    @observe()
+    @timed(CONTEXTUALIZE)
+    async def acontextualize(self, query: str, chat_history: list[ChatMessage], model: Models) -> str:
+        """Async variant of contextualize."""
+
+        if len(chat_history) == 0:
+            return query
+        # the shared store is SQLite, its calls must not block the event loop
+        cached = await asyncio.to_thread(self.cache.get, model, chat_history, query) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        if self.classifier is not None and not await self.classifier.aneeds_context(query, chat_history):
+            return query
+
+        contextualized_question = await self.llm.achat(
+            query=query, chat_history=chat_history, model=model, system_prompt=CONDENSE_QUESTION_PROMPT
+        )
+        if contextualized_question.content is None:
+            raise ValueError(
+                f"Contextualized question is None. Please check the LLM implementation. Response: {contextualized_question}"
+            )
+
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.set, model, chat_history, query, contextualized_question.content)
         return contextualized_question.content
@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from langfuse.decorators import observe
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from src.llm.LLMs import LLM, Models
+from src.llm.timing import SUMMARIZE_HISTORY, timed
+from src.llm.tokens import TOKENS_PER_MESSAGE, count_message_tokens, truncate_to_tokens
+
+SUMMARY_PROMPT = """
+You maintain a compact summary of a conversation between a user and the assistant of the KI-Campus, a learning
+platform for artificial intelligence. You get the current summary (it may be empty) followed by the messages that
+happened after it. Return the updated summary.
+
+Keep the courses, modules, topics, names and numbers the user asked about or was given, and the questions that are
+still open. Leave out greetings, sources and wording. Write at most 120 words in the language of the conversation.
+Return only the summary.
+"""
+# The summary is added to the chat history as an exchange, so that user and assistant messages still alternate
+SUMMARY_QUESTION = "Worüber haben wir bisher gesprochen?"
+MAX_SUMMARY_TOKENS = 250
+# upper bound of the kept messages, independent of their length
+MAX_RECENT_MESSAGES = 10
+# The summary is bookkeeping, it is written by the fallback model and not by the slower open models. A summary that
+# takes longer is not waited for, the older messages are dropped and the summary is cached for the next turn.
+SUMMARY_MODEL = Models.GPT4
+SUMMARY_TIMEOUT = 5  # in seconds
+DEFAULT_TOKEN_BUDGET = 1500
+MAX_SUMMARIES = 5000
+
+logger = logging.getLogger("api")
+
+
+def prefix_keys(messages: list[ChatMessage]) -> list[str]:
+    """Hash of every prefix of the messages, keys[i] identifies messages[: i + 1]."""
+    digest = hashlib.sha256()
+    keys = []
+    for message in messages:
+        digest.update(f"{message.role.value}\x1f{message.content or ''}\x1e".encode())
+        keys.append(digest.copy().hexdigest())
+    return keys
+
+
+def format_messages(messages: list[ChatMessage]) -> str:
+    return "\n".join(f"{message.role.value}: {message.content or ''}" for message in messages)
+
+
+class ChatHistorySummarizer:
+    """Keeps the chat history within the token budget of the model.
+
+    The newest turns are kept as long as they fit into the budget, older turns are folded into a rolling summary that
+    is added in front of them. The chat history is sent by the client with every request, so the summary of the folded
+    messages is cached under the hash of these messages and reused for several turns (see split). When more turns are
+    folded, only the new messages are summarized together with the cached summary of the earlier ones. With summarize=False, older turns are dropped.
+    """
+
+    def __init__(self, token_budgets: dict[str, int], summarize: bool = True, max_entries: int = MAX_SUMMARIES):
+        self.llm = LLM()
+        self.token_budgets = token_budgets
+        self.summarize = summarize
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # hash of the folded messages -> summary
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+        # the sync summaries run here, so that they can time out
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="summary")
+        # summaries that timed out and are cached when they finish
+        self._late_summaries: set[asyncio.Future] = set()
+
+        self.reused = 0
+        self.updated = 0
+        self.failed = 0
+        self.folded_messages = 0
+
+    def budget(self, model: Models) -> int:
+        return self.token_budgets.get(model.value, DEFAULT_TOKEN_BUDGET)
+
+    def split(self, chat_history: list[ChatMessage], model: Models) -> tuple[list[ChatMessage], list[ChatMessage]]:
+        """Split the chat history into the messages to fold and the newest turns within the budget. A turn starts with
+        a user message. The newest turn is always kept, its messages are shortened if it exceeds the budget alone.
+
+        Folding uses hysteresis, so that a summary is reused for several turns: the messages folded on an earlier turn
+        are folded again as long as the turns after them fit into the budget. Only when they do not, older turns are
+        folded until the kept turns use half of the budget."""
+        budget = self.budget(model) - MAX_SUMMARY_TOKENS - 2 * TOKENS_PER_MESSAGE
+        turn_starts = [
+            index for index, message in enumerate(chat_history) if message.role == MessageRole.USER or index == 0
+        ]
+        start = self._keep_from(chat_history, turn_starts, budget, MAX_RECENT_MESSAGES, model)
+        if start > 0 and self.summarize:
+            keys = prefix_keys(chat_history)
+            with self._lock:
+                folded_before = [
+                    index for index in turn_starts if index >= start and keys[index - 1] in self._summaries
+                ]
+            if folded_before:
+                start = folded_before[0]
+            else:
+                start = self._keep_from(chat_history, turn_starts, budget // 2, MAX_RECENT_MESSAGES // 2, model)
+        folded, recent = chat_history[:start], chat_history[start:]
+        if count_message_tokens(recent, model) > budget:
+            recent = self._shorten(recent, budget, model)
+        return folded, recent
+
+    @staticmethod
+    def _keep_from(
+        chat_history: list[ChatMessage], turn_starts: list[int], budget: int, max_messages: int, model: Models
+    ) -> int:
+        """Start of the newest turns that fit into the budget and max_messages, at least the newest turn."""
+        start = len(chat_history)
+        used = 0
+        for index in reversed(turn_starts):
+            turn_tokens = count_message_tokens(chat_history[index:start], model)
+            newest = start == len(chat_history)
+            if not newest and (used + turn_tokens > budget or len(chat_history) - index > max_messages):
+                break
+            used += turn_tokens
+            start = index
+        return start
+
+    @staticmethod
+    def _shorten(messages: list[ChatMessage], budget: int, model: Models) -> list[ChatMessage]:
+        per_message = max(budget // max(len(messages), 1) - TOKENS_PER_MESSAGE, 0)
+        return [
+            ChatMessage(role=message.role, content=truncate_to_tokens(message.content or "", per_message, model))
+            for message in messages
+        ]
+
+    @observe()
+    def limit(self, chat_history: list[ChatMessage], model: Models) -> list[ChatMessage]:
+        folded, recent = self.split(chat_history, model)
+        if not folded or not self.summarize:
+            return recent
+        keys = prefix_keys(folded)
+        summary = self._cached(keys[-1])
+        if summary is None:
+            previous, new_messages = self._previous_summary(keys, folded)
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, self._summarize, previous, new_messages, model)
+            future.add_done_callback(self._store_when_done(keys[-1], len(folded)))
+            try:
+                summary = future.result(timeout=SUMMARY_TIMEOUT)
+            except Exception:
+                logger.exception("Summarizing the chat history failed, the older messages are dropped.")
+                return self._record_failure(recent)
+        return self._with_summary(summary, recent)
+
+    @observe()
+    async def alimit(self, chat_history: list[ChatMessage], model: Models) -> list[ChatMessage]:
+        """Async variant of limit."""
+        folded, recent = self.split(chat_history, model)
+        if not folded or not self.summarize:
+            return recent
+        keys = prefix_keys(folded)
+        summary = self._cached(keys[-1])
+        if summary is None:
+            previous, new_messages = self._previous_summary(keys, folded)
+            task = asyncio.ensure_future(self._asummarize(previous, new_messages, model))
+            task.add_done_callback(self._store_when_done(keys[-1], len(folded)))
+            try:
+                # shielded, so that a summary that times out is still cached for the next turn
+                summary = await asyncio.wait_for(asyncio.shield(task), SUMMARY_TIMEOUT)
+            except Exception:
+                logger.exception("Summarizing the chat history failed, the older messages are dropped.")
+                if not task.done():
+                    self._late_summaries.add(task)
+                    task.add_done_callback(self._late_summaries.discard)
+                return self._record_failure(recent)
+        return self._with_summary(summary, recent)
+
+    def _store_when_done(self, key: str, folded_messages: int) -> Callable[[Future | asyncio.Future], None]:
+        def store(future: Future | asyncio.Future) -> None:
+            if not future.cancelled() and future.exception() is None:
+                self._store(key, future.result(), folded_messages)
+
+        return store
+
+    def _cached(self, key: str) -> str | None:
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+                self.reused += 1
+            return summary
+
+    def _previous_summary(self, keys: list[str], folded: list[ChatMessage]) -> tuple[str, list[ChatMessage]]:
+        """The cached summary of the longest folded prefix and the messages after it."""
+        with self._lock:
+            for index in range(len(keys) - 2, -1, -1):
+                if keys[index] in self._summaries:
+                    return self._summaries[keys[index]], folded[index + 1 :]
+        return "", folded
+
+    def _store(self, key: str, summary: str, folded_messages: int) -> None:
+        with self._lock:
+            self._summaries[key] = summary
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+            self.updated += 1
+            self.folded_messages += folded_messages
+
+    def _record_failure(self, recent: list[ChatMessage]) -> list[ChatMessage]:
+        with self._lock:
+            self.failed += 1
+        return recent
+
+    @staticmethod
+    def _summary_query(previous: str, new_messages: list[ChatMessage]) -> str:
+        return f"Current summary:\n{previous or '-'}\n\nNew messages:\n{format_messages(new_messages)}"
+
+    @timed(SUMMARIZE_HISTORY)
+    def _summarize(self, previous: str, new_messages: list[ChatMessage], model: Models) -> str:
+        """model is the model of the chat, its tokenizer limits the length of the summary."""
+        query = self._summary_query(previous, new_messages)
+        response = self.llm.chat(query=query, chat_history=[], model=SUMMARY_MODEL, system_prompt=SUMMARY_PROMPT)
+        return truncate_to_tokens((response.content or "").strip(), MAX_SUMMARY_TOKENS, model)
+
+    @timed(SUMMARIZE_HISTORY)
+    async def _asummarize(self, previous: str, new_messages: list[ChatMessage], model: Models) -> str:
+        query = self._summary_query(previous, new_messages)
+        response = await self.llm.achat(query=query, chat_history=[], model=SUMMARY_MODEL, system_prompt=SUMMARY_PROMPT)
+        return truncate_to_tokens((response.content or "").strip(), MAX_SUMMARY_TOKENS, model)
+
+    @staticmethod
+    def _with_summary(summary: str, recent: list[ChatMessage]) -> list[ChatMessage]:
+        if not summary:
+            return recent
+        return [
+            ChatMessage(role=MessageRole.USER, content=SUMMARY_QUESTION),
+            ChatMessage(role=MessageRole.ASSISTANT, content=summary),
+            *recent,
+        ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.reused + self.updated
+            return {
+                "summaries": len(self._summaries),
+                "reused": self.reused,
+                "updated": self.updated,
+                "failed": self.failed,
+                "reuse_rate": self.reused / lookups if lookups else 0.0,
+                "mean_folded_messages": self.folded_messages / self.updated if self.updated else 0.0,
+            }
@@ -1,16 +1,24 @@
 from langfuse.decorators import observe
 from lingua import Language, LanguageDetectorBuilder
 
+from src.llm.timing import LANGUAGE_DETECTION, timed
+
 
 class LanguageDetector:
-    def __init__(self):
+    def __init__(self, preload_models: bool = False):
+        """Set preload_models to load the language models now instead of on the first detection, e.g. to share them
+        between forked worker processes."""
         languages = [
             Language.ENGLISH,
             Language.GERMAN,
         ]
-        self.detector = LanguageDetectorBuilder.from_languages(*languages).build()
+        builder = LanguageDetectorBuilder.from_languages(*languages)
+        if preload_models:
+            builder = builder.with_preloaded_language_models()
+        self.detector = builder.build()
 
     @observe()
+    @timed(LANGUAGE_DETECTION)
     def detect(self, text: str) -> str:
         language = self.detector.detect_language_of(text)
         if language is None:
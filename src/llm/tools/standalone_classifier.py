@@ -0,0 +1,222 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from langfuse.decorators import observe
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from src.llm.speculative_retrieval import cosine_similarity
+
+if TYPE_CHECKING:
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+
+# Words that refer to something mentioned before: personal and demonstrative pronouns and German pronominal adverbs.
+# Pronouns that are mostly used without a reference ("es gibt", "is there", "Sie" as polite form) are left out.
+REFERENCE_WORDS = {
+    # German
+    "er", "ihn", "ihm", "sie", "ihnen", "ihr", "ihre", "ihren", "ihrem", "ihrer", "seine", "seinen", "seinem",
+    "dies", "diese", "dieser", "dieses", "diesem", "diesen", "jene", "jener", "jenes", "jenem", "jenen",
+    "derselbe", "dieselbe", "dasselbe", "denselben", "demselben", "deren", "dessen",
+    "dabei", "dafür", "dagegen", "damit", "danach", "daran", "darauf", "daraus", "darin", "darüber", "darum",
+    "davon", "davor", "dazu", "dort", "dorthin", "dahin", "ebenda",
+    # English
+    "it", "its", "they", "them", "their", "theirs", "he", "him", "his", "she", "her", "hers",
+    "this", "these", "those", "above", "former", "latter",
+}  # fmt: skip
+# Capitalized within a sentence, these are the polite form of address and do not refer to anything
+POLITE_FORMS = {"Sie", "Ihnen", "Ihr", "Ihre", "Ihren", "Ihrem", "Ihrer"}
+# Phrases that only make sense as continuation of the conversation
+FOLLOW_UP_PHRASES = [
+    "was ist mit", "wie ist es mit", "wie sieht es mit", "und was", "und wie", "und wo", "und wann", "und welche",
+    "noch mehr", "mehr dazu", "genauer", "ausführlicher", "nochmal", "noch einmal", "der erste", "die erste",
+    "das erste", "der zweite", "die zweite", "das zweite", "der letzte", "die letzte", "das letzte", "genannt",
+    "genannte", "genannten", "erwähnt", "erwähnte", "erwähnten", "vorhin", "du hast gesagt", "deine antwort",
+    "wie oben", "von oben",
+    "what about", "how about", "and what", "and how", "and where", "and when", "and which", "tell me more",
+    "more about", "more details", "elaborate", "the first one", "the second one", "the last one", "the other one",
+    "you said", "you mentioned", "your answer", "mentioned", "again", "which one", "that one", "this one",
+    "welcher davon", "welche davon",
+]  # fmt: skip
+FOLLOW_UP_PATTERN = re.compile(r"\b(?:" + "|".join(re.escape(phrase) for phrase in FOLLOW_UP_PHRASES) + r")\b")
+# Words a follow-up question may start with, e.g. "Und für Anfänger?", "Also auf Englisch?"
+FOLLOW_UP_STARTS = {"und", "aber", "oder", "sonst", "auch", "nur", "and", "but", "or", "also", "same", "even", "only"}
+# With a definite article, these refer to an item of an earlier answer, e.g. "über den ersten", "the next one"
+ORDINALS = {
+    "ersten", "erste", "zweiten", "zweite", "dritten", "dritte", "letzten", "letzte", "nächsten", "nächste",
+    "vorherigen", "anderen", "first", "second", "third", "last", "next", "previous", "other",
+}  # fmt: skip
+# German articles that are used as demonstrative pronouns when no noun follows, e.g. "Was kostet das?"
+ARTICLE_PRONOUNS = {"das", "die", "der", "den", "dem"}
+ADJECTIVE_ENDINGS = ("e", "en", "er", "es", "em")
+# Nouns that are ambiguous with a definite article ("der Kurs", "the course") unless the topic is named as well, and
+# nouns that ask for a property of whatever was discussed ("Wie viel Zeit ...?", "Bekomme ich am Ende ...?")
+GENERIC_NOUNS = {
+    "kurs", "kurses", "kurse", "modul", "moduls", "module", "lektion", "video", "videos", "quiz", "test", "prüfung",
+    "aufgabe", "zertifikat", "nachweis", "ende", "zeit", "dauer", "aufwand", "kosten", "gebühr", "voraussetzungen",
+    "course", "courses", "lesson", "exam", "assignment", "certificate", "end", "time", "hours", "week", "weeks",
+    "duration", "effort", "cost", "costs", "fee", "requirements", "prerequisites",
+}  # fmt: skip
+DEFINITE_ARTICLES = {"der", "die", "das", "den", "dem", "des", "im", "am", "zum", "zur", "beim", "vom", "the"}
+STOP_WORDS = {
+    # German
+    "ich", "du", "wir", "man", "mich", "mir", "uns", "ein", "eine", "einen", "einem", "einer", "der", "die", "das",
+    "den", "dem", "des", "und", "oder", "aber", "in", "im", "an", "am", "auf", "aus", "bei", "beim", "mit", "nach",
+    "von", "vom", "zu", "zum", "zur", "für", "über", "um", "ist", "sind", "war", "gibt", "es", "kann", "können",
+    "muss", "müssen", "soll", "habe", "hast", "hat", "haben", "wird", "werden", "bin", "bist", "wie", "was", "wer",
+    "wo", "wann", "warum", "wieso", "welche", "welcher", "welches", "welchen", "nicht", "kein", "keine", "auch",
+    "noch", "schon", "denn", "mal", "bitte", "gerne", "ja", "nein", "so", "sehr", "viel", "viele", "lange", "gut",
+    "mein", "meine", "meinem", "meinen", "meiner", "dein", "deine", "deinem", "deinen", "deiner", "wenn", "ob",
+    "alle", "sollte", "sollten", "würde",
+    # English
+    "i", "you", "we", "me", "my", "a", "an", "the", "and", "or", "but", "of", "on", "for", "to", "from", "with",
+    "about", "is", "are", "was", "do", "does", "did", "can", "could", "should", "have", "has", "there", "what",
+    "who", "where", "when", "why", "how", "which", "not", "no", "yes", "please", "any", "some", "much", "many",
+    "your", "our", "per", "if", "all", "will", "would",
+}  # fmt: skip
+# Questions with fewer content words than this do not name their topic, e.g. "Gibt es ein Zertifikat?"
+MIN_CONTENT_WORDS = 2
+# Questions with fewer content words than this, generic nouns left out, have to name their topic with an acronym or a
+# capitalized word within the sentence (e.g. "Wie viel Zeit sollte ich einplanen?" does not) and must not refer to a
+# generic noun with a definite article
+FEW_TOPIC_WORDS = 3
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+STANDALONE = "standalone"
+REFERENCE = "reference"
+FOLLOW_UP = "follow_up"
+GENERIC_REFERENCE = "generic_reference"
+UNDERSPECIFIED = "underspecified"
+NO_TOPIC = "no_topic"
+
+
+@dataclass
+class Decision:
+    # None if the cues are not conclusive and the similarity to the previous turn has to decide
+    needs_context: bool | None
+    reason: str
+
+
+class StandaloneQuestionClassifier:
+    """Decides without an LLM call whether a follow-up question has to be contextualized with the chat history.
+
+    German and English questions are checked for words that refer to the conversation (pronouns, demonstratives,
+    pronominal adverbs like "dafür"), for follow-up phrases ("Und was ist mit ...?") and for generic nouns with a
+    definite article ("der Kurs") that do not name their topic. A question without such cues that names its topic is
+    self-contained. A question with few content words and no named topic (no acronym and no capitalized word within
+    the sentence that is not a generic noun, e.g. "Bekomme ich am Ende ein Zertifikat?") is contextualized. A question
+    with a single content word (e.g. "Gibt es eine App?") continues the conversation if its embedding is similar to
+    the previous question, otherwise it starts a new topic.
+
+    False positives only cost the LLM call that would have been made anyway, so inconclusive cases are contextualized.
+    See src/benchmarks/standalone_classifier.py for the evaluation on the labelled questions in src/tests/data."""
+
+    def __init__(self, threshold: float, embedder: "BaseEmbedding | None" = None) -> None:
+        self.threshold = threshold
+        self._embedder = embedder
+        self._lock = threading.Lock()
+        # reason -> number of decisions
+        self.decisions: dict[str, int] = {}
+        self.skipped = 0
+
+    @property
+    def embedder(self) -> "BaseEmbedding":
+        if self._embedder is None:
+            from src.llm.LLMs import LLM
+
+            self._embedder = LLM().get_embedder()
+        return self._embedder
+
+    def classify(self, query: str) -> Decision:
+        """Decide based on the wording of the query alone."""
+        words = WORD_PATTERN.findall(query)
+        lowered_words = [word.lower() for word in words]
+        lowered = " ".join(lowered_words)
+
+        if any(word.lower() in REFERENCE_WORDS and word not in POLITE_FORMS for word in words):
+            return Decision(needs_context=True, reason=REFERENCE)
+        if any(self._is_article_pronoun(word, following) for word, following in zip(words, words[1:] + [""])):
+            return Decision(needs_context=True, reason=REFERENCE)
+        if any(
+            word in ORDINALS and previous in DEFINITE_ARTICLES
+            for previous, word in zip(lowered_words, lowered_words[1:])
+        ):
+            return Decision(needs_context=True, reason=REFERENCE)
+        if (lowered_words and lowered_words[0] in FOLLOW_UP_STARTS) or FOLLOW_UP_PATTERN.search(lowered):
+            return Decision(needs_context=True, reason=FOLLOW_UP)
+
+        content_words = [word for word in lowered_words if word not in STOP_WORDS and not word.isdigit()]
+        topic_words = [word for word in content_words if word not in GENERIC_NOUNS]
+        has_generic_reference = any(
+            word in GENERIC_NOUNS and previous in DEFINITE_ARTICLES
+            for previous, word in zip(lowered_words, lowered_words[1:])
+        )
+        if has_generic_reference and len(topic_words) < FEW_TOPIC_WORDS:
+            return Decision(needs_context=True, reason=GENERIC_REFERENCE)
+        if len(content_words) < MIN_CONTENT_WORDS:
+            return Decision(needs_context=None, reason=UNDERSPECIFIED)
+        if len(topic_words) < FEW_TOPIC_WORDS and not self._names_topic(words):
+            return Decision(needs_context=True, reason=NO_TOPIC)
+        return Decision(needs_context=False, reason=STANDALONE)
+
+    @staticmethod
+    def _names_topic(words: list[str]) -> bool:
+        """Acronyms (KI, AI) and capitalized words within the sentence, i.e. German nouns and names, name a topic
+        unless they are generic nouns."""
+        for index, word in enumerate(words):
+            if len(word) > 1 and word.isupper():
+                return True
+            lowered = word.lower()
+            if (
+                index > 0
+                and word[:1].isupper()
+                and word not in POLITE_FORMS
+                and lowered not in GENERIC_NOUNS
+                and lowered not in STOP_WORDS
+            ):
+                return True
+        return False
+
+    @staticmethod
+    def _is_article_pronoun(word: str, following: str) -> bool:
+        """German nouns are capitalized, so an article followed by a lowercase word (except an adjective) or by nothing
+        stands for a noun mentioned before."""
+        if word.lower() not in ARTICLE_PRONOUNS:
+            return False
+        return following == "" or (following[:1].islower() and not following.endswith(ADJECTIVE_ENDINGS))
+
+    @observe()
+    def needs_context(self, query: str, chat_history: list[ChatMessage]) -> bool:
+        """Without embeddings, inconclusive questions are contextualized."""
+        decision = self.classify(query)
+        return self._record(decision, decision.needs_context is not False)
+
+    @observe()
+    async def aneeds_context(self, query: str, chat_history: list[ChatMessage]) -> bool:
+        decision = self.classify(query)
+        if decision.needs_context is not None:
+            return self._record(decision, decision.needs_context)
+
+        previous_question = next(
+            (message.content for message in reversed(chat_history) if message.role == MessageRole.USER), None
+        )
+        if not previous_question:
+            return self._record(decision, True)
+        query_embedding, previous_embedding = await self.embedder.aget_text_embedding_batch([query, previous_question])
+        return self._record(decision, cosine_similarity(query_embedding, previous_embedding) >= self.threshold)
+
+    def _record(self, decision: Decision, needs_context: bool) -> bool:
+        with self._lock:
+            self.decisions[decision.reason] = self.decisions.get(decision.reason, 0) + 1
+            if not needs_context:
+                self.skipped += 1
+        return needs_context
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self.decisions.values())
+            return {
+                "decisions": dict(self.decisions),
+                "skipped": self.skipped,
+                "skip_rate": self.skipped / total if total else 0.0,
+            }
@@ -1,5 +1,3 @@
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
 from pydantic import BaseModel
 
 from src.loaders.models.module import Module
@@ -21,6 +19,9 @@ class FailedTranscripts(BaseModel):
 
 
 def save_failed_transcripts_to_excel(transcripts: FailedTranscripts, file_name: str):
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
     wb = Workbook()
     ws = wb.active
     ws.title = "Fehlgeschlagene Transcripte"
@@ -8,6 +8,7 @@ from qdrant_client.http import models
 
 from src.env import env
 from src.llm.LLMs import LLM
+from src.llm.semantic_cache import ANSWER_CACHE_COLLECTION
 from src.loaders.drupal import Drupal
 from src.loaders.moochup import Moochup
 from src.loaders.moodle import Moodle
@@ -109,6 +110,11 @@ class Fetch_Data:
             self.prod_vector_store.client, [DEFAULT_COLLECTION], recreate_on_collision=True
         )
         self.logger.info("Migration successful")
+        # Cached answers may reference outdated content. API workers with an in-memory cache notice the
+        # rebuild through their course catalog and clear their cache on their own.
+        if self.prod_vector_store.client.collection_exists(ANSWER_CACHE_COLLECTION):
+            self.logger.info("Invalidate the semantic answer cache")
+            self.prod_vector_store.client.delete_collection(ANSWER_CACHE_COLLECTION)
 
         self.sanity_check()
 
@@ -0,0 +1,70 @@
+import asyncio
+
+from fastapi import HTTPException
+
+from src.api.admission import ModelLimiter
+from src.api.rest import AdmittedStreamingResponse
+
+
+def test_round_robin_and_key_share():
+    limiter = ModelLimiter("GPT-4", limit=1, queue_size=4, queue_timeout=1, api_key_count=2)
+    served = []
+
+    async def chat(api_key: str, i: int):
+        try:
+            async with limiter.slot(api_key):
+                served.append((api_key, i))
+                await asyncio.sleep(0.01)
+        except HTTPException as e:
+            served.append((api_key, i, e.status_code))
+            assert int(e.headers["Retry-After"]) >= 1
+
+    async def run():
+        await asyncio.gather(*[chat("a", i) for i in range(4)], chat("b", 0), chat("b", 1))
+
+    asyncio.run(run())
+
+    # "a" may only queue 2 requests, the queued requests of both keys are served alternately
+    assert served == [("a", 0), ("a", 3, 429), ("a", 1), ("b", 0), ("a", 2), ("b", 1)]
+    assert limiter.active == 0 and limiter.queued == 0
+
+
+def test_queue_timeout():
+    limiter = ModelLimiter("Llama3", limit=1, queue_size=4, queue_timeout=0.05, api_key_count=1)
+
+    async def run():
+        await limiter.acquire("a")
+        try:
+            await limiter.acquire("a")
+        except HTTPException as e:
+            return e.status_code
+        finally:
+            limiter.release()
+
+    assert asyncio.run(run()) == 503
+    assert limiter.active == 0 and limiter.queued == 0
+
+
+def test_stream_releases_slot_when_client_is_gone():
+    limiter = ModelLimiter("GPT-4", limit=1, queue_size=4, queue_timeout=1, api_key_count=1)
+
+    async def events():
+        yield 'event: token\ndata: "Hallo"\n\n'
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # the client disconnected before the response started, the generator never runs
+        raise OSError("Connection reset by peer")
+
+    async def run():
+        await limiter.acquire("a")
+        response = AdmittedStreamingResponse(events(), limiter, media_type="text/event-stream")
+        try:
+            await response({"type": "http"}, receive, send)
+        except BaseException:
+            pass
+
+    asyncio.run(run())
+    assert limiter.active == 0
@@ -0,0 +1,66 @@
+import os
+import threading
+
+from src.api.feedback import FeedbackQueue
+
+
+class FakeLangfuse:
+    def __init__(self) -> None:
+        self.reachable = False
+        self.scores: dict[str, dict] = {}
+
+    def auth_check(self) -> bool:
+        if not self.reachable:
+            raise ConnectionError("Langfuse is not reachable")
+        return True
+
+    def score(self, id: str, **kwargs) -> None:
+        self.scores[id] = kwargs
+
+    def flush(self) -> None:
+        if not self.reachable:
+            self.scores.clear()
+
+
+def test_feedback_is_spooled_and_replayed(tmp_path):
+    feedback_queue = FeedbackQueue(spool_path=str(tmp_path / "spool.jsonl"))
+    langfuse = feedback_queue._client = FakeLangfuse()
+    # no background thread, the queued feedback is sent by close()
+    feedback_queue._thread = threading.Thread(target=lambda: None)
+    feedback_queue._thread.start()
+
+    feedback_queue.submit(trace_id="trace-1", value=1, comment="Good answer")
+    feedback_queue.submit(trace_id="trace-2", value=0, comment=None)
+    feedback_queue.close()
+    assert langfuse.scores == {}
+    assert feedback_queue.stats()["spooled"] == 2
+
+    langfuse.reachable = True
+    feedback_queue._last_health_check = 0
+    feedback_queue.submit(trace_id="trace-3", value=1, comment=None)
+    feedback_queue._replay_spool()
+    feedback_queue.close()
+
+    assert sorted(score["trace_id"] for score in langfuse.scores.values()) == ["trace-1", "trace-2", "trace-3"]
+    assert not (tmp_path / "spool.jsonl").exists()
+    assert feedback_queue.stats()["replayed"] == 2
+
+
+def test_replay_skips_corrupt_lines_and_takes_over_leftover_files(tmp_path):
+    spool_path = tmp_path / "spool.jsonl"
+    feedback_queue = FeedbackQueue(spool_path=str(spool_path))
+    langfuse = feedback_queue._client = FakeLangfuse()
+    langfuse.reachable = True
+
+    spool_path.write_text('{"trace_id": "trace-1", "value": 1, "comment": null, "id": "1"}\n{"trace_id": "tr\n')
+    # left by a crashed worker
+    leftover_path = tmp_path / "spool.jsonl.12345.0.replay"
+    leftover_path.write_text('{"trace_id": "trace-2", "value": 0, "comment": null, "id": "2"}\n')
+    os.utime(leftover_path, (0, 0))
+
+    feedback_queue._replay_spool()
+
+    assert sorted(score["trace_id"] for score in langfuse.scores.values()) == ["trace-1", "trace-2"]
+    assert list(tmp_path.iterdir()) == []
+    assert feedback_queue.stats()["replayed"] == 2
+    assert feedback_queue.stats()["dropped"] == 1
@@ -0,0 +1,22 @@
+import pytest
+
+from src.llm.parser.answer_stream_parser import AnswerStreamParser
+
+examples = [
+    ('{"answer": "Der Kurs ist kostenlos. [doc1]"}', "Der Kurs ist kostenlos. [doc1]"),
+    ('{\n    "answer": "Zeile 1\\nZeile \\"2\\" \\u00fcber"\n}', 'Zeile 1\nZeile "2" über'),
+    ('```json\n{"answer": "In a code block"}\n```', "In a code block"),
+    ('{"answer": "Emoji \\ud83d\\ude00 end"}', "Emoji 😀 end"),
+    ("Plain text without JSON [doc2]", "Plain text without JSON [doc2]"),
+    ('{"answer": "NO ANSWER FOUND"}', "NO ANSWER FOUND"),
+]
+
+
+@pytest.mark.parametrize("response, answer", examples)
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 100])
+def test_answer_stream_parsing(response: str, answer: str, chunk_size: int):
+    parser = AnswerStreamParser()
+    chunks = [response[i : i + chunk_size] for i in range(0, len(response), chunk_size)]
+
+    streamed_answer = "".join(parser.feed(chunk) for chunk in chunks)
+    assert streamed_answer == answer
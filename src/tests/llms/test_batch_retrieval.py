@@ -0,0 +1,52 @@
+import asyncio
+import base64
+
+import numpy as np
+from qdrant_client.http.models import Distance, PointStruct, VectorParams
+
+from src.api.rest import encode_embedding
+from src.llm.retriever import KiCampusRetriever
+from src.vectordb.qdrant import VectorDBQdrant
+
+
+class FakeEmbedder:
+    async def aget_text_embedding_batch(self, texts: list[str]) -> list[list[float]]:
+        return [[1.0, 0.0] if "ethics" in text else [0.0, 1.0] for text in texts]
+
+
+async def create_retriever() -> KiCampusRetriever:
+    vector_db = VectorDBQdrant(version="memory")
+    await vector_db.aclient.create_collection("web_assistant", VectorParams(size=2, distance=Distance.COSINE))
+    await vector_db.aclient.upsert(
+        "web_assistant",
+        points=[
+            PointStruct(id=1, vector=[1.0, 0.0], payload={"text": "Ethics", "source": "Drupal"}),
+            PointStruct(id=2, vector=[0.0, 1.0], payload={"text": "Python", "source": "Drupal"}),
+            PointStruct(id=3, vector=[1.0, 0.0], payload={"text": "Ethics course", "course_id": 79}),
+        ],
+    )
+    retriever = KiCampusRetriever(vector_db=vector_db)
+    retriever.embedder = FakeEmbedder()
+    return retriever
+
+
+def test_batch_retrieval_applies_filters_per_query():
+    async def run():
+        retriever = await create_retriever()
+        return await retriever.aretrieve_batch(
+            [("ethics", None, None), ("python", None, None), ("ethics", 79, None)], limit=1, with_vectors=True
+        )
+
+    ethics, python, course = asyncio.run(run())
+
+    assert ethics[0].node.get_content() == "Ethics"
+    assert python[0].node.get_content() == "Python"
+    assert course[0].node.get_content() == "Ethics course"
+    assert course[0].node.embedding == [1.0, 0.0]
+
+
+def test_base64_embedding_encoding():
+    embedding = [0.5, -1.25, 3.0]
+    encoded = encode_embedding(embedding, "base64")
+    assert np.frombuffer(base64.b64decode(encoded), dtype="<f4").tolist() == embedding
+    assert encode_embedding(embedding, "float") == embedding
@@ -0,0 +1,167 @@
+import asyncio
+import fcntl
+
+from llama_index.core.llms import (
+    ChatMessage,
+    CompletionResponse,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+from src.llm.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitBreakerRegistry,
+    FileBreakerStore,
+    InMemoryBreakerStore,
+    Permit,
+)
+from src.llm.LLMs import LLM, Models
+
+
+def breaker(store=None, open_seconds: float = 60) -> CircuitBreaker:
+    return CircuitBreaker(
+        "gwdg",
+        store or InMemoryBreakerStore(),
+        error_rate_threshold=0.5,
+        latency_threshold=5,
+        open_seconds=open_seconds,
+        min_calls=4,
+    )
+
+
+def test_breaker_opens_on_error_rate_and_closes_after_probe():
+    gwdg = breaker(open_seconds=0)
+    for success in (True, False, True, False):
+        gwdg.record(success, 1.0, gwdg.allow())
+    assert gwdg.state() == OPEN
+
+    # after open_seconds exactly one call probes the backend
+    probe = gwdg.allow()
+    assert probe.probe_at is not None
+    assert gwdg.state() == HALF_OPEN
+    assert not gwdg.allow()
+    gwdg.record(True, 1.0, probe)
+
+    assert gwdg.state() == CLOSED
+    assert gwdg.stats()["trips"] == 1 and gwdg.stats()["rejected"] == 1
+
+
+def test_only_the_current_probe_decides():
+    gwdg = breaker(open_seconds=0)
+    for _ in range(4):
+        gwdg.record(False, 1.0)
+    probe = gwdg.allow()
+
+    # a regular call that was allowed before the breaker opened does not close it
+    gwdg.record(True, 1.0, Permit())
+    assert gwdg.state() == HALF_OPEN
+
+    # a cancelled probe lets the next call probe at once
+    gwdg.release(probe)
+    next_probe = gwdg.allow()
+    assert next_probe and next_probe != probe
+    gwdg.record(True, 1.0, probe)
+    assert gwdg.state() == HALF_OPEN
+
+    gwdg.record(True, 1.0, next_probe)
+    assert gwdg.state() == CLOSED
+
+
+def test_slow_probe_opens_the_breaker_again():
+    gwdg = breaker(open_seconds=0)
+    for _ in range(4):
+        gwdg.record(False, 1.0)
+
+    gwdg.record(True, 6.0, gwdg.allow())
+
+    assert gwdg.state() == OPEN and gwdg.stats()["trips"] == 2
+
+
+def test_breaker_opens_on_latency():
+    gwdg = breaker()
+    for seconds in (1.0, 6.0, 6.5, 7.0):
+        gwdg.record(True, seconds)
+
+    assert gwdg.state() == OPEN
+    assert not gwdg.allow()
+
+
+def test_failed_calls_only_count_for_the_error_rate():
+    gwdg = breaker()
+    for success, seconds in ((True, 1.0), (False, 30.0), (True, 2.0), (True, 1.5)):
+        gwdg.record(success, seconds)
+
+    assert gwdg.state() == CLOSED
+    assert gwdg.stats()["error_rate"] == 0.25 and gwdg.stats()["p95_first_token_seconds"] == 2.0
+
+
+def test_workers_share_the_state(tmp_path):
+    path = str(tmp_path / "circuit_breakers.json")
+    first_worker, second_worker = breaker(FileBreakerStore(path)), breaker(FileBreakerStore(path))
+    for _ in range(4):
+        first_worker.record(False, 7.0)
+
+    assert not second_worker.allow()
+
+
+def test_event_loop_does_not_wait_for_the_state_file(tmp_path):
+    path = str(tmp_path / "circuit_breakers.json")
+    gwdg = breaker(FileBreakerStore(path))
+
+    async def run():
+        with open(path, "a+") as file:
+            # another worker changes the state
+            fcntl.flock(file, fcntl.LOCK_EX)
+            allowed = asyncio.ensure_future(gwdg.aallow())
+            await asyncio.sleep(0.1)
+            assert not allowed.done()
+        assert await allowed
+        # the state that was just read is reused, the file is not read again
+        gwdg.store = None
+        return await gwdg.aallow()
+
+    assert asyncio.run(run())
+
+
+class FakeLLM(CustomLLM):
+    name: str
+    calls: list
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(is_chat_model=False)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs) -> CompletionResponse:
+        raise NotImplementedError
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs):
+        self.calls.append(self.name)
+        if self.name != Models.GPT4.value:
+            raise TimeoutError("GWDG did not answer in time.")
+
+        def tokens():
+            text = ""
+            for delta in ["Hal", "lo"]:
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+
+        return tokens()
+
+
+def test_failed_call_falls_back_once(monkeypatch):
+    calls: list[str] = []
+    registry = CircuitBreakerRegistry()
+    monkeypatch.setattr("src.llm.LLMs.circuit_breakers", registry)
+    monkeypatch.setattr(LLM, "get_model", lambda self, model: FakeLLM(name=model.value, calls=calls))
+
+    response = LLM().chat("Hallo", [ChatMessage(role="user", content="Hi")], Models.LLAMA3, "Du bist ein Assistent.")
+
+    assert response.content == "Hallo"
+    assert calls == ["Llama3", "GPT-4"]
+    assert registry.stats()["gwdg"]["error_rate"] == 1.0
@@ -0,0 +1,48 @@
+import asyncio
+
+from llama_index.core.callbacks import CallbackManager
+
+from src.llm.clients import LLMClientPool
+from src.llm.LLMs import AZURE_OPENAI_ENDPOINT, GWDG_ENDPOINT, LLM, Models
+
+
+def test_models_share_the_pooled_client(monkeypatch):
+    pool = LLMClientPool()
+    monkeypatch.setattr("src.llm.LLMs.llm_clients", pool)
+    llm = LLM()
+
+    first = llm.get_model(Models.GPT4)
+    second = llm.get_model(Models.GPT4)
+    embedder = llm.get_embedder()
+
+    assert first is not second
+    assert first._http_client is second._http_client is embedder._http_client
+    assert first._get_client() is second._get_client()
+    assert embedder is llm.get_embedder()
+    assert pool.stats()["clients"] == 2 and list(pool.stats()["endpoints"]) == [AZURE_OPENAI_ENDPOINT]
+
+
+def test_callback_manager_is_set_per_request():
+    pool = LLMClientPool()
+    pooled = LLM()._build_model(Models.GPT4)
+
+    first = pool.for_request(pooled, CallbackManager([]))
+    second = pool.for_request(pooled, CallbackManager([]))
+
+    assert first.callback_manager is not second.callback_manager
+    assert pooled.callback_manager is not first.callback_manager
+
+
+def test_async_clients_are_kept_per_event_loop():
+    pool = LLMClientPool()
+
+    async def clients():
+        return pool.http_clients(GWDG_ENDPOINT)
+
+    first_sync, first_async = asyncio.run(clients())
+    second_sync, second_async = asyncio.run(clients())
+
+    assert first_sync is second_sync
+    assert first_async is not second_async
+    # the client of the closed loop was dropped
+    assert len(pool.pool(GWDG_ENDPOINT).async_clients) == 1
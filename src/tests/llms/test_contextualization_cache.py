@@ -0,0 +1,66 @@
+import asyncio
+
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from src.llm.contextualization_cache import (
+    ContextualizationCache,
+    InMemoryMemoBackend,
+    SqliteMemoBackend,
+)
+from src.llm.LLMs import Models
+from src.llm.tools.contextualizer import Contextualizer
+
+CHAT_HISTORY = [
+    ChatMessage(role=MessageRole.USER, content="Worum geht es im Kurs Deep Learning?"),
+    ChatMessage(role=MessageRole.ASSISTANT, content="Um neuronale Netze."),
+]
+
+
+class FakeLLM:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def achat(self, query: str, chat_history: list[ChatMessage], model: Models, system_prompt: str):
+        self.calls += 1
+        return ChatMessage(role=MessageRole.ASSISTANT, content=f"{query} (Kurs Deep Learning)")
+
+
+def contextualizer(cache: ContextualizationCache) -> Contextualizer:
+    instance = Contextualizer(cache=cache)
+    instance.llm = FakeLLM()
+    return instance
+
+
+def test_same_conversation_is_contextualized_once():
+    cache = ContextualizationCache(InMemoryMemoBackend(), store=None, ttl=60)
+    worker = contextualizer(cache)
+
+    first = asyncio.run(worker.acontextualize("Wie lange dauert er?", CHAT_HISTORY, Models.GPT4))
+    second = asyncio.run(worker.acontextualize("Wie lange dauert er?", CHAT_HISTORY, Models.GPT4))
+    asyncio.run(worker.acontextualize("Wie lange dauert er?", CHAT_HISTORY, Models.LLAMA3))
+    asyncio.run(worker.acontextualize("Wie lange dauert er?", CHAT_HISTORY[:1], Models.GPT4))
+
+    assert first == second == "Wie lange dauert er? (Kurs Deep Learning)"
+    assert worker.llm.calls == 3
+    assert cache.stats()["memory_hits"] == 1 and cache.stats()["misses"] == 3
+
+
+def test_workers_share_the_sqlite_store(tmp_path):
+    path = str(tmp_path / "contextualization.sqlite3")
+    first_worker = contextualizer(ContextualizationCache(InMemoryMemoBackend(), SqliteMemoBackend(path), ttl=60))
+    second_worker = contextualizer(ContextualizationCache(InMemoryMemoBackend(), SqliteMemoBackend(path), ttl=60))
+
+    asyncio.run(first_worker.acontextualize("Wie lange dauert er?", CHAT_HISTORY, Models.GPT4))
+    rag_query = asyncio.run(second_worker.acontextualize("Wie lange dauert er?", CHAT_HISTORY, Models.GPT4))
+
+    assert rag_query == "Wie lange dauert er? (Kurs Deep Learning)"
+    assert second_worker.llm.calls == 0
+    assert second_worker.cache.stats()["store_hits"] == 1
+
+
+def test_expired_entries_are_not_returned():
+    memory = InMemoryMemoBackend()
+    memory.set("key", "value", created_at=0.0)
+
+    assert memory.get("key", ttl=60) is None
+    assert len(memory) == 0
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from src.llm import hedging
+from src.llm.circuit_breaker import OPEN, CircuitBreaker, InMemoryBreakerStore
+from src.llm.hedging import MIN_LATENCY_SAMPLES, Hedger, first_success
+from src.llm.LLMs import LLM, Models
+from src.llm.streaming import StreamedAnswer
+
+
+async def answer(text: str, seconds: float, cancelled: list[str]) -> str:
+    try:
+        await asyncio.sleep(seconds)
+    except asyncio.CancelledError:
+        cancelled.append(text)
+        raise
+    return text
+
+
+async def hedged_call(hedger: Hedger, primary_seconds: float, cancelled: list[str]) -> str:
+    primary = asyncio.ensure_future(answer("Llama3", primary_seconds, cancelled))
+    hedge = await hedger.ahedge("Llama3", primary, lambda: answer("GPT-4", 0.01, cancelled))
+    winner = await first_success([primary] if hedge is None else [primary, hedge])
+    return winner.result()
+
+
+def test_slow_call_is_hedged_and_the_loser_cancelled(monkeypatch):
+    monkeypatch.setattr(hedging, "DEFAULT_HEDGE_DELAY", 0.05)
+    monkeypatch.setattr(hedging.env, "LLM_HEDGE_BUDGETS", {"Llama3": 1.0})
+    hedger, cancelled = Hedger(), []
+
+    assert asyncio.run(hedged_call(hedger, 0.01, cancelled)) == "Llama3"
+    assert asyncio.run(hedged_call(hedger, 1.0, cancelled)) == "GPT-4"
+    assert cancelled == ["Llama3"]
+    assert hedger.stats()["Llama3"]["hedged"] == 1
+
+
+def test_budget_caps_hedges(monkeypatch):
+    monkeypatch.setattr(hedging, "DEFAULT_HEDGE_DELAY", 0.01)
+    monkeypatch.setattr(hedging.env, "LLM_HEDGE_BUDGETS", {"Llama3": 0.5})
+    hedger = Hedger()
+
+    answers = [asyncio.run(hedged_call(hedger, 0.05, [])) for _ in range(4)]
+
+    assert answers == ["Llama3", "GPT-4", "Llama3", "GPT-4"]
+
+
+def test_delay_follows_the_latency_of_the_model():
+    hedger = Hedger()
+    for index in range(MIN_LATENCY_SAMPLES * 5):
+        hedger.record("Llama3", 1.0 + index / 100)
+
+    assert 1.85 <= hedger.delay("Llama3") <= 1.95
+
+
+@pytest.fixture
+def stuck_primary(monkeypatch) -> tuple[Hedger, CircuitBreaker]:
+    """Llama3 does not answer, GPT-4 answers at once. The breaker is short-lived and not shared with other tests."""
+    monkeypatch.setattr(hedging, "DEFAULT_HEDGE_DELAY", 0.05)
+    monkeypatch.setattr("src.llm.LLMs.env.LLM_HEDGING", True)
+    monkeypatch.setattr("src.llm.LLMs.env.LLM_HEDGE_BUDGETS", {"Llama3": 1.0})
+    hedger = Hedger()
+    breaker = CircuitBreaker(
+        "gwdg", InMemoryBreakerStore(), error_rate_threshold=0.5, latency_threshold=6, open_seconds=0, min_calls=4
+    )
+    monkeypatch.setattr("src.llm.LLMs.hedger", hedger)
+    monkeypatch.setattr(LLM, "circuit_breaker", staticmethod(lambda model: None if model == Models.GPT4 else breaker))
+
+    async def streamed_answer(self, model: Models, messages: list) -> StreamedAnswer:
+        await asyncio.sleep(1.0 if model == Models.LLAMA3 else 0.01)
+        return StreamedAnswer(model.value, 0.01, 0.01, 1)
+
+    monkeypatch.setattr(LLM, "astreamed_answer", streamed_answer)
+    return hedger, breaker
+
+
+def test_cancelled_primary_is_recorded(stuck_primary: tuple[Hedger, CircuitBreaker]):
+    hedger, breaker = stuck_primary
+
+    response = asyncio.run(LLM().achat("Hallo", [], Models.LLAMA3, "Du bist ein Assistent."))
+
+    # the primary counts as failed, and with the time until it was cancelled for the hedge delay
+    assert response.content == "GPT-4"
+    assert hedger.stats()["Llama3"]["fallback_wins"] == 1
+    assert 0.05 <= hedger._latencies["Llama3"][0] < 1.0
+    assert breaker.stats()["calls"] == 1 and breaker.stats()["error_rate"] == 1.0
+
+
+def test_probe_that_loses_to_the_hedge_does_not_close_the_breaker(stuck_primary: tuple[Hedger, CircuitBreaker]):
+    _, breaker = stuck_primary
+    for _ in range(4):
+        breaker.record(False, 1.0)
+    assert breaker.state() == OPEN
+
+    # the call probes the half-open breaker, GPT-4 answers long before the latency threshold
+    response = asyncio.run(LLM().achat("Hallo", [], Models.LLAMA3, "Du bist ein Assistent."))
+
+    assert response.content == "GPT-4"
+    assert breaker.state() == OPEN and breaker.stats()["trips"] == 2
@@ -0,0 +1,131 @@
+import asyncio
+
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from src.llm.LLMs import Models
+from src.llm.tokens import count_message_tokens, count_tokens, truncate_to_tokens
+from src.llm.tools import history_summarizer as history_summarizer_module
+from src.llm.tools.history_summarizer import SUMMARY_QUESTION, ChatHistorySummarizer
+
+BUDGETS = {"GPT-4": 600, "Mistral8": 600}
+
+
+def turn(number: int) -> list[ChatMessage]:
+    return [
+        ChatMessage(role=MessageRole.USER, content=f"Frage {number}: Worum geht es im Kurs Nummer {number}?"),
+        ChatMessage(role=MessageRole.ASSISTANT, content=f"Antwort {number}: " + "Der Kurs behandelt KI. " * 15),
+    ]
+
+
+def history(turns: int) -> list[ChatMessage]:
+    return [message for number in range(turns) for message in turn(number)]
+
+
+class FakeLLM:
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.queries: list[str] = []
+
+    async def achat(self, query: str, chat_history: list[ChatMessage], model: Models, system_prompt: str):
+        if self.fail:
+            raise TimeoutError()
+        self.queries.append(query)
+        return ChatMessage(role=MessageRole.ASSISTANT, content=f"Zusammenfassung {len(self.queries)}")
+
+
+def summarizer(fail: bool = False) -> ChatHistorySummarizer:
+    history_summarizer = ChatHistorySummarizer(token_budgets=BUDGETS)
+    history_summarizer.llm = FakeLLM(fail=fail)
+    return history_summarizer
+
+
+def test_short_history_is_kept():
+    history_summarizer = summarizer()
+    chat_history = history(2)
+
+    assert asyncio.run(history_summarizer.alimit(chat_history, Models.GPT4)) == chat_history
+    assert history_summarizer.llm.queries == []
+
+
+def test_older_turns_are_folded_into_summary_within_budget():
+    history_summarizer = summarizer()
+    chat_history = history(8)
+
+    limited = asyncio.run(history_summarizer.alimit(chat_history, Models.GPT4))
+
+    assert [message.content for message in limited[:2]] == [SUMMARY_QUESTION, "Zusammenfassung 1"]
+    assert limited[2].role == MessageRole.USER and limited[-1] == chat_history[-1]
+    assert count_message_tokens(limited, Models.GPT4) <= BUDGETS["GPT-4"]
+    assert "Frage 0" in history_summarizer.llm.queries[0]
+
+
+def test_summary_is_reused_and_updated_incrementally():
+    history_summarizer = summarizer()
+    asyncio.run(history_summarizer.alimit(history(8), Models.GPT4))
+    asyncio.run(history_summarizer.alimit(history(8), Models.GPT4))
+    # the turns after the folded ones still fit into the budget
+    asyncio.run(history_summarizer.alimit(history(9), Models.GPT4))
+    assert len(history_summarizer.llm.queries) == 1
+
+    asyncio.run(history_summarizer.alimit(history(11), Models.GPT4))
+
+    # only the newly folded turns are summarized, together with the earlier summary
+    update = history_summarizer.llm.queries[1]
+    assert "Zusammenfassung 1" in update and "Frage 0" not in update and "Frage 9" in update
+    assert history_summarizer.stats()["reused"] == 2 and history_summarizer.stats()["updated"] == 2
+
+
+def test_summary_is_reused_while_the_conversation_grows():
+    history_summarizer = ChatHistorySummarizer(token_budgets={"GPT-4": 1500})
+    history_summarizer.llm = FakeLLM()
+
+    for turns in range(1, 21):
+        limited = asyncio.run(history_summarizer.alimit(history(turns), Models.GPT4))
+        assert count_message_tokens(limited, Models.GPT4) <= 1500
+
+    # most turns reuse the summary of an earlier turn
+    stats = history_summarizer.stats()
+    assert len(history_summarizer.llm.queries) <= 5
+    assert stats["reused"] > 2 * stats["updated"]
+
+
+def test_slow_summary_is_cached_for_the_next_turn(monkeypatch):
+    monkeypatch.setattr(history_summarizer_module, "SUMMARY_TIMEOUT", 0.05)
+    history_summarizer = summarizer()
+    achat = history_summarizer.llm.achat
+
+    async def slow_achat(**kwargs):
+        await asyncio.sleep(0.2)
+        return await achat(**kwargs)
+
+    history_summarizer.llm.achat = slow_achat
+
+    async def conversation():
+        first = await history_summarizer.alimit(history(8), Models.GPT4)
+        await asyncio.sleep(0.3)
+        return first, await history_summarizer.alimit(history(8), Models.GPT4)
+
+    first, second = asyncio.run(conversation())
+
+    assert first[0].content != SUMMARY_QUESTION
+    assert [message.content for message in second[:2]] == [SUMMARY_QUESTION, "Zusammenfassung 1"]
+    assert len(history_summarizer.llm.queries) == 1
+
+
+def test_older_turns_are_dropped_when_summary_fails():
+    history_summarizer = summarizer(fail=True)
+    chat_history = history(8)
+
+    limited = asyncio.run(history_summarizer.alimit(chat_history, Models.GPT4))
+
+    assert limited[0].role == MessageRole.USER and limited[0].content != SUMMARY_QUESTION
+    assert limited[-1] == chat_history[-1]
+    assert history_summarizer.stats()["failed"] == 1
+
+
+def test_token_counts_depend_on_model():
+    text = "Welche Kurse zum maschinellen Lernen bietet der KI-Campus an?"
+
+    assert count_tokens(text, Models.MISTRAL8) > count_tokens(text, Models.GPT4)
+    shortened = truncate_to_tokens(text * 20, 30, Models.MISTRAL8)
+    assert count_tokens(shortened, Models.MISTRAL8) <= 30 and shortened.endswith("…")
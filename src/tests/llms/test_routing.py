@@ -0,0 +1,75 @@
+import asyncio
+
+import httpx
+
+from src.llm.routing import AsyncRoutingTransport, DeploymentRouter, RoutingTransport
+
+CONFIG = [
+    {"url": "https://sweden.openai.azure.com", "deployment": "gpt4-sweden", "api_key": "key-sweden", "name": "sweden"},
+    {"url": "https://france.openai.azure.com", "deployment": "gpt4-france", "api_key": "key-france", "name": "france"},
+]
+CHAT_URL = "https://main.openai.azure.com/openai/deployments/gpt4/chat/completions?api-version=2023-05-15"
+
+
+def backend(throttled: set[str], requests: list[httpx.Request]):
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        region = request.url.host.split(".")[0]
+        if region in throttled:
+            return httpx.Response(429, headers={"retry-after": "30"})
+        return httpx.Response(200, json={"region": region}, headers={"x-ratelimit-remaining-requests": "100"})
+
+    return handle
+
+
+def test_requests_are_rewritten_to_the_deployment():
+    requests: list[httpx.Request] = []
+    router = DeploymentRouter.from_config("gpt4", CONFIG)
+    client = httpx.Client(transport=RoutingTransport(router, httpx.MockTransport(backend(set(), requests))))
+
+    client.post(CHAT_URL, json={"messages": []}, headers={"api-key": "key-main"})
+
+    request = requests[0]
+    assert request.url.host == "sweden.openai.azure.com"
+    assert request.url.path == "/openai/deployments/gpt4-sweden/chat/completions"
+    assert request.url.params["api-version"] == "2023-05-15"
+    assert request.headers["api-key"] == "key-sweden" and request.headers["host"] == "sweden.openai.azure.com"
+
+
+def test_throttled_deployment_is_retried_on_sibling_and_skipped():
+    requests: list[httpx.Request] = []
+    router = DeploymentRouter.from_config("gpt4", CONFIG)
+    client = httpx.Client(transport=RoutingTransport(router, httpx.MockTransport(backend({"sweden"}, requests))))
+
+    first = client.post(CHAT_URL, json={"messages": []})
+    second = client.post(CHAT_URL, json={"messages": []})
+
+    assert first.json() == second.json() == {"region": "france"}
+    # sweden is not asked again before its retry-after is over
+    assert [request.url.host.split(".")[0] for request in requests] == ["sweden", "france", "france"]
+    assert router.stats()["sweden"]["throttled"] == 1
+
+
+def test_faster_deployment_is_preferred():
+    router = DeploymentRouter.from_config("gpt4", CONFIG)
+    sweden, france = router.deployments
+    sweden.latency, france.latency = 2.0, 0.5
+
+    assert router.choose(set()) is france
+    # requests in flight spread the load
+    assert router.choose(set()) is france
+    assert router.choose(set()) is france
+    assert router.choose(set()) is sweden
+
+
+def test_all_deployments_throttled_returns_429():
+    requests: list[httpx.Request] = []
+    router = DeploymentRouter.from_config("gpt4", CONFIG)
+    transport = AsyncRoutingTransport(router, httpx.MockTransport(backend({"sweden", "france"}, requests)))
+
+    async def post() -> httpx.Response:
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.post(CHAT_URL, json={"messages": []})
+
+    assert asyncio.run(post()).status_code == 429
+    assert len(requests) == 2
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from src.llm.semantic_cache import (
+    ANSWER_CACHE_COLLECTION,
+    InMemoryCacheBackend,
+    QdrantCacheBackend,
+    SemanticCache,
+)
+from src.vectordb.qdrant import VectorDBQdrant
+
+
+@pytest.fixture(params=["memory", "qdrant"])
+def semantic_cache(request) -> SemanticCache:
+    if request.param == "memory":
+        backend = InMemoryCacheBackend()
+    else:
+        backend = QdrantCacheBackend(VectorDBQdrant(version="memory"))
+    return SemanticCache(backend, threshold=0.95, ttl=60)
+
+
+def test_semantic_cache(semantic_cache: SemanticCache):
+    async def run():
+        assert await semantic_cache.lookup([1.0, 0.0, 0.0], None, None, "GPT-4", "German") is None
+        await semantic_cache.store([1.0, 0.0, 0.0], None, None, "GPT-4", "German", "Registrierung über ...")
+
+        # close enough
+        assert await semantic_cache.lookup([0.99, 0.05, 0.0], None, None, "GPT-4", "German") == "Registrierung über ..."
+        # not similar
+        assert await semantic_cache.lookup([0.0, 1.0, 0.0], None, None, "GPT-4", "German") is None
+        # other scope
+        assert await semantic_cache.lookup([1.0, 0.0, 0.0], 79, None, "GPT-4", "German") is None
+        assert await semantic_cache.lookup([1.0, 0.0, 0.0], None, None, "Llama3", "German") is None
+        assert await semantic_cache.lookup([1.0, 0.0, 0.0], None, None, "GPT-4", "English") is None
+
+    asyncio.run(run())
+    assert semantic_cache.stats()["hits"] == 1
+    assert semantic_cache.stats()["misses"] == 5
+
+
+def test_semantic_cache_invalidation():
+    semantic_cache = SemanticCache(InMemoryCacheBackend(), threshold=0.95, ttl=60)
+
+    async def run():
+        await semantic_cache.store([1.0, 0.0], 79, 12, "GPT-4", "German", "Antwort")
+        semantic_cache.invalidate()
+        assert await semantic_cache.lookup([1.0, 0.0], 79, 12, "GPT-4", "German") is None
+        await semantic_cache.store([1.0, 0.0], 79, 12, "GPT-4", "German", "Neue Antwort")
+        assert await semantic_cache.lookup([1.0, 0.0], 79, 12, "GPT-4", "German") == "Neue Antwort"
+
+    asyncio.run(run())
+
+
+def test_qdrant_cache_invalidation_keeps_shared_answers():
+    vector_db = VectorDBQdrant(version="memory")
+    first_worker = SemanticCache(QdrantCacheBackend(vector_db), threshold=0.95, ttl=60)
+    second_worker = SemanticCache(QdrantCacheBackend(vector_db), threshold=0.95, ttl=60)
+
+    async def run():
+        await first_worker.store([1.0, 0.0], 79, 12, "GPT-4", "German", "Antwort")
+        # the collection is only deleted by the loaders, a worker that noticed the rebuild keeps the shared answers
+        second_worker.invalidate()
+        await second_worker.store([0.0, 1.0], 79, 12, "GPT-4", "German", "Andere Antwort")
+        return await first_worker.lookup([1.0, 0.0], 79, 12, "GPT-4", "German")
+
+    assert asyncio.run(run()) == "Antwort"
+
+
+def test_qdrant_cache_recovers_from_deleted_collection():
+    vector_db = VectorDBQdrant(version="memory")
+    semantic_cache = SemanticCache(QdrantCacheBackend(vector_db), threshold=0.95, ttl=60)
+
+    async def run():
+        await semantic_cache.store([1.0, 0.0], None, None, "GPT-4", "German", "Antwort")
+        await vector_db.aclient.delete_collection(ANSWER_CACHE_COLLECTION)
+        # the first store after the collection was deleted fails, the next one creates it again
+        await semantic_cache.store([1.0, 0.0], None, None, "GPT-4", "German", "Antwort")
+        await semantic_cache.store([1.0, 0.0], None, None, "GPT-4", "German", "Antwort")
+        return await semantic_cache.lookup([1.0, 0.0], None, None, "GPT-4", "German")
+
+    assert asyncio.run(run()) == "Antwort"
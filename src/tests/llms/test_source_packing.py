@@ -0,0 +1,118 @@
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+from src.llm.LLMs import Models
+from src.llm.parser.citation_parser import CitationParser
+from src.llm.source_packing import (
+    GAP_MARKER,
+    SCORE_METADATA_KEY,
+    SourcePacker,
+    consolidate_sources,
+)
+from src.llm.tokens import count_tokens
+from src.llm.tools.question_answerer import (
+    SHORT_SYSTEM_PROMPT,
+    SYSTEM_PROMPT,
+    QuestionAnswerer,
+)
+from src.loaders.moochup import CourseInfo
+
+BUDGETS = {"GPT-4": 600, "Llama3": 300}
+DOCUMENT = " ".join(f"Satz {number} über den Kurs." for number in range(30))
+
+
+def source(name: str, score: float, words: int) -> TextNode:
+    node = TextNode(
+        text=" ".join([f"{name}-Inhalt"] * words),
+        metadata={"title": name, "url": f"https://ki-campus.org/{name}", SCORE_METADATA_KEY: score},
+    )
+    node.excluded_llm_metadata_keys = [SCORE_METADATA_KEY]
+    return node
+
+
+def chunk(start: int, end: int, score: float) -> TextNode:
+    node = TextNode(
+        text=DOCUMENT[start:end],
+        start_char_idx=start,
+        end_char_idx=end,
+        metadata={"fullname": "Kurs", "course_id": 79, "url": "https://moodle.ki-campus.org/79", "score": score},
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id="kurs-79")},
+    )
+    node.excluded_llm_metadata_keys = [SCORE_METADATA_KEY]
+    return node
+
+
+def test_chunks_of_the_same_source_are_merged():
+    sources = [chunk(100, 250, 0.9), source("blog", 0.85, 10), chunk(0, 120, 0.8), chunk(500, 600, 0.7)]
+
+    consolidated = consolidate_sources(sources)
+
+    assert len(consolidated) == 2
+    merged = consolidated[0]
+    # the overlap of adjacent chunks is kept once, a gap is marked
+    assert merged.text == DOCUMENT[0:250] + GAP_MARKER + DOCUMENT[500:600]
+    assert merged.metadata[SCORE_METADATA_KEY] == 0.9
+
+
+def test_only_prompt_metadata_is_rendered():
+    packed = SourcePacker(BUDGETS).pack([chunk(0, 120, 0.8), chunk(100, 250, 0.9)], Models.GPT4)
+
+    assert 'Metadata: {"title": "Kurs"}' in packed.text
+    assert "course_id" not in packed.text and "moodle.ki-campus.org" not in packed.text
+    assert packed.merged == 1 and packed.tokens_saved > 0
+
+
+def test_courses_keep_title_and_language():
+    moodle = TextNode(text="Inhalt", metadata={"fullname": "KI für alle", "type": "Kurs", "language": "de"})
+    moochup = CourseInfo(
+        id="42",
+        type="course",
+        attributes={"name": "Daten verstehen", "description": "Inhalt", "languages": ["de"], "url": "https://x.org/42"},
+    ).to_document()
+
+    packed = SourcePacker(BUDGETS).pack([moodle, moochup], Models.GPT4)
+
+    assert 'Metadata: {"title": "KI für alle", "type": "Kurs", "language": "de"}' in packed.text
+    assert '"title": "Daten verstehen"' in packed.text and '"language": ["de"]' in packed.text
+
+
+def test_sources_are_packed_by_score_within_budget():
+    sources = [source("kurs", 0.81, 20), source("blog", 0.89, 20), source("faq", 0.85, 20)]
+
+    packed = SourcePacker(BUDGETS).pack(sources, Models.GPT4)
+
+    assert [node.metadata["title"] for node in packed.nodes] == ["blog", "faq", "kurs"]
+    assert packed.text.index("[doc1]") < packed.text.index("blog-Inhalt") < packed.text.index("[doc2]")
+    assert SCORE_METADATA_KEY not in packed.text
+    assert packed.dropped == 0
+
+
+def test_oversized_source_is_truncated_and_smaller_sources_still_fit():
+    sources = [source("gross", 0.9, 1000), source("klein", 0.8, 20)]
+
+    packed = SourcePacker(BUDGETS).pack(sources, Models.LLAMA3)
+
+    assert [node.metadata["title"] for node in packed.nodes] == ["gross", "klein"]
+    assert packed.truncated == 1
+    assert count_tokens(packed.text, Models.LLAMA3) <= BUDGETS["Llama3"]
+    assert packed.tokens_saved > 0
+
+
+def test_citations_refer_to_packed_order():
+    sources = [source("kurs", 0.81, 20), chunk(0, 120, 0.8), source("blog", 0.89, 20), chunk(100, 250, 0.9)]
+    packed = SourcePacker(BUDGETS).pack(sources, Models.GPT4)
+
+    answer = CitationParser().parse("Siehe den Kurs [doc1] und den Blog [doc2].", packed.nodes)
+
+    assert answer.index("https://moodle.ki-campus.org/79") < answer.index("https://ki-campus.org/blog")
+    assert "[doc" not in answer
+
+
+def test_system_prompt_does_not_depend_on_request():
+    packed = SourcePacker(BUDGETS).pack([source("kurs", 0.8, 20)], Models.GPT4)
+    answerer = QuestionAnswerer()
+
+    system_prompt, user_query = answerer._build_prompts("Was ist KI?", packed, Models.GPT4, "German")
+    short_system_prompt, _ = answerer._build_prompts("What is AI?", packed, Models.LLAMA3, "English")
+
+    assert system_prompt == SYSTEM_PROMPT and short_system_prompt == SHORT_SYSTEM_PROMPT
+    assert "<LANGUAGE>: German" in user_query and packed.text in user_query
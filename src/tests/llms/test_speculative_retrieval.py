@@ -0,0 +1,94 @@
+import asyncio
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.schema import TextNode
+
+from src.llm.assistant import KICampusAssistant
+from src.llm.LLMs import Models
+from src.llm.speculative_retrieval import SpeculativeResult, SpeculativeRetrieval
+from src.llm.timing import VECTOR_SEARCH
+
+EMBEDDINGS = {
+    "Und was kostet er?": [1.0, 0.0, 0.0],
+    "Was kostet der Kurs Deep Learning?": [0.8, 0.6, 0.0],
+    "Was kostet er, der Kurs?": [0.99, 0.1, 0.0],
+}
+CHAT_HISTORY = [
+    ChatMessage(role=MessageRole.USER, content="Worum geht es im Kurs Deep Learning?"),
+    ChatMessage(role=MessageRole.ASSISTANT, content="Um neuronale Netze."),
+]
+
+
+class FakeContextualizer:
+    def __init__(self, rag_query: str) -> None:
+        self.rag_query = rag_query
+
+    async def acontextualize(self, query: str, chat_history: list[ChatMessage], model: Models) -> str:
+        await asyncio.sleep(0.05)
+        return self.rag_query
+
+
+class FakeRetriever:
+    def __init__(self) -> None:
+        self.embedded: list[str] = []
+        self.searched: list[list[float]] = []
+
+    async def aembed(self, query: str) -> list[float]:
+        self.embedded.append(query)
+        return EMBEDDINGS[query]
+
+    async def aretrieve_by_embedding(self, embedding, course_id=None, module_id=None) -> list[TextNode]:
+        self.searched.append(embedding)
+        return [TextNode(text="searched")]
+
+    async def aretrieve_speculative(self, query: str, course_id=None, module_id=None) -> SpeculativeResult:
+        await asyncio.sleep(0.01)
+        return SpeculativeResult(
+            embedding=EMBEDDINGS[query], nodes=[TextNode(text="speculative")], embed_seconds=0.005, search_seconds=0.005
+        )
+
+
+class FakeLanguageDetector:
+    def detect(self, text: str) -> str:
+        return "German"
+
+
+def retrieve(rag_query: str) -> tuple[list[TextNode], FakeRetriever, SpeculativeRetrieval]:
+    assistant = KICampusAssistant.__new__(KICampusAssistant)
+    assistant.retriever = FakeRetriever()
+    assistant.contextualizer = FakeContextualizer(rag_query)
+    assistant.language_detector = FakeLanguageDetector()
+    assistant.semantic_cache = None
+    assistant.speculative_retrieval = SpeculativeRetrieval(threshold=0.95)
+
+    async def run():
+        async with assistant._aretrieval_graph("Und was kostet er?", CHAT_HISTORY, Models.GPT4) as graph:
+            return await graph.aresult(VECTOR_SEARCH)
+
+    return asyncio.run(run()), assistant.retriever, assistant.speculative_retrieval
+
+
+def test_identical_query_reuses_speculative_sources():
+    nodes, retriever, speculation = retrieve(" und was  kostet er?")
+
+    assert [node.text for node in nodes] == ["speculative"]
+    assert retriever.embedded == [] and retriever.searched == []
+    assert speculation.stats()["identical"] == 1
+    assert speculation.stats()["seconds_saved"] > 0
+
+
+def test_similar_query_reuses_speculative_sources():
+    nodes, retriever, speculation = retrieve("Was kostet er, der Kurs?")
+
+    assert [node.text for node in nodes] == ["speculative"]
+    assert retriever.embedded == ["Was kostet er, der Kurs?"] and retriever.searched == []
+    assert speculation.stats()["similar"] == 1
+
+
+def test_different_query_discards_speculative_sources():
+    nodes, retriever, speculation = retrieve("Was kostet der Kurs Deep Learning?")
+
+    assert [node.text for node in nodes] == ["searched"]
+    assert retriever.searched == [EMBEDDINGS["Was kostet der Kurs Deep Learning?"]]
+    assert speculation.stats()["discarded"] == 1
+    assert speculation.stats()["hit_rate"] == 0.0
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import pytest
+
+from src.llm.stages import StageGraph
+from src.llm.timing import track_request
+
+
+async def contextualize() -> str:
+    await asyncio.sleep(0.05)
+    return "contextualized query"
+
+
+def detect_language() -> str:
+    time.sleep(0.05)
+    return "German"
+
+
+async def retrieve(query: str) -> list[str]:
+    await asyncio.sleep(0.02)
+    return [f"source for {query}"]
+
+
+async def search_forever(query: str) -> None:
+    await asyncio.sleep(10)
+
+
+def test_independent_stages_overlap():
+    graph = StageGraph()
+    graph.add("contextualize", contextualize)
+    graph.add("language_detection", detect_language)
+    graph.add("retrieve", retrieve, after=["contextualize"])
+
+    async def run():
+        with track_request("GPT-4") as timings:
+            async with graph:
+                sources = await graph.aresult("retrieve")
+                language = await graph.aresult("language_detection")
+            return sources, language, timings
+
+    sources, language, timings = asyncio.run(run())
+
+    assert sources == ["source for contextualized query"] and language == "German"
+    # the language detection ran while the query was contextualized
+    assert graph.spans["language_detection"][0] < graph.spans["contextualize"][1]
+    assert graph.spans["contextualize"][0] < graph.spans["language_detection"][1]
+    assert graph.spans["retrieve"][0] >= graph.spans["contextualize"][1]
+    assert timings.critical_path == ["contextualize", "retrieve"]
+    assert 'critical_path;desc="contextualize>retrieve"' in timings.server_timing()
+
+
+def test_unneeded_stages_are_cancelled():
+    graph = StageGraph()
+    graph.add("contextualize", contextualize)
+    graph.add("vector_search", search_forever, after=["contextualize"])
+
+    async def run():
+        start = time.perf_counter()
+        async with graph:
+            await graph.aresult("contextualize")
+        return time.perf_counter() - start
+
+    assert asyncio.run(run()) < 1
+    assert "vector_search" not in graph.spans
+
+
+def test_sync_stages_run_in_threads():
+    graph = StageGraph()
+    graph.add("contextualize", lambda: time.sleep(0.05) or "query")
+    graph.add("language_detection", detect_language)
+    graph.add("retrieve", lambda query: [query], after=["contextualize"])
+
+    with track_request("GPT-4") as timings:
+        with graph:
+            assert graph.result("retrieve") == ["query"]
+            assert graph.result("language_detection") == "German"
+    assert graph.spans["language_detection"][0] < graph.spans["contextualize"][1]
+    assert graph.spans["contextualize"][0] < graph.spans["language_detection"][1]
+    assert timings.critical_path[-1] in ["retrieve", "language_detection"]
+
+
+def test_stages_depend_on_added_stages():
+    graph = StageGraph()
+    with pytest.raises(ValueError):
+        graph.add("retrieve", retrieve, after=["contextualize"])
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from src.benchmarks.standalone_classifier import evaluate, load_examples
+from src.llm.LLMs import Models
+from src.llm.tools.standalone_classifier import StandaloneQuestionClassifier
+
+CHAT_HISTORY = [
+    ChatMessage(role=MessageRole.USER, content="Bekomme ich ein Zertifikat für den Kurs KI für alle?"),
+    ChatMessage(role=MessageRole.ASSISTANT, content="Ja, nach bestandener Abschlussprüfung."),
+]
+
+
+class FakeEmbedder:
+    def __init__(self, embeddings: dict[str, list[float]]) -> None:
+        self.embeddings = embeddings
+
+    async def aget_text_embedding_batch(self, texts: list[str]) -> list[list[float]]:
+        return [self.embeddings[text] for text in texts]
+
+
+@pytest.mark.parametrize(
+    "query, needs_context",
+    [
+        ("Wie lange dauert er?", True),
+        ("Gibt es dafür ein Zertifikat?", True),
+        ("Und für Anfänger?", True),
+        ("Was kostet das?", True),
+        ("Which one is better for beginners?", True),
+        ("Bekomme ich am Ende ein Zertifikat?", True),
+        ("Wie viel Zeit sollte ich einplanen?", True),
+        ("How many hours per week should I plan?", True),
+        ("Welche Kurse gibt es zu Ethik?", False),
+        ("Können Sie mir Kurse zu generativer KI empfehlen?", False),
+        ("Is there a course about AI in healthcare?", False),
+    ],
+)
+def test_cues(query, needs_context):
+    classifier = StandaloneQuestionClassifier(threshold=0.85)
+    assert classifier.needs_context(query, CHAT_HISTORY) == needs_context
+
+
+def test_vague_questions_are_decided_by_similarity_to_previous_question():
+    previous = CHAT_HISTORY[0].content
+    embedder = FakeEmbedder({previous: [1.0, 0.0], "Warum?": [0.9, 0.1], "Gibt es eine App?": [0.1, 0.9]})
+    classifier = StandaloneQuestionClassifier(threshold=0.85, embedder=embedder)
+
+    assert asyncio.run(classifier.aneeds_context("Warum?", CHAT_HISTORY))
+    assert not asyncio.run(classifier.aneeds_context("Gibt es eine App?", CHAT_HISTORY))
+    assert classifier.stats()["decisions"] == {"underspecified": 2}
+    assert classifier.stats()["skipped"] == 1
+
+
+def test_accuracy_on_evaluation_set():
+    result = asyncio.run(evaluate("cues", load_examples(), threshold=0.85, model=Models.GPT4))
+
+    assert result["accuracy"] >= 0.9
+    # skipping the contextualizer for a real follow-up question is the costly error
+    assert result["false_skip_rate"] <= 0.03
+    assert result["skip_rate"] >= 0.35
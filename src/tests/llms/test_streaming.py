@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from llama_index.core.llms import (
+    ChatMessage,
+    ChatResponse,
+    CompletionResponse,
+    CustomLLM,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+
+from src.llm.LLMs import LLM, Models
+from src.llm.streaming import StreamStats, StreamTimeout, acollect
+
+
+def stream(tokens: list[str], gaps: list[float]):
+    async def start():
+        async def generate():
+            text = ""
+            for token, gap in zip(tokens, gaps):
+                await asyncio.sleep(gap)
+                text += token
+                yield ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=text), delta=token)
+
+        return generate()
+
+    return start
+
+
+def test_long_answer_is_not_cut_off():
+    answer = asyncio.run(acollect(stream(["Hal", "lo"] * 10, [0.02] * 20), first_token_timeout=0.1, stall_timeout=0.1))
+
+    assert answer.text == "Hallo" * 10
+    assert answer.seconds > 0.3 and answer.chunks == 20
+
+
+def test_stalled_and_silent_streams_time_out():
+    with pytest.raises(StreamTimeout) as stalled:
+        asyncio.run(acollect(stream(["Hal", "lo"], [0.0, 0.3]), first_token_timeout=0.1, stall_timeout=0.1))
+    with pytest.raises(StreamTimeout) as silent:
+        asyncio.run(acollect(stream(["Hallo"], [0.3]), first_token_timeout=0.1, stall_timeout=None))
+
+    assert not stalled.value.first_token and silent.value.first_token
+
+
+class FakeLLM(CustomLLM):
+    name: str
+    gap: float
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(is_chat_model=True)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs) -> CompletionResponse:
+        raise NotImplementedError
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs):
+        raise NotImplementedError
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages, **kwargs):
+        return await stream([self.name, "!"], [0.0, self.gap])()
+
+
+def test_stalled_model_falls_back(monkeypatch):
+    gaps = {Models.LLAMA3: 0.5, Models.GPT4: 0.01}
+    monkeypatch.setattr(LLM, "get_model", lambda self, model: FakeLLM(name=model.value, gap=gaps[model]))
+    monkeypatch.setattr("src.llm.LLMs.env.LLM_STALL_TIMEOUTS", {"Llama3": 0.1})
+    stats = StreamStats()
+    monkeypatch.setattr("src.llm.LLMs.stream_stats", stats)
+
+    response = asyncio.run(LLM().achat("Hallo", [], Models.LLAMA3, "Du bist ein Assistent."))
+
+    assert response.content == "GPT-4!"
+    assert stats.stats()["Llama3"]["stalls"] == 1
+    assert stats.stats()["GPT-4"]["answers"] == 1 and stats.stats()["GPT-4"]["tokens_per_second"] > 0
@@ -0,0 +1,57 @@
+import asyncio
+
+from src.api.metrics import StageMetrics
+from src.llm.timing import mark_fallback, stage, timed, track_request
+
+
+@timed("answer")
+async def answer() -> str:
+    await asyncio.sleep(0.01)
+    return "answer"
+
+
+@timed("stream")
+async def stream():
+    for token in ["a", "b"]:
+        await asyncio.sleep(0.01)
+        yield token
+
+
+def test_stage_timings():
+    async def run():
+        with track_request("GPT-4") as timings:
+            with stage("retrieve"):
+                await asyncio.sleep(0.01)
+            await answer()
+            async for _ in stream():
+                # time spent by the consumer does not count for the stream stage
+                await asyncio.sleep(0.05)
+            mark_fallback()
+        return timings
+
+    timings = asyncio.run(run())
+
+    assert list(timings.stages.keys()) == ["retrieve", "answer", "stream", "total"]
+    assert 0.02 <= timings.stages["stream"] < 0.05
+    assert timings.stages["total"] >= 0.13
+    assert timings.fallback
+    assert timings.server_timing().startswith("retrieve;dur=")
+
+
+def test_stage_outside_of_request():
+    assert asyncio.run(answer()) == "answer"
+
+
+def test_metrics_rendering():
+    metrics = StageMetrics()
+    for _ in range(10):
+        with track_request("Llama3") as timings:
+            timings.add("llm_answer", 1.5)
+        metrics.observe(timings)
+
+    text = metrics.render({"kicwa_chat_queue_depth": ("Chats waiting.", [({"model": "Llama3"}, 3)])})
+
+    assert 'stage="llm_answer",model="Llama3",fallback="false"' in text
+    assert 'quantile="0.99"} 1.500000' in text
+    assert 'kicwa_chat_stage_duration_seconds_count{stage="llm_answer"' in text
+    assert 'kicwa_chat_queue_depth{model="Llama3",worker=' in text
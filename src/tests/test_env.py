@@ -0,0 +1,69 @@
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+from src.env import EnvHelper, SecretResolver
+
+SECRETS = {"AZURE-MISTRAL-KEY": "mistral-key", "DATA-SOURCE-STAGING-MOODLE-URL": "staging-url", "DEBUG-MODE": "true"}
+
+
+@pytest.fixture
+def key_vault(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    for key in [
+        "AZURE_MISTRAL_KEY",
+        "DATA_SOURCE_MOODLE_URL",
+        "DATA_SOURCE_STAGING_MOODLE_URL",
+        "DEBUG_MODE",
+        "KEY_VAULT_DISABLED",
+    ]:
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv("ENVIRONMENT", "STAGING")
+    fetched = []
+
+    def fetch(self, name: str) -> str | None:
+        fetched.append(name)
+        time.sleep(0.05)
+        return SECRETS.get(name.replace("_", "-"))
+
+    monkeypatch.setattr(SecretResolver, "fetch", fetch)
+    return fetched
+
+
+def test_secrets_are_resolved_lazily(key_vault: list[str]):
+    env = EnvHelper()
+    assert key_vault == []
+
+    assert env.AZURE_MISTRAL_KEY == "mistral-key"
+    # only the requested variable is fetched
+    assert key_vault == ["AZURE_MISTRAL_KEY"]
+    assert env.DATA_SOURCE_MOODLE_URL == "staging-url"
+    assert env.DEBUG_MODE is True
+    assert sorted(key_vault) == sorted(
+        ["AZURE_MISTRAL_KEY", "DATA_SOURCE_STAGING_MOODLE_URL", "DATA_SOURCE_MOODLE_URL", "DEBUG_MODE"]
+    )
+
+
+def test_prefetch_skips_env_only_variables(key_vault: list[str], monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delenv("LLM_HEDGING", raising=False)
+    env = EnvHelper()
+    env.prefetch()
+
+    assert env.AZURE_MISTRAL_KEY == "mistral-key" and env.LLM_HEDGING is False
+    assert "AZURE_MISTRAL_KEY" in key_vault and "LLM_HEDGING" not in key_vault
+
+
+def test_secret_cache(key_vault: list[str], monkeypatch: pytest.MonkeyPatch, tmp_path):
+    monkeypatch.setenv("ENV_CACHE_PATH", str(tmp_path / "secrets"))
+    monkeypatch.setenv("ENV_CACHE_KEY", Fernet.generate_key().decode())
+    env = EnvHelper()
+    env.prefetch()
+    assert env.AZURE_MISTRAL_KEY == "mistral-key"
+
+    for _ in range(100):
+        if (tmp_path / "secrets").exists():
+            break
+        time.sleep(0.05)
+    key_vault.clear()
+    assert EnvHelper().AZURE_MISTRAL_KEY == "mistral-key"
+    assert key_vault == []
@@ -0,0 +1,72 @@
+import pytest
+from qdrant_client.http.models import Distance, PointStruct, VectorParams
+
+from src.vectordb.catalog import CatalogNotLoadedError, CourseCatalog
+from src.vectordb.qdrant import VectorDBQdrant
+
+
+def create_memory_db(payloads: list[dict]) -> VectorDBQdrant:
+    vector_db = VectorDBQdrant(version="memory")
+    vector_db.client.create_collection("web_assistant", vectors_config=VectorParams(size=2, distance=Distance.DOT))
+    vector_db.client.upsert(
+        "web_assistant",
+        points=[PointStruct(id=i, vector=[1.0, 0.0], payload=payload) for i, payload in enumerate(payloads)],
+    )
+    return vector_db
+
+
+def test_catalog_lookup():
+    vector_db = create_memory_db(
+        [{"source": "Drupal"}, {"course_id": 79}, {"course_id": 79, "module_id": 12}, {"course_id": 102}]
+    )
+    catalog = CourseCatalog(vector_db)
+    catalog.load()
+
+    assert catalog.has_course(79)
+    assert catalog.has_course(102)
+    assert not catalog.has_course(12)
+    assert catalog.has_module(12)
+    assert not catalog.has_module(79)
+
+
+def test_catalog_refresh_on_collection_change():
+    vector_db = create_memory_db([{"course_id": 79}])
+    catalog = CourseCatalog(vector_db)
+    catalog.load()
+    assert not catalog.has_course(91)
+
+    vector_db.client.upsert("web_assistant", points=[PointStruct(id=100, vector=[1.0, 0.0], payload={"course_id": 91})])
+    catalog.refresh()
+    assert catalog.has_course(91)
+
+
+def test_catalog_lookup_does_not_load():
+    vector_db = create_memory_db([{"course_id": 79}])
+    catalog = CourseCatalog(vector_db)
+
+    with pytest.raises(CatalogNotLoadedError):
+        catalog.has_course(79)
+    catalog.refresh()
+    assert catalog.has_course(79)
+
+
+def test_catalog_notifies_listeners_only_after_rebuild():
+    vector_db = create_memory_db([{"course_id": 79}, {"course_id": 102}])
+    catalog = CourseCatalog(vector_db)
+    catalog.load()
+    changes = []
+    catalog.on_change(lambda: changes.append(True))
+
+    catalog.refresh()
+    catalog.refresh()
+    assert not changes
+
+    # rebuilt with new point ids and the same number of points
+    vector_db.client.delete_collection("web_assistant")
+    vector_db.client.create_collection("web_assistant", vectors_config=VectorParams(size=2, distance=Distance.DOT))
+    vector_db.client.upsert(
+        "web_assistant",
+        points=[PointStruct(id=i, vector=[1.0, 0.0], payload={"course_id": 91}) for i in (10, 11)],
+    )
+    catalog.refresh()
+    assert len(changes) == 1 and catalog.has_course(91) and not catalog.has_course(79)
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+from src.vectordb.qdrant import VectorDBQdrant
+
+REFRESH_INTERVAL = 60  # in seconds, how often the collection is checked for changes
+SCROLL_PAGE_SIZE = 1000
+
+logger = logging.getLogger("api")
+
+
+class CatalogNotLoadedError(RuntimeError):
+    pass
+
+
+class CourseCatalog:
+    """In-memory catalog of the course and module ids in a collection, used to validate requests without a Qdrant call.
+
+    The ids are loaded once at startup and refreshed by a background thread. The thread only checks the version of the
+    collection every REFRESH_INTERVAL seconds and reloads the ids when it changed, i.e. after the collection was
+    rebuilt by the loaders. A load that failed at startup is retried by the thread, lookups raise
+    CatalogNotLoadedError until then."""
+
+    def __init__(self, vector_db: VectorDBQdrant, collection_name: str = "web_assistant") -> None:
+        self.vector_db = vector_db
+        self.collection_name = collection_name
+
+        self._course_ids: frozenset[int] = frozenset()
+        self._module_ids: frozenset[int] = frozenset()
+        self._version: tuple[int | None, str | None] | None = None
+        self._loaded_at: float | None = None
+
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresh_thread: threading.Thread | None = None
+        self._change_listeners: list[Callable[[], None]] = []
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    def load(self) -> None:
+        """Load all course and module ids of the collection."""
+        with self._load_lock:
+            self._load()
+
+    def version(self) -> tuple[int | None, str | None]:
+        """The number of points and the id of the first point of the collection. The loaders rebuild the collection
+        with new point ids, so the version changes even when the number of points stays the same."""
+        points_count = self.vector_db.client.get_collection(self.collection_name).points_count
+        records, _ = self.vector_db.client.scroll(
+            collection_name=self.collection_name, with_payload=False, with_vectors=False, limit=1
+        )
+        return points_count, str(records[0].id) if records else None
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        version = self.version()
+        course_ids: set[int] = set()
+        module_ids: set[int] = set()
+
+        offset = None
+        while True:
+            records, offset = self.vector_db.client.scroll(
+                collection_name=self.collection_name,
+                with_payload=["course_id", "module_id"],
+                with_vectors=False,
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+            )
+            for record in records:
+                payload = record.payload or {}
+                if isinstance(payload.get("course_id"), int):
+                    course_ids.add(payload["course_id"])
+                if isinstance(payload.get("module_id"), int):
+                    module_ids.add(payload["module_id"])
+            if offset is None:
+                break
+
+        # Swapping the references is atomic, readers never see a partially loaded catalog
+        self._course_ids = frozenset(course_ids)
+        self._module_ids = frozenset(module_ids)
+        self._version = version
+        self._loaded_at = time.monotonic()
+        logger.info(
+            f"Loaded {len(course_ids)} courses and {len(module_ids)} modules from '{self.collection_name}' "
+            f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+        )
+
+    def on_change(self, listener: Callable[[], None]) -> None:
+        """Register a function that is called when a refresh finds that the collection was rebuilt."""
+        self._change_listeners.append(listener)
+
+    def refresh(self) -> None:
+        """Reload the ids if the version of the collection changed, or if they were not loaded yet."""
+        previous = self._version
+        if previous is not None and self.version() == previous:
+            return
+        self.load()
+        if previous is not None and self._version != previous:
+            for listener in self._change_listeners:
+                listener()
+
+    def start(self) -> None:
+        """Start refreshing the catalog in a background thread."""
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        self._stop.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, name="course-catalog", daemon=True)
+        self._refresh_thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def reset_after_fork(self) -> None:
+        """Threads and locks are not inherited by a forked process, the loaded ids and listeners are kept."""
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresh_thread = None
+        self._change_listeners = []
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(REFRESH_INTERVAL):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Refreshing the course catalog failed, keeping the previous ids.")
+
+    def _check_loaded(self) -> None:
+        # lookups never load the ids themselves, they run while a request is validated
+        if self._loaded_at is None:
+            raise CatalogNotLoadedError(f"The course catalog of '{self.collection_name}' is not loaded yet.")
+
+    def has_course(self, course_id: int) -> bool:
+        self._check_loaded()
+        return course_id in self._course_ids
+
+    def has_module(self, module_id: int) -> bool:
+        self._check_loaded()
+        return module_id in self._module_ids
@@ -3,7 +3,7 @@ import sys
 from typing import List
 
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
 from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
 from qdrant_client.http.models import Distance, PointStruct, VectorParams
 
@@ -17,10 +17,14 @@ sys.path.append(parent)
 class VectorDBQdrant:
     def __init__(self, version: str = "prod_remote"):
         self.version = version
+        # The async client is used by the async chat path. It connects lazily on first use.
+        # In memory mode the async client has its own storage, which is not synced with the sync client.
         if version == "memory":
             self.client = QdrantClient(":memory:")
+            self.aclient = AsyncQdrantClient(":memory:")
         elif version == "disk":
             self.client = QdrantClient("localhost", port=6333)
+            self.aclient = AsyncQdrantClient("localhost", port=6333)
             try:
                 _ = self.client.get_collections()
             except ResponseHandlingException as e:
@@ -34,17 +38,29 @@ class VectorDBQdrant:
             self.client = QdrantClient(
                 url=env.DEV_QDRANT_URL, port=443, https=True, timeout=120, api_key=env.DEV_QDRANT_API_KEY
             )
+            self.aclient = AsyncQdrantClient(
+                url=env.DEV_QDRANT_URL, port=443, https=True, timeout=120, api_key=env.DEV_QDRANT_API_KEY
+            )
             _ = self.client.get_collections()
         elif version == "prod_remote":
             self.client = QdrantClient(
                 url=env.PROD_QDRANT_URL, port=443, https=True, timeout=30, api_key=env.PROD_QDRANT_API_KEY
             )
+            self.aclient = AsyncQdrantClient(
+                url=env.PROD_QDRANT_URL, port=443, https=True, timeout=30, api_key=env.PROD_QDRANT_API_KEY
+            )
             _ = self.client.get_collections()
         else:
             raise ValueError("Version must be either 'memory' or 'disk' or 'remote'")
 
-    def as_llama_vector_store(self, collection_name) -> QdrantVectorStore:
-        return QdrantVectorStore(client=self.client, collection_name=collection_name, max_retries=10)
+    def as_llama_vector_store(self, collection_name, with_async_client: bool = False) -> QdrantVectorStore:
+        """Set with_async_client to use the async query methods of the vector store."""
+        return QdrantVectorStore(
+            client=self.client,
+            aclient=self.aclient if with_async_client else None,
+            collection_name=collection_name,
+            max_retries=10,
+        )
 
     def create_collection(self, collection_name, vector_size) -> None:
         try:
@@ -131,7 +147,7 @@ class VectorDBQdrant:
         scroll_filter = models.Filter(
             must=[
                 models.FieldCondition(
-                    key="course_id",
+                    key="module_id",
                     match=models.MatchValue(value=module_id),
                 ),
             ],